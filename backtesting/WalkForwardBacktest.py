@@ -1,11 +1,21 @@
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 from pandas.tseries import offsets as time_offset
+from pandas.tseries.frequencies import to_offset
 
+from backtesting.engine import calculate_instrument_pnl, run_nav_and_holdings_recursion, \
+    run_batch_nav_and_holdings_recursion, scale_weights, advance_from_state, calculate_cost_per_unit, \
+    calculate_transaction_costs
+from backtesting.portfolio_analysis import PortfolioResults
 from utils.dataset import DataSet
 
 
 class WalkForwardBtCompounding(object):
 
+    compounding = True  # positions are sized on the current nav
+
     # -----------------------
     # initialize object
     # -----------------------
@@ -16,7 +26,14 @@ class WalkForwardBtCompounding(object):
         :param weights: dataframe of trading_signals / weights
         :param prices: dataframe of prices (equal to or longer than weights dates)
         :param aum: scalar with initial aum
-        :param kwargs: # optional arguments: max_gross_leverage, max_net_leverage, name, dividends, contract_value, tc
+        :param kwargs: # optional arguments: max_gross_leverage, max_net_leverage, name, dividends, contract_value, tc,
+        engine ('loop' walks the dates with label lookups, 'array' runs the recursion on aligned numpy arrays),
+        dtype (np.float64 or np.float32 for the holdings and pnl buffers), cache (utils.result_cache.ResultCache),
+        trading costs are charged by the array engine only (the loop engine raises a ValueError if any are set):
+        trading_costs (proportional to the traded notional),
+        fee_per_contract (scalar or pd.Series per instrument), slippage (multiple of the return vol, estimated with
+        an ewm of span slippage_vol_span), universe (utils.universe_helpers.UniverseMembership), constant_exposure
+        with constant_long / constant_short (long and short exposure, defaults 1 and -1)
         """
 
         # set aum
@@ -37,17 +54,46 @@ class WalkForwardBtCompounding(object):
             self.max_pos_leverage = 1
         if 'constant_exposure' in kwargs:
             self.constant_exposure = kwargs['constant_exposure']
-            self.constant_long = 1
-            self.constant_short = -1
         else:
             self.constant_exposure = False
+        # with constant exposure longs sum to constant_long and shorts to constant_short
+        if 'constant_long' in kwargs:
+            self.constant_long = kwargs['constant_long']
+        else:
+            self.constant_long = 1
+        if 'constant_short' in kwargs:
+            self.constant_short = kwargs['constant_short']
+        else:
+            self.constant_short = -1
         if 'config' in kwargs:
             self.max_pos_leverage = kwargs['config'].position_limit
             self.max_net_leverage = kwargs['config'].max_net_leverage
             self.max_gross_leverage = kwargs['config'].max_gross_leverage
 
+        if 'engine' in kwargs:
+            self.engine = kwargs['engine']
+        else:
+            self.engine = 'loop'
+        assert self.engine in ['loop', 'array'], "Unknown backtest engine %s" % self.engine
+        if 'dtype' in kwargs:
+            self.dtype = np.dtype(kwargs['dtype'])
+        else:
+            self.dtype = np.dtype(np.float64)
+        if 'cache' in kwargs:
+            self.cache = kwargs['cache']  # results are loaded from / stored in the cache if supplied
+        else:
+            self.cache = None
+
+        if 'universe' in kwargs:
+            # utils.universe_helpers.UniverseMembership, weights of markets not live at a date are set to 0
+            self.universe = kwargs['universe']
+        else:
+            self.universe = None
+
         # weights
         self.weights = weights.loc[weights.first_valid_index():]  # trading weights/signals (supplied)
+        if self.universe is not None:
+            self.weights = self.universe.mask_weights(self.weights)
         self.scaled_weights = None  # scaled weights
         # dates
         self.trading_dt_index = None  # trading dates index
@@ -68,19 +114,35 @@ class WalkForwardBtCompounding(object):
         if 'dividends' in kwargs:
             self.dividends = kwargs['dividends']  # dividends (supplied or none)
         else:
-            self.dividends = pd.DataFrame(index=self.close.index, columns=self.close.columns).fillna(0)
+            self.dividends = pd.DataFrame(index=self.close.index, columns=self.close.columns, data=0.)
         if 'trading_costs' in kwargs:
             self.trading_costs = kwargs['trading_costs']  # (supplied or none)
         else:
-            self.trading_costs = pd.DataFrame(index=self.close.index, columns=self.close.columns).fillna(0)
+            self.trading_costs = pd.DataFrame(index=self.close.index, columns=self.close.columns, data=0.)
+        if 'fee_per_contract' in kwargs:
+            self.fee_per_contract = kwargs['fee_per_contract']
+        else:
+            self.fee_per_contract = 0
+        if 'slippage' in kwargs:
+            self.slippage = kwargs['slippage']
+        else:
+            self.slippage = 0
+        if 'slippage_vol_span' in kwargs:
+            self.slippage_vol_span = kwargs['slippage_vol_span']
+        else:
+            self.slippage_vol_span = 20
+        if self.engine == 'loop' and self._costs_enabled(pd.DataFrame(self.trading_costs).values):
+            raise ValueError("trading_costs, fee_per_contract and slippage are only charged by engine='array'")
         if 'point_value_instrument' in kwargs:
             self.point_value_instrument = kwargs['point_value_instrument']
         else:
-            self.point_value_instrument = pd.DataFrame(index=self.close.index, columns=self.close.columns).fillna(1)
+            self.point_value_instrument = pd.DataFrame(index=self.close.index, columns=self.close.columns, data=1.)
 
         # initialize holdings and pnl per instrument dataframes
         self.holdings = None  # initialize holdings
         self.pnl_per_instrument = None
+        self.net_asset_value = None  # nav series on the backtest date index
+        self.transaction_costs = None  # costs charged per date by the array engine
 
         # backtest will be a dataset with entries net_asset_value (a pd.Series) and holdings (a pd.Dataframe)
         self._backtest = None
@@ -156,11 +218,19 @@ class WalkForwardBtCompounding(object):
             x = pd.concat([x_long, x_short], axis=0).reindex(index_order)
         return x
 
+    def _calculate_scaled_weights(self, weights):
+        # whole-matrix equivalent of applying _weight_scaling_alternative to every row
+        if self.constant_exposure is False:
+            scaled_weights = scale_weights(weights.values, self.max_pos_leverage, self.max_gross_leverage,
+                                           self.max_net_leverage)
+        else:
+            scaled_weights = scale_weights(weights.values, constant_exposure=True,
+                                           constant_long=self.constant_long, constant_short=self.constant_short)
+        return pd.DataFrame(scaled_weights, index=weights.index, columns=weights.columns)
+
     def _scale_weights(self):
         # ensures that we are never invested with leverage > leverage_max,
-        scaled_weights_tmp = self.weights.copy()
-        scaled_weights = scaled_weights_tmp.swifter.apply(lambda x: self._weight_scaling_alternative(x), axis=1)
-        self.scaled_weights = scaled_weights
+        self.scaled_weights = self._calculate_scaled_weights(self.weights)
 
     # ----------------------------------------------------------------
     # initialize  holdings, and pnl per instrument dataframes
@@ -168,15 +238,15 @@ class WalkForwardBtCompounding(object):
 
     # initialize holdings dataframe, first entry is at t=0 == 0
     def _initialize_holdings(self):
-        holdings = pd.DataFrame(index=self.bt_dt_index, columns=self.weights.columns)
-        holdings.iloc[0] = 0  # holdings initialized at 0
-        self.holdings = holdings
+        holdings = np.full((len(self.bt_dt_index), self.weights.shape[1]), np.nan, dtype=self.dtype)
+        holdings[0] = 0  # holdings initialized at 0
+        self.holdings = pd.DataFrame(holdings, index=self.bt_dt_index, columns=self.weights.columns)
 
     # initialize pnl per instrument dataframe, first entry is 0
     def _initialize_pnl_per_instrument(self):
-        pnl_per_instrument = pd.DataFrame(index=self.bt_dt_index, columns=self.close.columns)
-        pnl_per_instrument.iloc[0] = 0
-        self.pnl_per_instrument = pnl_per_instrument
+        pnl_per_instrument = np.full((len(self.bt_dt_index), self.close.shape[1]), np.nan, dtype=self.dtype)
+        pnl_per_instrument[0] = 0
+        self.pnl_per_instrument = pd.DataFrame(pnl_per_instrument, index=self.bt_dt_index, columns=self.close.columns)
 
     # -------------------------------
     # prepare date index and df
@@ -205,7 +275,7 @@ class WalkForwardBtCompounding(object):
                 initialization_date = dt_t0_tmp[0] - time_offset.Day(1)
             elif freq == 'min':
                 initialization_date = dt_t0_tmp[0] - time_offset.Minute(1)
-            elif freq == 'H':
+            elif freq == 'h' or freq == 'H':
                 initialization_date = dt_t0_tmp[0] - time_offset.Hour(1)
             else:
                 import pdb
@@ -216,17 +286,20 @@ class WalkForwardBtCompounding(object):
             dates_t0_index = dt_t0_tmp.append(pd.DatetimeIndex([initialization_date])).sort_values()
         return dates_t0_index
 
-    def _construct_dates_df(self):
+    def _construct_dates_df(self, bt_dt_index=None):
         """ constructs a dataframe of dates with index t, and columns dt_previous and dt_next for t-1 and t + 1
         we need date t + 1 to calculate holdings at t, we buy/sell a position at the open of t + 1
         we need date t - 1 to calculate holdings at t if t is not a trading date and to calculate the current
-        investment value which is the investment value at t-1 + the pnl over period [t-1, t] """
-        dt_df = pd.DataFrame(index=self.bt_dt_index)
+        investment value which is the investment value at t-1 + the pnl over period [t-1, t]
+        :param bt_dt_index: backtest date index, defaults to self.bt_dt_index """
+        if bt_dt_index is None:
+            bt_dt_index = self.bt_dt_index
+        dt_df = pd.DataFrame(index=bt_dt_index)
         dt_df['dt_previous'] = dt_df.index.copy()
         # date at t-1 is the previous date for date t
         dt_df.dt_previous = dt_df.dt_previous.shift(1)
         # first date previous is initialization date
-        dt_df.iloc[0].previous = self.bt_dt_index[0]
+        dt_df.iloc[0].previous = bt_dt_index[0]
         dt_df['dt_next'] = dt_df.index.copy()
         dt_df.dt_next = dt_df['dt_next'].shift(-1)
         dt_df['dt_now'] = dt_df.index.copy()
@@ -324,6 +397,321 @@ class WalkForwardBtCompounding(object):
                 holdings_previous * point_value_now * (pnl_now + dividends_now)).sum()
         return net_asset_value_now
 
+    # --------------------
+    # array engine
+    # --------------------
+
+    def _align_prices_to_arrays(self, bt_dt_index):
+        """ aligns the price inputs once on a backtest date index and the weights columns, returns float arrays """
+        columns = self.weights.columns
+
+        def align(df):
+            return pd.DataFrame(df).reindex(index=bt_dt_index, columns=columns).values.astype(np.float64)
+
+        arrays = DataSet()
+        arrays.close = align(self.close)
+        arrays.open = align(self.open)
+        arrays.close_diff = align(pd.DataFrame(self.close).diff(1, axis=0))
+        arrays.dividends = align(self.dividends)
+        arrays.point_value = align(self.point_value_instrument)
+        arrays.trading_costs = align(self.trading_costs)
+        return arrays
+
+    def _costs_enabled(self, trading_costs):
+        """ :param trading_costs: np.array of the proportional trading costs of the dates costs are charged on """
+        fee_per_contract = np.asarray(self.fee_per_contract)
+        return bool(np.any(fee_per_contract != 0) or self.slippage != 0 or
+                    np.any(np.nan_to_num(trading_costs) != 0))
+
+    def _get_slippage_history_length(self):
+        """ number of closes the slippage vol depends on, older returns carry an ewm weight below float precision """
+        alpha = 2. / (self.slippage_vol_span + 1)
+        return int(np.ceil(np.log(np.finfo(np.float64).eps) / np.log(1 - alpha))) + 2
+
+    def _calculate_cost_per_unit(self, bt_dt_index, arrays, close=None):
+        """
+        cost of trading one unit per date and instrument on a backtest date index, None if there are no costs
+        :param close: close prices the slippage vol is estimated on, defaults to self.close
+        """
+        if not self._costs_enabled(arrays.trading_costs):
+            return None
+        columns = self.weights.columns
+        fee_per_contract = self.fee_per_contract
+        if isinstance(fee_per_contract, pd.Series):
+            fee_per_contract = fee_per_contract.reindex(columns).fillna(0).values
+        volatility = 0
+        if self.slippage != 0:
+            # vol known at the decision date t-1 is used for a trade executed at the open of t
+            returns = np.log(pd.DataFrame(self.close if close is None else close)).diff(1)
+            volatility = returns.ewm(span=self.slippage_vol_span).std().shift(1)
+            volatility = volatility.reindex(index=bt_dt_index, columns=columns).values
+        return calculate_cost_per_unit(arrays.open, arrays.point_value, arrays.trading_costs, fee_per_contract,
+                                       self.slippage, volatility)
+
+    def _align_weights_to_arrays(self, bt_dt_index):
+        """ scaled weights and trading date flags on a backtest date index, dates before t0 are never traded """
+        weights = self.scaled_weights.reindex(index=bt_dt_index, columns=self.weights.columns).values
+        is_trading_date = np.asarray(bt_dt_index.isin(self.trading_dt_index))
+        is_trading_date[:bt_dt_index.get_loc(self.bt_dt_index[0]) + 1] = False
+        return weights.astype(np.float64), is_trading_date
+
+    def _run_array_engine(self):
+        """ runs the nav / holdings recursion over integer positions """
+        arrays = self._align_prices_to_arrays(self.bt_dt_index)
+        weights, is_trading_date = self._align_weights_to_arrays(self.bt_dt_index)
+        pnl = calculate_instrument_pnl(arrays.close, arrays.open, arrays.close_diff, arrays.dividends,
+                                       np.roll(is_trading_date, 1))
+        cost_per_unit = self._calculate_cost_per_unit(self.bt_dt_index, arrays)
+        nav, holdings = run_nav_and_holdings_recursion(weights, arrays.open, arrays.point_value, pnl,
+                                                       arrays.dividends, is_trading_date, self.aum,
+                                                       compounding=self.compounding, dtype=self.dtype,
+                                                       cost_per_unit=cost_per_unit)
+        return self._set_backtest_from_arrays(nav, holdings, pnl, cost_per_unit)
+
+    def _set_backtest_from_arrays(self, nav, holdings, pnl, cost_per_unit=None):
+        """ wraps the array engine output on the backtest date index, sets holdings and pnl_per_instrument """
+        if cost_per_unit is not None:
+            self.transaction_costs = pd.Series(calculate_transaction_costs(holdings, cost_per_unit),
+                                               index=self.bt_dt_index)
+        self.holdings = pd.DataFrame(holdings, index=self.bt_dt_index, columns=self.weights.columns)
+        self.pnl_per_instrument = pd.DataFrame(pnl.astype(self.dtype, copy=False), index=self.bt_dt_index,
+                                               columns=self.weights.columns)
+        net_asset_value_series = pd.Series(nav, index=self.bt_dt_index)
+        return self._assemble_backtest(net_asset_value_series, self.holdings)
+
+    def _assemble_backtest(self, net_asset_value_series, holdings_df):
+        self.net_asset_value = net_asset_value_series  # nav on the backtest date index, before resampling
+        backtest_dataset = DataSet()
+        backtest_dataset.holdings = holdings_df.resample(self.frequency).last()
+        backtest_dataset.net_asset_value = net_asset_value_series.resample(self.frequency).last()
+        backtest_dataset.cumulative_pnl_per_instrument = self._get_pnl_attribution()
+        self._backtest = backtest_dataset
+        self._store_backtest_in_cache()
+
+        return self._backtest
+
+    # --------------------
+    # result cache
+    # --------------------
+
+    def _get_cache_key(self):
+        return self.cache.make_key(self.weights, self.close, self.open, self.dividends, self.point_value_instrument,
+                                   self.trading_costs, strategy=type(self).__name__, aum=self.aum,
+                                   max_pos_leverage=self.max_pos_leverage, max_gross_leverage=self.max_gross_leverage,
+                                   max_net_leverage=self.max_net_leverage, constant_exposure=self.constant_exposure,
+                                   constant_long=self.constant_long, constant_short=self.constant_short,
+                                   compounding=self.compounding, dtype=str(self.dtype), engine=self.engine,
+                                   fee_per_contract=self.fee_per_contract, slippage=self.slippage,
+                                   slippage_vol_span=self.slippage_vol_span)
+
+    def _load_backtest_from_cache(self):
+        """ returns the cached backtest DataSet, None if there is no cache or no entry """
+        if self.cache is None:
+            return None
+        backtest = self.cache.get(self._get_cache_key())
+        if backtest is not None:
+            # frames stored alongside the backtest are restored as attributes
+            self.pnl_per_instrument = backtest.pop('pnl_per_instrument')
+            self.transaction_costs = backtest.pop('transaction_costs', None)
+            self.holdings = backtest.holdings
+            self.net_asset_value = backtest.net_asset_value
+            self._backtest = backtest
+        return backtest
+
+    def _store_backtest_in_cache(self):
+        if self.cache is not None:
+            results = dict(self._backtest, pnl_per_instrument=self.pnl_per_instrument)
+            if self.transaction_costs is not None:
+                results['transaction_costs'] = self.transaction_costs
+            self.cache.put(self._get_cache_key(), results)
+
+    # --------------------
+    # incremental backtest
+    # --------------------
+
+    def get_backtest_state(self):
+        """
+        compact snapshot of the backtest at the last bar, extend continues from it
+        :return: DataSet with last_date, net_asset_value, holdings (held over the last bar), last_is_trading_date,
+        pending_weights (scaled weights at the last bar, traded at the next open), close, point_value and
+        trading_costs at the last bar, close_history (the closes the slippage vol of the next bars depends on, None
+        without slippage) and cumulative_pnl_per_instrument (running pnl attribution, None if the backtest has none)
+        """
+        if self._backtest is None:
+            self.calculate_backtest_performance()
+        last_date = self.bt_dt_index[-1]
+        state = DataSet()
+        state.last_date = last_date
+        state.net_asset_value = self.net_asset_value.iloc[-1]
+        state.holdings = self.holdings.iloc[-2].astype(np.float64)
+        state.last_is_trading_date = last_date in self.trading_dt_index
+        if state.last_is_trading_date:
+            state.pending_weights = self.scaled_weights.loc[last_date].astype(np.float64)
+        else:
+            state.pending_weights = None
+        state.close = self.close.loc[last_date]
+        state.point_value = self.point_value_instrument.loc[last_date]
+        state.trading_costs = pd.DataFrame(self.trading_costs).iloc[-1]
+        if self.slippage != 0:
+            state.close_history = pd.DataFrame(self.close).iloc[-self._get_slippage_history_length():]
+        else:
+            state.close_history = None
+        if 'cumulative_pnl_per_instrument' in self._backtest:
+            state.cumulative_pnl_per_instrument = self._get_cumulative_pnl_total()
+        else:
+            state.cumulative_pnl_per_instrument = None
+        return state
+
+    def _get_cumulative_pnl_total(self):
+        """ running total of the pnl attribution per instrument, from its last row and the bars after it """
+        attribution = self._backtest.cumulative_pnl_per_instrument
+        if len(attribution) > 0:
+            start = self.holdings.index.get_loc(attribution.index[-1]) + 1
+            pnl = self.holdings.iloc[start:] * self.pnl_per_instrument.iloc[start:]
+            pnl = pd.concat([attribution.iloc[-1:], pnl])
+        else:
+            pnl = self.holdings * self.pnl_per_instrument
+        return pnl.cumsum().ffill().iloc[-1].fillna(0)
+
+    def _resample_from(self, resampled, raw, date):
+        """
+        :param resampled: raw resampled to self.frequency before raw changed from date on
+        :return: resampled with the buckets from the one holding date on recomputed from the rows of raw
+        """
+        bucket = pd.Series(0, index=[date]).resample(self.frequency).last().index[0]
+        kept = resampled.iloc[:resampled.index.searchsorted(bucket)]
+        # rows after the last kept bucket cover all buckets from the one holding date on
+        tail = raw.iloc[raw.index.searchsorted(kept.index[-1], side='right'):] if len(kept) > 0 else raw
+        recomputed = tail.resample(self.frequency).last()
+        return pd.concat([kept, recomputed.iloc[recomputed.index.searchsorted(bucket):]])
+
+    def _extend_backtest(self, state):
+        """
+        appends the bars from the last bar of state on (its holdings are only known now) to the backtest, only the
+        resample buckets and pnl attribution rows from that bar on are recomputed
+        """
+        backtest = self._backtest
+        backtest.holdings = self._resample_from(backtest.holdings, self.holdings, state.last_date)
+        backtest.net_asset_value = self._resample_from(backtest.net_asset_value, self.net_asset_value,
+                                                       state.last_date)
+        start = self.holdings.index.get_loc(state.last_date)
+        pnl = self.holdings.iloc[start:] * self.pnl_per_instrument.iloc[start:]
+        # the running total is prepended, so the sums are those of a cumsum over the full history
+        cumulative_pnl = state.cumulative_pnl_per_instrument.to_frame().T
+        attribution = pd.concat([cumulative_pnl, pnl]).cumsum().iloc[1:].dropna()
+        attribution_previous = backtest.cumulative_pnl_per_instrument
+        backtest.cumulative_pnl_per_instrument = pd.concat([
+            attribution_previous.iloc[:attribution_previous.index.searchsorted(state.last_date)], attribution])
+        return backtest
+
+    def extend(self, weights_new, prices_new, **kwargs):
+        """
+        appends new bars and continues the backtest from the state at the last bar. The recursion, costs, dates,
+        resampling and pnl attribution run over the new bars only, the results are appended to the full history
+        frames. The extended backtest is not stored in the cache
+        :param weights_new: dataframe of trading weights for dates after the last bar (may be empty)
+        :param prices_new: dataframe of close prices for dates after the last bar
+        :param kwargs: optional arguments: open_new (defaults to previous close), dividends_new (defaults to 0),
+        point_value_new (defaults to last point value), trading_costs_new (defaults to last trading costs),
+        state (defaults to get_backtest_state())
+        :return: backtest DataSet over the full history
+        """
+        if 'state' in kwargs:
+            state = kwargs['state']
+        else:
+            state = self.get_backtest_state()
+        last_date = state.last_date
+        assert prices_new.index[0] > last_date, "New prices need to start after the last bar %s" % last_date
+        columns = self.close.columns
+
+        prices_new = pd.DataFrame(prices_new).reindex(columns=columns)
+        if 'open_new' in kwargs:
+            open_new = kwargs['open_new']
+        else:
+            open_new = pd.concat([state.close.to_frame().T, prices_new]).shift(1).iloc[1:]
+        if 'dividends_new' in kwargs:
+            dividends_new = kwargs['dividends_new']
+        else:
+            dividends_new = pd.DataFrame(index=prices_new.index, columns=columns, data=0.)
+        if 'point_value_new' in kwargs:
+            point_value_new = kwargs['point_value_new']
+        else:
+            point_value_new = pd.DataFrame(index=prices_new.index, columns=columns,
+                                           data=np.tile(state.point_value.values, (prices_new.shape[0], 1)))
+        if 'trading_costs_new' in kwargs:
+            trading_costs_new = kwargs['trading_costs_new']
+        else:
+            trading_costs_new = pd.DataFrame(index=prices_new.index, columns=columns,
+                                             data=np.tile(state.trading_costs.reindex(columns).values,
+                                                          (prices_new.shape[0], 1)))
+        weights_new = weights_new.reindex(columns=self.weights.columns)
+        if self.universe is not None:
+            weights_new = self.universe.mask_weights(weights_new)
+        scaled_weights_new = self._calculate_scaled_weights(weights_new)
+
+        # arrays over the new bars, the recursion continues from the state at the last bar
+        dates = pd.DatetimeIndex([last_date]).append(prices_new.index)
+        state_columns = self.weights.columns
+
+        def align(df):
+            return pd.DataFrame(df).reindex(columns=state_columns).values.astype(np.float64)
+
+        state_arrays = {'net_asset_value': state.net_asset_value,
+                        'holdings': state.holdings.reindex(state_columns).values,
+                        'last_is_trading_date': state.last_is_trading_date,
+                        'pending_weights': None if state.pending_weights is None else
+                        state.pending_weights.reindex(state_columns).values,
+                        'close': state.close.reindex(state_columns).values.astype(np.float64),
+                        'point_value': state.point_value.reindex(state_columns).values.astype(np.float64)}
+        weights = scaled_weights_new.reindex(index=prices_new.index).values.astype(np.float64)
+        is_trading_date = np.asarray(prices_new.index.isin(scaled_weights_new.index))
+
+        # append the new bars to the inputs
+        self.weights = pd.concat([self.weights, weights_new])
+        self.scaled_weights = pd.concat([self.scaled_weights, scaled_weights_new])
+        self.close = pd.concat([self.close, prices_new])
+        self.open = pd.concat([self.open, open_new])
+        self.dividends = pd.concat([self.dividends, dividends_new])
+        self.point_value_instrument = pd.concat([self.point_value_instrument, point_value_new])
+        self.trading_costs = pd.concat([self.trading_costs, trading_costs_new])
+
+        arrays_new = DataSet()
+        arrays_new.open = align(open_new)
+        arrays_new.point_value = align(point_value_new)
+        arrays_new.trading_costs = align(trading_costs_new)
+        # the slippage vol continues from the closes before the new bars
+        close_history = None if state.close_history is None else pd.concat([state.close_history, prices_new])
+        cost_per_unit = self._calculate_cost_per_unit(prices_new.index, arrays_new, close=close_history)
+        if cost_per_unit is None and self.transaction_costs is not None:
+            cost_per_unit = np.zeros((prices_new.shape[0], len(state_columns)))
+        nav, holdings, pnl = advance_from_state(state_arrays, weights, align(prices_new), arrays_new.open,
+                                                align(dividends_new), arrays_new.point_value, is_trading_date,
+                                                self.aum, compounding=self.compounding, dtype=self.dtype,
+                                                cost_per_unit=cost_per_unit)
+        if cost_per_unit is not None:
+            transaction_costs = calculate_transaction_costs(holdings, np.vstack([np.zeros(len(state_columns)),
+                                                                                 cost_per_unit]),
+                                                            holdings_before=state_arrays['holdings'])
+            transaction_costs_previous = self.transaction_costs if self.transaction_costs is not None else \
+                pd.Series(0., index=self.bt_dt_index)
+            self.transaction_costs = pd.concat([transaction_costs_previous,
+                                                pd.Series(transaction_costs[1:], index=dates[1:])])
+
+        # append the new bars to the results, the last bar's row is replaced
+        self.trading_dt_index = self.weights.index
+        self.price_date_index = self.close.index
+        self.bt_dt_index = self.bt_dt_index.append(prices_new.index)
+        if last_date in self.dt_df.index:
+            self.dt_df.loc[last_date, 'dt_next'] = prices_new.index[0]
+        self.dt_df = pd.concat([self.dt_df, self._construct_dates_df(dates)])
+        self.holdings = pd.concat([self.holdings.iloc[:-1], pd.DataFrame(holdings, index=dates,
+                                                                         columns=state_columns)])
+        self.pnl_per_instrument = pd.concat([self.pnl_per_instrument,
+                                             pd.DataFrame(pnl[1:].astype(self.dtype), index=dates[1:],
+                                                          columns=state_columns)])
+        self.net_asset_value = pd.concat([self.net_asset_value.iloc[:-1], pd.Series(nav, index=dates)])
+        return self._extend_backtest(state)
+
     # --------------------
     # RUN BACKTEST
     # --------------------
@@ -332,6 +720,11 @@ class WalkForwardBtCompounding(object):
         """
         :return: returns a DataSet object with 2 keys: net_asset_value (pd.Series), holdings (pd.DataFrame)
         """
+        cached_backtest = self._load_backtest_from_cache()
+        if cached_backtest is not None:
+            return cached_backtest
+        if self.engine == 'array':
+            return self._run_array_engine()
         net_asset_value_series = pd.Series()
         net_asset_value_series.loc[self.bt_dt_index[0]] = self.aum
         holdings_df = self.holdings
@@ -340,7 +733,8 @@ class WalkForwardBtCompounding(object):
             # get previous date
             date_previous = self.dt_df.dt_previous.loc[date]
             # calculate pnl per instrument
-            self.pnl_per_instrument.loc[date] = self._calculate_instruments_pnl(self.dt_df.loc[date])
+            self.pnl_per_instrument.loc[date] = self._calculate_instruments_pnl(self.dt_df.loc[date]).astype(
+                self.dtype)
             net_asset_value_now = self._update_net_asset_value(
                 self.dt_df.loc[date], net_asset_value_series.loc[date_previous], holdings_df.loc[date_previous])
             # update nav at date t
@@ -348,16 +742,10 @@ class WalkForwardBtCompounding(object):
             # don't update holdings at last date as we have no open t+1 price
             if date != self.dt_df.index[-1]:
                 holdings_df.loc[date] = self._update_holdings(
-                    self.dt_df.loc[date], holdings_df.loc[date_previous], net_asset_value_now)
+                    self.dt_df.loc[date], holdings_df.loc[date_previous], net_asset_value_now).astype(self.dtype)
             if date.is_year_end and date.time().hour is 23:
                 print("\nStrategy value for date " + str(date) + " for strategy calculated \n")
-        backtest_dataset = DataSet()
-        backtest_dataset.holdings = holdings_df.resample(self.frequency).last()
-        backtest_dataset.net_asset_value = net_asset_value_series.resample(self.frequency).last()
-        backtest_dataset.cumulative_pnl_per_instrument = self._get_pnl_attribution()
-        self._backtest = backtest_dataset
-
-        return self._backtest
+        return self._assemble_backtest(net_asset_value_series, holdings_df)
 
     @property
     def backtest(self):
@@ -373,12 +761,35 @@ class WalkForwardBtNoCompounding(WalkForwardBtCompounding):
     current NAV
     """
 
+    compounding = False  # positions are sized on the initial aum
+
     def __init__(self, weights, prices, aum, **kwargs):
         super().__init__(weights, prices, aum, **kwargs)
 
+    def _assemble_backtest(self, net_asset_value_series, holdings_df):
+        self.net_asset_value = net_asset_value_series
+        backtest_dataset = DataSet()
+        backtest_dataset.holdings = holdings_df
+        backtest_dataset.net_asset_value = net_asset_value_series
+        self._backtest = backtest_dataset
+        self._store_backtest_in_cache()
+
+        return self._backtest
+
+    def _extend_backtest(self, state):
+        # the backtest holds the full history frames, nothing is resampled or attributed
+        self._backtest.holdings = self.holdings
+        self._backtest.net_asset_value = self.net_asset_value
+        return self._backtest
+
     def calculate_backtest_performance(self):
 
         # outputs a dataset with entries a) net_asset_value (a series) and b) holdings: a holdings dataframe
+        cached_backtest = self._load_backtest_from_cache()
+        if cached_backtest is not None:
+            return cached_backtest
+        if self.engine == 'array':
+            return self._run_array_engine()
         net_asset_value_series = pd.Series()
         net_asset_value_series.loc[self.bt_dt_index[0]] = self.aum
         holdings_df = self.holdings
@@ -387,7 +798,8 @@ class WalkForwardBtNoCompounding(WalkForwardBtCompounding):
             # get previous date
             date_previous = self.dt_df.dt_previous.loc[date]
             # calculate pnl per instrument
-            self.pnl_per_instrument.loc[date] = self._calculate_instruments_pnl(self.dt_df.loc[date])
+            self.pnl_per_instrument.loc[date] = self._calculate_instruments_pnl(self.dt_df.loc[date]).astype(
+                self.dtype)
             net_asset_value_now = self._update_net_asset_value(
                 self.dt_df.loc[date], net_asset_value_series.loc[date_previous], holdings_df.loc[date_previous])
             # update nav at date t
@@ -396,12 +808,265 @@ class WalkForwardBtNoCompounding(WalkForwardBtCompounding):
             # if date != self.trading_dt_index[-1]:
             if date != self.dt_df.index[-1]:
                 holdings_df.loc[date] = self._update_holdings(
-                    self.dt_df.loc[date], holdings_df.loc[date_previous], self.aum)
+                    self.dt_df.loc[date], holdings_df.loc[date_previous], self.aum).astype(self.dtype)
             if date.is_year_end and date.time().hour is 23:
                 print("\nStrategy value for date " + str(date) + " for strategy calculated \n")
-        backtest_dataset = DataSet()
-        backtest_dataset.holdings = holdings_df
-        backtest_dataset.net_asset_value = net_asset_value_series
-        self._backtest = backtest_dataset
+        return self._assemble_backtest(net_asset_value_series, holdings_df)
 
+
+class WalkForwardBtBatch(object):
+    """
+    runs several strategies on one price panel. Prices, open, dividends and point values are derived and aligned once,
+    all strategies then advance together through the array engine. Each strategy is kept as a WalkForwardBt object
+    (in self.strategies) so that PortfolioResults and Comparis can consume it directly
+    """
+
+    def __init__(self, weights, prices, aum, compounding=False, **kwargs):
+        """
+        :param weights: dict of name: weights dataframe, or a np.array (S, T, N) aligned on the prices index/columns
+        :param prices: dataframe of prices shared by all strategies
+        :param aum: scalar with initial aum
+        :param compounding: Boolean, if True strategies are WalkForwardBtCompounding else WalkForwardBtNoCompounding
+        :param kwargs: optional arguments as for WalkForwardBtCompounding
+        """
+        if isinstance(weights, np.ndarray):
+            weights = {i: pd.DataFrame(weights[i], index=prices.index, columns=prices.columns)
+                       for i in range(weights.shape[0])}
+        self.aum = aum
+        self.compounding = compounding
+        self.close = prices
+        # derive the shared price inputs once, all strategies reference the same frames
+        if 'open' not in kwargs:
+            kwargs['open'] = pd.DataFrame(prices).shift(1)
+        if 'dividends' not in kwargs:
+            kwargs['dividends'] = pd.DataFrame(index=prices.index, columns=prices.columns, data=0.)
+        if 'trading_costs' not in kwargs:
+            kwargs['trading_costs'] = pd.DataFrame(index=prices.index, columns=prices.columns, data=0.)
+        if 'point_value_instrument' not in kwargs:
+            kwargs['point_value_instrument'] = pd.DataFrame(index=prices.index, columns=prices.columns, data=1.)
+        kwargs['engine'] = 'array'
+
+        bt_class = WalkForwardBtCompounding if compounding else WalkForwardBtNoCompounding
+        self.strategies = DataSet()
+        for name, strategy_weights in weights.items():
+            self.strategies[name] = bt_class(strategy_weights, prices, aum, **kwargs)
+        # the backtest date index of the strategy starting first covers all others
+        self.bt_dt_index = min([strategy.bt_dt_index for strategy in self.strategies.values()], key=lambda x: x[0])
+        self._backtest = None
+
+    def calculate_backtest_performance(self):
+        """
+        :return: DataSet of name: backtest DataSet, as returned by the single strategy backtests
+        """
+        strategies = list(self.strategies.values())
+        # all strategies share the price arrays, columns are those of the first strategy
+        columns = strategies[0].weights.columns
+        assert all([strategy.weights.columns.equals(columns) for strategy in strategies]), \
+            "All strategies need the same instrument columns"
+        arrays = strategies[0]._align_prices_to_arrays(self.bt_dt_index)
+        weights, is_trading_date = zip(*[strategy._align_weights_to_arrays(self.bt_dt_index)
+                                         for strategy in strategies])
+        weights, is_trading_date = np.stack(weights), np.stack(is_trading_date)
+        pnl = calculate_instrument_pnl(arrays.close, arrays.open, arrays.close_diff, arrays.dividends,
+                                       np.roll(is_trading_date, 1, axis=1))
+        cost_per_unit = strategies[0]._calculate_cost_per_unit(self.bt_dt_index, arrays)
+        nav, holdings = run_batch_nav_and_holdings_recursion(weights, arrays.open, arrays.point_value, pnl,
+                                                             arrays.dividends, is_trading_date, self.aum,
+                                                             compounding=self.compounding,
+                                                             dtype=strategies[0].dtype, cost_per_unit=cost_per_unit)
+        backtest = DataSet()
+        for i, (name, strategy) in enumerate(self.strategies.items()):
+            # cut the shared arrays to the strategy's own backtest dates
+            start = self.bt_dt_index.get_loc(strategy.bt_dt_index[0])
+            pnl_strategy = pnl[i, start:]
+            pnl_strategy[0] = 0
+            cost_per_unit_strategy = None if cost_per_unit is None else cost_per_unit[start:]
+            backtest[name] = strategy._set_backtest_from_arrays(nav[i, start:], holdings[i, start:], pnl_strategy,
+                                                                cost_per_unit_strategy)
+        self._backtest = backtest
+
+        return self._backtest
+
+    @property
+    def backtest(self):
+        if self._backtest is None:
+            self.calculate_backtest_performance()
         return self._backtest
+
+    def get_portfolio_results(self):
+        """ returns a DataSet of name: PortfolioResults, to be passed to Comparis(**results) """
+        if self._backtest is None:
+            self.calculate_backtest_performance()
+        results = DataSet()
+        for name, strategy in self.strategies.items():
+            results[name] = PortfolioResults(strategy, name=str(name))
+        return results
+
+
+class WalkForwardBtStream(object):
+    """
+    streaming walk forward backtest with bounded memory for long intraday histories. Chunks of weights and prices are
+    consumed one after the other and only the state at the last bar is kept, i.e. O(assets) memory. Nav and holdings of
+    each chunk are emitted to a callback and/or written as numbered parquet files to sink_dir
+    """
+
+    def __init__(self, aum, compounding=True, callback=None, sink_dir=None, **kwargs):
+        """
+        :param aum: scalar with initial aum
+        :param compounding: Boolean, if True positions are sized on the current nav, else on the initial aum
+        :param callback: function called with (net_asset_value chunk (pd.Series), holdings chunk (pd.DataFrame))
+        :param sink_dir: directory the chunks are written to as parquet files, see read_stream_sink
+        :param kwargs: optional arguments: max_gross_leverage, max_net_leverage, max_pos_leverage, constant_exposure,
+        constant_long, constant_short, config, dtype
+        """
+        self.aum = aum
+        self.compounding = compounding
+        self.callback = callback
+        self.sink_dir = None if sink_dir is None else Path(sink_dir)
+        if self.sink_dir is not None:
+            self.sink_dir.mkdir(parents=True, exist_ok=True)
+        self.max_gross_leverage = kwargs['max_gross_leverage'] if 'max_gross_leverage' in kwargs else 1
+        self.max_net_leverage = kwargs['max_net_leverage'] if 'max_net_leverage' in kwargs else 1
+        self.max_pos_leverage = kwargs['max_pos_leverage'] if 'max_pos_leverage' in kwargs else 1
+        self.constant_exposure = kwargs['constant_exposure'] if 'constant_exposure' in kwargs else False
+        self.constant_long = kwargs['constant_long'] if 'constant_long' in kwargs else 1
+        self.constant_short = kwargs['constant_short'] if 'constant_short' in kwargs else -1
+        if 'config' in kwargs:
+            self.max_pos_leverage = kwargs['config'].position_limit
+            self.max_net_leverage = kwargs['config'].max_net_leverage
+            self.max_gross_leverage = kwargs['config'].max_gross_leverage
+        self.dtype = np.dtype(kwargs['dtype']) if 'dtype' in kwargs else np.dtype(np.float64)
+
+        self.columns = None
+        self.state = None  # arrays at the last bar, see engine.advance_from_state
+        self.last_date = None
+        self._chunk_number = 0
+        self._is_t0_pending = False  # the nav at t0 is emitted with the first chunk that has new bars
+
+    def _scale_weights(self, weights):
+        if self.constant_exposure is False:
+            scaled_weights = scale_weights(weights.values, self.max_pos_leverage, self.max_gross_leverage,
+                                           self.max_net_leverage)
+        else:
+            scaled_weights = scale_weights(weights.values, constant_exposure=True, constant_long=self.constant_long,
+                                           constant_short=self.constant_short)
+        return pd.DataFrame(scaled_weights, index=weights.index, columns=weights.columns)
+
+    def _emit(self, net_asset_value, holdings):
+        if self.callback is not None:
+            self.callback(net_asset_value, holdings)
+        if self.sink_dir is not None:
+            net_asset_value.to_frame(name='net_asset_value').to_parquet(
+                self.sink_dir.joinpath('net_asset_value_%06d.parquet' % self._chunk_number))
+            holdings.to_parquet(self.sink_dir.joinpath('holdings_%06d.parquet' % self._chunk_number))
+        self._chunk_number += 1
+
+    def _initialize_state(self, scaled_weights, prices, point_value):
+        """
+        the initialization date t0 has nav aum and an empty book, it is the first bar unless that is a trading date.
+        Then t0 is prepended one bar before it, as the backtest does, so the first trade is on the bar after t0
+        """
+        first_date = prices.index[0]
+        self.columns = prices.columns
+        self.last_date = first_date
+        if first_date in scaled_weights.index:
+            frequency = prices.index.freq
+            if frequency is None and len(prices.index) > 2:
+                frequency = pd.infer_freq(prices.index)
+            if frequency is None:
+                raise ValueError("The first bar is a trading date, t0 is prepended at the previous bar, which needs "
+                                 "prices with a frequency")
+            self.last_date = first_date - to_offset(frequency)
+        self.state = {'net_asset_value': self.aum,
+                      'holdings': np.zeros(len(self.columns)),
+                      'last_is_trading_date': False,
+                      'pending_weights': None,
+                      'close': prices.iloc[0].values.astype(np.float64),
+                      'point_value': point_value.iloc[0].values.astype(np.float64)}
+        self._is_t0_pending = True
+
+    def process_chunk(self, weights_chunk, prices_chunk, **kwargs):
+        """
+        advances the backtest over the bars of one chunk and emits their nav and holdings. Holdings of the last bar
+        are emitted with the next chunk, as they need the next open
+        :param weights_chunk: dataframe of trading weights within the chunk (may be empty)
+        :param prices_chunk: dataframe of close prices of the chunk, starting after the last processed bar
+        :param kwargs: optional arguments: open (defaults to previous close), dividends (defaults to 0),
+        point_value (defaults to 1)
+        """
+        if self.columns is not None:
+            prices_chunk = prices_chunk.reindex(columns=self.columns)
+        columns = prices_chunk.columns
+        point_value = kwargs['point_value'] if 'point_value' in kwargs else \
+            pd.DataFrame(index=prices_chunk.index, columns=columns, data=1.)
+        dividends = kwargs['dividends'] if 'dividends' in kwargs else \
+            pd.DataFrame(index=prices_chunk.index, columns=columns, data=0.)
+        scaled_weights = self._scale_weights(weights_chunk.reindex(columns=columns))
+
+        if self.state is None:
+            self._initialize_state(scaled_weights, prices_chunk, point_value)
+        new_dates = prices_chunk.index[prices_chunk.index > self.last_date]
+        if len(new_dates) == 0:
+            return
+        if 'open' in kwargs:
+            open_new = kwargs['open'].reindex(index=new_dates, columns=columns)
+        else:
+            open_new = pd.DataFrame(np.vstack([self.state['close'], prices_chunk.loc[new_dates].values[:-1]]),
+                                    index=new_dates, columns=columns)
+
+        def align(df):
+            return df.reindex(index=new_dates, columns=columns).values.astype(np.float64)
+
+        weights = align(scaled_weights)
+        is_trading_date = np.asarray(new_dates.isin(scaled_weights.index))
+        nav, holdings, pnl = advance_from_state(self.state, weights, align(prices_chunk), align(open_new),
+                                                align(dividends), align(point_value), is_trading_date, self.aum,
+                                                compounding=self.compounding, dtype=self.dtype)
+
+        # nav of the new bars (and of t0 until it is emitted), holdings of the previous last bar and all but the last
+        dates = pd.DatetimeIndex([self.last_date]).append(new_dates)
+        nav_chunk = pd.Series(nav, index=dates)
+        if not self._is_t0_pending:
+            nav_chunk = nav_chunk.iloc[1:]
+        self._is_t0_pending = False
+        holdings_chunk = pd.DataFrame(holdings[:-1], index=dates[:-1], columns=columns)
+        self._emit(nav_chunk, holdings_chunk)
+
+        # only the state at the last bar is kept
+        self.last_date = new_dates[-1]
+        self.state = {'net_asset_value': nav[-1],
+                      'holdings': holdings[-2],
+                      'last_is_trading_date': is_trading_date[-1],
+                      'pending_weights': weights[-1] if is_trading_date[-1] else None,
+                      'close': align(prices_chunk)[-1],
+                      'point_value': align(point_value)[-1]}
+
+    def run(self, chunks):
+        """
+        :param chunks: iterator / generator of (weights_chunk, prices_chunk) tuples
+        :return: state at the last bar
+        """
+        for weights_chunk, prices_chunk in chunks:
+            self.process_chunk(weights_chunk, prices_chunk)
+        self.finalize()
+        return self.state
+
+    def finalize(self):
+        """ emits the holdings row of the last bar, which stays nan as there is no open at t+1 """
+        if self.state is not None:
+            holdings_last = pd.DataFrame(np.nan, index=[self.last_date], columns=self.columns, dtype=self.dtype)
+            self._emit(pd.Series(dtype=np.float64), holdings_last)
+
+
+def read_stream_sink(sink_dir):
+    """
+    :param sink_dir: directory written by WalkForwardBtStream
+    :return: DataSet with net_asset_value (pd.Series) and holdings (pd.DataFrame)
+    """
+    sink_dir = Path(sink_dir)
+    net_asset_value = pd.concat([pd.read_parquet(f) for f in sorted(sink_dir.glob('net_asset_value_*.parquet'))])
+    holdings = pd.concat([pd.read_parquet(f) for f in sorted(sink_dir.glob('holdings_*.parquet'))])
+    results = DataSet()
+    results.net_asset_value = net_asset_value['net_asset_value']
+    results.holdings = holdings
+    return results
@@ -0,0 +1,234 @@
+import numpy as np
+
+
+# ---------------------------------------------------------------------------------
+# array kernels of the walk forward backtest. All inputs are float arrays of shape (T, N) aligned on the backtest
+# date index (row 0 is the initialization date t0) and on the instrument columns. They mirror the label based logic
+# of WalkForwardBtCompounding, but work on integer positions only. The batch functions take an extra leading
+# strategy axis S on weights, pnl and trading dates, prices stay (T, N) and are shared by all strategies
+# ---------------------------------------------------------------------------------
+
+
+def scale_weights(weights, max_pos_leverage=1, max_gross_leverage=1, max_net_leverage=1, constant_exposure=False,
+                  constant_long=1, constant_short=-1):
+    """
+    masked whole-matrix version of WalkForwardBtCompounding._weight_scaling_alternative, every row is a date
+    :param weights: np.array (T, N) of trading signals / weights, nan entries stay nan
+    :param max_pos_leverage: scalar, position limit per instrument
+    :param max_gross_leverage: scalar
+    :param max_net_leverage: scalar, if breached the side with too much leverage is reduced pro rata
+    :param constant_exposure: if True longs are scaled to sum to constant_long and shorts to constant_short
+    :param constant_long: scalar
+    :param constant_short: scalar
+    :return: scaled_weights: np.array (T, N)
+    """
+    x = np.array(weights, dtype=np.float64)
+    is_long = x >= 0
+    is_short = x < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if constant_exposure:
+            long_sum = np.where(is_long, x, 0).sum(axis=1, keepdims=True)
+            short_sum = np.where(is_short, x, 0).sum(axis=1, keepdims=True)
+            return np.where(is_long, x / (long_sum / constant_long),
+                            np.where(is_short, x / (short_sum / constant_short), np.nan))
+
+        # ensure position limits are met
+        x = np.clip(x, -max_pos_leverage, max_pos_leverage)
+        long_sum = np.where(is_long, x, 0).sum(axis=1, keepdims=True)
+        short_sum = np.where(is_short, x, 0).sum(axis=1, keepdims=True)
+        # ensure gross leverage is met
+        gross_leverage = long_sum - short_sum
+        gross_scaling = np.where(gross_leverage > max_gross_leverage, gross_leverage / max_gross_leverage, 1)
+        x = x / gross_scaling
+        long_sum = long_sum / gross_scaling
+        short_sum = short_sum / gross_scaling
+        # ensure net leverage is met, pro rata reduction on the side where the leverage is too high
+        net_leverage = long_sum + short_sum
+        long_too_high = net_leverage > max_net_leverage
+        short_too_high = net_leverage < -max_net_leverage
+        x = np.where(is_long & long_too_high, x / (long_sum / (max_net_leverage - short_sum)), x)
+        x = np.where(is_short & short_too_high, x / (short_sum / -(max_net_leverage + long_sum)), x)
+    return x
+
+
+def calculate_instrument_pnl(close, open_, close_diff, dividends, previous_is_trading_date):
+    """
+    pnl over [t-1, t] per unit of instrument: close_t - open_t if t-1 is a trading date, else close_t - close_t-1
+    :param close: np.array (T, N) of close prices
+    :param open_: np.array (T, N) of open prices
+    :param close_diff: np.array (T, N) of close_t - close_t-1 (diff on the price index)
+    :param dividends: np.array (T, N)
+    :param previous_is_trading_date: boolean np.array (T,) or (S, T), True if t-1 is a trading date
+    :return: pnl: np.array (T, N) or (S, T, N), first date is 0
+    """
+    pnl = np.where(previous_is_trading_date[..., None], close - open_, close_diff) + dividends
+    pnl[..., 0, :] = 0
+    return pnl
+
+
+def calculate_cost_per_unit(open_, point_value, proportional_costs, fee_per_contract=0, slippage=0, volatility=0):
+    """
+    cost of trading one unit (contract) at the open of t: notional * (proportional cost + slippage * vol) + fixed fee
+    :param open_: np.array (T, N) of open prices, trades decided at t-1 are executed at the open of t
+    :param point_value: np.array (T, N)
+    :param proportional_costs: np.array (T, N) of costs as a fraction of the traded notional, nan means no costs
+    :param fee_per_contract: scalar or np.array (N,) of fixed fees per unit traded
+    :param slippage: scalar, slippage as a multiple of volatility
+    :param volatility: scalar or np.array (T, N) of return volatility known at t-1
+    :return: cost_per_unit: np.array (T, N)
+    """
+    rate = np.nan_to_num(proportional_costs) + slippage * np.nan_to_num(volatility)
+    return np.abs(open_) * point_value * rate + fee_per_contract
+
+
+def calculate_transaction_costs(holdings, cost_per_unit, holdings_before=None):
+    """
+    costs of the holdings changes, a change from t-1 to t is executed at the open of t + 1 and booked at t + 1
+    :param holdings: np.array (T, N), nan is treated as no position
+    :param cost_per_unit: np.array (T, N), from calculate_cost_per_unit
+    :param holdings_before: np.array (N,) of holdings before t0, defaults to holdings at t0 (no trade at t0)
+    :return: costs: np.array (T,)
+    """
+    holdings = np.nan_to_num(holdings)
+    holdings_before = holdings[0] if holdings_before is None else np.nan_to_num(holdings_before)
+    trades = np.abs(np.diff(np.vstack([holdings_before, holdings]), axis=0))
+    costs = np.zeros(holdings.shape[0])
+    costs[1:] = np.nansum(trades[:-1] * cost_per_unit[1:], axis=1)
+    return costs
+
+
+def run_nav_and_holdings_recursion(weights, open_, point_value, pnl, dividends, is_trading_date, aum,
+                                   compounding=True, holdings_initial=None, nav_initial=None, dtype=np.float64,
+                                   cost_per_unit=None, holdings_before=None):
+    """
+    walks forward through the backtest dates: nav_t = nav_t-1 + sum(holdings_t-1 * point_value_t * (pnl_t + div_t)),
+    holdings are re-set on trading dates at the open of t+1 and carried forward otherwise
+    :param weights: np.array (T, N) of scaled weights, only rows of trading dates are used
+    :param open_: np.array (T, N) of open prices, open at t+1 is used to size positions at t
+    :param point_value: np.array (T, N)
+    :param pnl: np.array (T, N), from calculate_instrument_pnl
+    :param dividends: np.array (T, N)
+    :param is_trading_date: boolean np.array (T,)
+    :param aum: scalar, initial aum, positions are sized on it if not compounding
+    :param compounding: if True positions are sized on the current nav, else on the initial aum
+    :param holdings_initial: np.array (N,) of holdings at t0, defaults to 0
+    :param nav_initial: scalar nav at t0, defaults to aum
+    :param dtype: dtype of the holdings buffer, the nav is always float64
+    :param cost_per_unit: np.array (T, N) of trading costs per unit, None for no costs
+    :param holdings_before: np.array (N,) of holdings before t0, the change to holdings_initial is charged at t1
+    :return: nav: np.array (T,), holdings: np.array (T, N), last row is nan as there is no open at t+1
+    """
+    if holdings_initial is not None:
+        holdings_initial = holdings_initial[None]
+    if holdings_before is not None:
+        holdings_before = holdings_before[None]
+    nav, holdings = run_batch_nav_and_holdings_recursion(weights[None], open_, point_value, pnl[None], dividends,
+                                                         is_trading_date[None], aum, compounding=compounding,
+                                                         holdings_initial=holdings_initial, nav_initial=nav_initial,
+                                                         dtype=dtype, cost_per_unit=cost_per_unit,
+                                                         holdings_before=holdings_before)
+    return nav[0], holdings[0]
+
+
+def run_batch_nav_and_holdings_recursion(weights, open_, point_value, pnl, dividends, is_trading_date, aum,
+                                         compounding=True, holdings_initial=None, nav_initial=None, dtype=np.float64,
+                                         cost_per_unit=None, holdings_before=None):
+    """
+    batch version of run_nav_and_holdings_recursion, all strategies advance together date by date
+    :param weights: np.array (S, T, N)
+    :param open_: np.array (T, N)
+    :param point_value: np.array (T, N)
+    :param pnl: np.array (S, T, N)
+    :param dividends: np.array (T, N)
+    :param is_trading_date: boolean np.array (S, T)
+    :param aum: scalar or np.array (S,)
+    :param compounding: Boolean
+    :param holdings_initial: np.array (S, N), defaults to 0
+    :param nav_initial: scalar or np.array (S,), defaults to aum
+    :param dtype: dtype of the holdings buffer
+    :param cost_per_unit: np.array (T, N) of trading costs per unit, None for no costs
+    :param holdings_before: np.array (S, N) of holdings before t0, defaults to holdings at t0
+    :return: nav: np.array (S, T), holdings: np.array (S, T, N)
+    """
+    n_strategies, n_dates, n_assets = weights.shape
+    aum = np.broadcast_to(np.asarray(aum, dtype=np.float64), (n_strategies,))
+    nav = np.empty((n_strategies, n_dates))
+    holdings = np.full((n_strategies, n_dates, n_assets), np.nan, dtype=dtype)
+    nav[:, 0] = aum if nav_initial is None else nav_initial
+    holdings[:, 0] = 0 if holdings_initial is None else holdings_initial
+    # contribution per unit held, the dividends are added on top of the instrument pnl as in the loop engine
+    unit_pnl = point_value * (pnl + dividends)
+    # sizing at t uses the open at t+1
+    sizing = np.full((n_dates, n_assets), np.nan)
+    sizing[:-1] = open_[1:] * point_value[:-1]
+    weights_are_zero = np.nansum(weights, axis=2) == 0
+    charge_costs = cost_per_unit is not None
+    if charge_costs:
+        holdings_traded = np.nan_to_num(holdings[:, 0] if holdings_before is None else holdings_before)
+
+    for i in range(1, n_dates):
+        nav[:, i] = nav[:, i - 1] + np.nansum(holdings[:, i - 1] * unit_pnl[:, i], axis=1)
+        if charge_costs:
+            # holdings set at t-1 are traded at the open of t
+            holdings_now = np.nan_to_num(holdings[:, i - 1])
+            nav[:, i] -= np.nansum(np.abs(holdings_now - holdings_traded) * cost_per_unit[i], axis=1)
+            holdings_traded = holdings_now
+        # don't update holdings at last date as we have no open t+1 price
+        if i == n_dates - 1:
+            break
+        base = nav[:, i] if compounding else aum
+        holdings_new = weights[:, i] * base[:, None] / sizing[i]
+        # a flat book is held as nan, as the loop engine does on dates whose weights sum to 0
+        holdings_new[weights_are_zero[:, i]] = np.nan
+        holdings[:, i] = np.where(is_trading_date[:, i, None], holdings_new, holdings[:, i - 1])
+    return nav, holdings
+
+
+def advance_from_state(state, weights, close, open_, dividends, point_value, is_trading_date, aum, compounding=True,
+                       dtype=np.float64, cost_per_unit=None):
+    """
+    continues the recursion from the state at the last bar over K new bars
+    :param state: dict of arrays at the last bar: net_asset_value (scalar), holdings (N,) held over the last bar,
+    last_is_trading_date (Boolean), pending_weights (N,) traded at the next open (None if not a trading date),
+    close (N,), point_value (N,)
+    :param weights: np.array (K, N) of scaled weights on the new bars
+    :param close: np.array (K, N)
+    :param open_: np.array (K, N)
+    :param dividends: np.array (K, N)
+    :param point_value: np.array (K, N)
+    :param is_trading_date: boolean np.array (K,)
+    :param aum: scalar, initial aum
+    :param compounding: Boolean
+    :param dtype: dtype of the holdings buffer
+    :param cost_per_unit: np.array (K, N) of trading costs per unit on the new bars, None for no costs
+    :return: nav: np.array (K + 1,), holdings: np.array (K + 1, N), pnl: np.array (K + 1, N), row 0 is the last bar
+    with its holdings set from the pending weights and the new open
+    """
+    n_assets = close.shape[1]
+    close = np.vstack([state['close'], close])
+    open_ = np.vstack([np.full(n_assets, np.nan), open_])
+    dividends = np.vstack([np.zeros(n_assets), dividends])
+    point_value = np.vstack([state['point_value'], point_value])
+    weights = np.vstack([np.full(n_assets, np.nan), weights])
+    is_trading_date = np.append(False, is_trading_date)
+    previous_is_trading_date = np.roll(is_trading_date, 1)
+    if len(is_trading_date) > 1:
+        previous_is_trading_date[1] = state['last_is_trading_date']
+    close_diff = np.vstack([np.full((1, n_assets), np.nan), np.diff(close, axis=0)])
+    pnl = calculate_instrument_pnl(close, open_, close_diff, dividends, previous_is_trading_date)
+
+    # holdings at the last bar can only be set now that the next open is known
+    holdings_last = state['holdings']
+    if state['last_is_trading_date']:
+        if np.nansum(state['pending_weights']) == 0:
+            holdings_last = np.full(n_assets, np.nan)
+        else:
+            base = state['net_asset_value'] if compounding else aum
+            holdings_last = state['pending_weights'] * base / (open_[1] * point_value[0])
+    if cost_per_unit is not None:
+        cost_per_unit = np.vstack([np.zeros(n_assets), cost_per_unit])
+    nav, holdings = run_nav_and_holdings_recursion(weights, open_, point_value, pnl, dividends, is_trading_date, aum,
+                                                   compounding=compounding, holdings_initial=holdings_last,
+                                                   nav_initial=state['net_asset_value'], dtype=dtype,
+                                                   cost_per_unit=cost_per_unit, holdings_before=state['holdings'])
+    return nav, holdings, pnl
@@ -0,0 +1,188 @@
+import itertools
+import json
+import multiprocessing as mp
+import os
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from backtesting.WalkForwardBacktest import WalkForwardBtNoCompounding
+from backtesting.portfolio_analysis import PortfolioResults
+from signals.momentum.time_series_momentum import exp_ma_crossover
+from utils.parallel_computing import share_pandas_obj, attach_shared_pandas_obj, release_shared_array, \
+    report_progress
+from utils.splines import spline_series, cta_spline, grd_spline
+
+
+splines = {'cta_spline': cta_spline, 'grd_spline': grd_spline}
+
+# price panel of a worker process, attached once to the shared memory block of the sweep
+_worker_prices = None
+_worker_shm = None
+
+
+# ---------------------------------
+# parameter grid and signals
+# ---------------------------------
+
+
+def build_parameter_grid(fast, slow, window, vol_floor=(0,), spline=(None,), signal_scaling=(1,)):
+    """
+    cartesian product of the exp_ma_crossover parameters, combinations with fast >= slow are dropped
+    :param fast: list of fast lookbacks
+    :param slow: list of slow lookbacks
+    :param window: list of vol windows
+    :param vol_floor: list of vol floors
+    :param spline: list of spline names (keys of splines) or None for the raw signal
+    :param signal_scaling: list of scalars the (splined) signal is multiplied with
+    :return: grid: list of parameter dicts
+    """
+    names = ['fast', 'slow', 'window', 'vol_floor', 'spline', 'signal_scaling']
+    grid = []
+    for values in itertools.product(fast, slow, window, vol_floor, spline, signal_scaling):
+        params = dict(zip(names, values))
+        if params['fast'] < params['slow']:
+            grid.append(params)
+    return grid
+
+
+def get_parameter_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def calculate_ma_crossover_weights(prices, fast, slow, window, vol_floor=0, spline=None, signal_scaling=1):
+    """ exp_ma_crossover signal per instrument, optionally splined, as used in crypto_cta_script """
+    weights = pd.DataFrame(index=prices.index)
+    for instrument in prices:
+        signal = exp_ma_crossover(prices[instrument], fast, slow, window, vol_floor=vol_floor)
+        if spline is not None:
+            signal = spline_series(signal, splines[spline])
+        weights[instrument] = signal
+    return weights * signal_scaling
+
+
+# ---------------------------------
+# sweep jobs
+# ---------------------------------
+
+
+def _initialize_worker(prices_spec):
+    global _worker_prices, _worker_shm
+    _worker_shm, _worker_prices = attach_shared_pandas_obj(prices_spec)
+
+
+def run_sweep_job(params, aum, bt_kwargs, prices=None):
+    """
+    computes signals, runs the backtest and the results overview for one parameter set
+    :param params: parameter dict from build_parameter_grid
+    :param aum: scalar
+    :param bt_kwargs: dict of optional backtest arguments (e.g. crypto_cta_config)
+    :param prices: price panel, defaults to the panel shared with the worker process
+    :return: row: dict with parameter_key, the parameters and the results overview metrics
+    """
+    if prices is None:
+        prices = _worker_prices
+    weights = calculate_ma_crossover_weights(prices, **params)
+    bt = WalkForwardBtNoCompounding(weights, prices, aum, engine='array', **bt_kwargs)
+    bt.calculate_backtest_performance()
+    key = get_parameter_key(params)
+    overview = PortfolioResults(bt, name=key).calculate_results_overview()
+    row = {'parameter_key': key}
+    row.update(params)
+    row.update(overview.to_dict())
+    return row
+
+
+def _expand_sweep_job(args):
+    return run_sweep_job(*args)
+
+
+# ---------------------------------
+# results file
+# ---------------------------------
+
+
+def _is_parameter_key(key):
+    try:
+        return isinstance(json.loads(key), dict)
+    except (TypeError, ValueError):
+        return False
+
+
+def load_completed_results(results_path):
+    """
+    rows of a results file, a partial last row (left by a crash during a write) is cut from the file and rows that
+    fail to parse are dropped, so their parameter sets are run again
+    :param results_path: Path of the csv file
+    :return: completed: pd.DataFrame
+    """
+    with open(results_path, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end < len(content):
+            f.truncate(end)
+    if end == 0:
+        return pd.DataFrame()
+    completed = pd.read_csv(results_path, on_bad_lines='skip', engine='python')
+    if 'parameter_key' not in completed:
+        return pd.DataFrame()
+    return completed[completed['parameter_key'].map(_is_parameter_key)].reset_index(drop=True)
+
+
+def append_result_row(results_path, row):
+    """ appends one row to the results file and syncs it to disk, a crash can only leave a partial last row """
+    is_empty = not results_path.exists() or results_path.stat().st_size == 0
+    with open(results_path, 'a', newline='') as f:
+        pd.DataFrame([row]).to_csv(f, header=is_empty, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_parameter_sweep(prices, parameter_grid, aum=100, num_threads=8, results_path=None, **bt_kwargs):
+    """
+    runs the backtests of a parameter grid across a process pool, the price panel is placed once in shared memory.
+    Each finished parameter set is appended to results_path and synced to disk, on a rerun parameter sets already in
+    it are skipped (rows cut short by a crash are dropped and rerun)
+    :param prices: pd.DataFrame of prices with a well defined frequency
+    :param parameter_grid: list of parameter dicts, see build_parameter_grid
+    :param aum: scalar
+    :param num_threads: number of worker processes, 1 runs in process
+    :param results_path: csv file results are streamed into (and resumed from), None keeps results in memory only
+    :param bt_kwargs: optional backtest arguments
+    :return: results: pd.DataFrame, one row per parameter set
+    """
+    completed = pd.DataFrame()
+    if results_path is not None:
+        results_path = Path(results_path)
+        if results_path.exists():
+            completed = load_completed_results(results_path)
+    completed_keys = set(completed['parameter_key']) if 'parameter_key' in completed else set()
+    jobs = [(params, aum, dict(bt_kwargs)) for params in parameter_grid
+            if get_parameter_key(params) not in completed_keys]
+
+    rows = []
+    if len(jobs) > 0:
+        shm, prices_spec = share_pandas_obj(prices)
+        try:
+            if num_threads == 1:
+                _initialize_worker(prices_spec)
+                outputs = map(_expand_sweep_job, jobs)
+                pool = None
+            else:
+                pool = mp.Pool(processes=num_threads, initializer=_initialize_worker, initargs=(prices_spec,))
+                outputs = pool.imap_unordered(_expand_sweep_job, jobs)
+            time0 = time.time()
+            for i, row in enumerate(outputs, 1):
+                rows.append(row)
+                if results_path is not None:
+                    append_result_row(results_path, row)
+                report_progress(i, len(jobs), time0, 'parameter_sweep')
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            release_shared_array(shm)
+
+    results = pd.concat([completed, pd.DataFrame(rows)], ignore_index=True)
+    return results
@@ -0,0 +1,170 @@
+import argparse
+import datetime as dt
+import json
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from backtesting.WalkForwardBacktest import WalkForwardBtNoCompounding
+from backtesting.engine import scale_weights
+from benchmarks.synthetic_markets import generate_gbm_prices, generate_signals
+from classes.portfolio_construction.ERC import RiskParity
+from classes.portfolio_construction.HRP import HRP
+from risk_metrics.cleaning_routines import calculate_cleaned_cov_mat
+from signals.machine_learning.labelling import get_barrier_touch_dates, get_bins_sign, get_daily_vol, \
+    set_vertical_barrier
+from signals.machine_learning.sampling_routines import calculate_sampling_weights_from_avg_label_uniqueness
+
+history_path = Path(__file__).parent.joinpath('benchmark_history.json')
+
+
+# ---------------------------------
+# hot paths, each takes a price panel and the benchmark config
+# ---------------------------------
+
+
+def bench_weight_scaling(prices, config):
+    scale_weights(generate_signals(prices).values, 1, 1, 1)
+
+
+def bench_backtest_loop(prices, config):
+    WalkForwardBtNoCompounding(generate_signals(prices), prices, aum=100, engine='loop').calculate_backtest_performance()
+
+
+def bench_backtest_array(prices, config):
+    WalkForwardBtNoCompounding(generate_signals(prices), prices, aum=100,
+                               engine='array').calculate_backtest_performance()
+
+
+def bench_hrp_through_time(prices, config):
+    returns = np.log(prices).diff(1).iloc[1:]
+    HRP(prices, window_length=config.window, future_returns=returns).hrp_calculation_through_time_in_parallel()
+
+
+def bench_erc_rolling(prices, config):
+    RiskParity(prices, window=config.window).calculate_rolling_erc_allocation()
+
+
+def bench_cleaned_covariance(prices, config):
+    returns = np.log(prices).diff(1).iloc[1:]
+    calculate_cleaned_cov_mat(returns)
+
+
+def get_triple_barrier_dates(prices, num_threads, span=100, vb_days=10):
+    """ barrier touch dates of the events at the dates with a target vol (the first bars have none) """
+    trgt = get_daily_vol(prices, span).dropna()
+    vertical_barrier = set_vertical_barrier(dates=prices.index, days=vb_days)
+    return get_barrier_touch_dates(prices=prices, dates=trgt.index, pt_sl=[1, 1], trgt=trgt, min_ret=0,
+                                   num_threads=num_threads, vertical_barrier=vertical_barrier.reindex(trgt.index))
+
+
+def bench_triple_barrier_labelling(prices, config):
+    barrier_dates = get_triple_barrier_dates(prices.iloc[:, 0], config.num_threads)
+    get_bins_sign(barrier_dates, prices.iloc[:, 0])
+
+
+def bench_concurrency_weights(prices, config):
+    barrier_dates = get_triple_barrier_dates(prices.iloc[:, 0], config.num_threads)
+    calculate_sampling_weights_from_avg_label_uniqueness(barrier_dates, prices.iloc[:, 0])
+
+
+benchmarks = {'weight_scaling': bench_weight_scaling,
+              'backtest_loop': bench_backtest_loop,
+              'backtest_array': bench_backtest_array,
+              'hrp_through_time': bench_hrp_through_time,
+              'erc_rolling': bench_erc_rolling,
+              'cleaned_covariance': bench_cleaned_covariance,
+              'triple_barrier_labelling': bench_triple_barrier_labelling,
+              'concurrency_weights': bench_concurrency_weights}
+
+
+# ---------------------------------
+# timing and history
+# ---------------------------------
+
+
+def time_benchmark(func, prices, config):
+    """
+    runs a benchmark config.repeat times, peak memory is traced on the last run (allocations of the main process)
+    :return: dict with seconds (best run), throughput in bars * assets / s and peak_memory_mb
+    """
+    timings = []
+    for _ in range(config.repeat):
+        time0 = time.perf_counter()
+        func(prices, config)
+        timings.append(time.perf_counter() - time0)
+    tracemalloc.start()
+    func(prices, config)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = min(timings)
+    return {'seconds': seconds, 'throughput': prices.size / seconds, 'peak_memory_mb': peak_memory / 1024 ** 2}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def load_history(path=history_path):
+    if Path(path).exists():
+        with open(path) as f:
+            return json.load(f)
+    return []
+
+
+def run_benchmarks(config, names=None):
+    """
+    :param config: argparse namespace with assets, bars, frequency, window, repeat, num_threads
+    :param names: list of benchmark names, defaults to all
+    :return: run: dict with timestamp, commit, config and a result per benchmark
+    """
+    names = list(benchmarks) if names is None else names
+    prices = generate_gbm_prices(config.assets, config.bars, frequency=config.frequency, seed=config.seed)
+    run = {'timestamp': str(dt.datetime.now()), 'commit': get_git_commit(),
+           'config': {'assets': config.assets, 'bars': config.bars, 'frequency': config.frequency,
+                      'window': config.window}, 'results': {}}
+    for name in names:
+        run['results'][name] = time_benchmark(benchmarks[name], prices, config)
+    return run
+
+
+def print_comparison(run, previous_run):
+    """ prints each benchmark with its change in runtime against the previous run of the same config """
+    for name, result in run['results'].items():
+        line = '{:<26} {:>10.4f}s {:>14.0f} bars*assets/s {:>9.1f} MB'.format(
+            name, result['seconds'], result['throughput'], result['peak_memory_mb'])
+        if previous_run is not None and name in previous_run['results']:
+            ratio = result['seconds'] / previous_run['results'][name]['seconds']
+            line += '   {:.2f}x of {}'.format(ratio, previous_run['commit'])
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time the hot paths on synthetic gbm prices')
+    parser.add_argument('--assets', type=int, default=20)
+    parser.add_argument('--bars', type=int, default=1000)
+    parser.add_argument('--frequency', default='B', choices=['B', 'D', 'H', 'min'])
+    parser.add_argument('--window', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', choices=list(benchmarks), default=None)
+    parser.add_argument('--history', default=str(history_path))
+    parser.add_argument('--no_save', action='store_true')
+    args = parser.parse_args()
+
+    history = load_history(args.history)
+    benchmark_run = run_benchmarks(args, args.only)
+    previous = [r for r in history if r['config'] == benchmark_run['config']]
+    print_comparison(benchmark_run, previous[-1] if len(previous) > 0 else None)
+    if not args.no_save:
+        history.append(benchmark_run)
+        with open(args.history, 'w') as f:
+            json.dump(history, f, indent=2)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from utils.resampling_and_risk_metrics import calculate_annualization_factor
+
+
+def generate_gbm_prices(n_assets, n_bars, frequency='B', mu=0.05, sigma=0.2, correlation=0.3, start='2000-01-03',
+                        staggered_start=False, seed=0):
+    """
+    generates a panel of geometric brownian motion prices with a common factor
+    :param n_assets: number of instruments
+    :param n_bars: number of bars
+    :param frequency: 'B', 'D', 'H' or 'min'
+    :param mu: scalar annualized drift
+    :param sigma: scalar or np.array (n_assets,) of annualized vols
+    :param correlation: scalar pairwise correlation of returns, via one common factor
+    :param start: first date
+    :param staggered_start: if True instruments are listed at random dates within the first half of the history
+    (prices are nan before), as for an expanding universe
+    :param seed: random seed
+    :return: prices: pd.DataFrame with a well defined frequency
+    """
+    rng = np.random.default_rng(seed)
+    dt = 1. / calculate_annualization_factor(frequency)
+    sigma = np.broadcast_to(sigma, (n_assets,))
+    common = rng.standard_normal((n_bars, 1))
+    idiosyncratic = rng.standard_normal((n_bars, n_assets))
+    shocks = np.sqrt(correlation) * common + np.sqrt(1 - correlation) * idiosyncratic
+    log_returns = (mu - 0.5 * sigma ** 2) * dt + sigma * np.sqrt(dt) * shocks
+    prices = 100 * np.exp(np.cumsum(log_returns, axis=0))
+    if staggered_start:
+        first_bars = rng.integers(0, n_bars // 2, size=n_assets)
+        first_bars[:2] = 0  # at least two instruments from the start
+        prices[np.arange(n_bars)[:, None] < first_bars[None, :]] = np.nan
+    # pandas only takes the lower case hourly alias
+    index = pd.date_range(start=start, periods=n_bars, freq='h' if frequency == 'H' else frequency)
+    columns = ['asset_%d' % i for i in range(n_assets)]
+    return pd.DataFrame(prices, index=index, columns=columns)
+
+
+def generate_signals(prices, seed=0):
+    """ random, autocorrelated trading signals aligned with prices, to feed the backtester """
+    rng = np.random.default_rng(seed)
+    noise = pd.DataFrame(rng.standard_normal(prices.shape), index=prices.index, columns=prices.columns)
+    signals = noise.ewm(span=20).mean() * 2
+    return signals.where(prices.notna())
@@ -1,8 +1,138 @@
+import copy
+
 import numpy as np
 import pandas as pd
 from scipy import optimize
-from risk_metrics.cleaning_routines import calculate_cleaned_cov_mat
-from utils.universe_helpers import find_universe_tickers
+from risk_metrics.cleaning_routines import calculate_cleaned_cov_mat, calculate_normed_correlation, \
+    clean_correlation_matrices
+from risk_metrics.rolling_moments import iterate_rolling_moments
+from utils.parallel_computing import mp_pandas_obj
+from utils.rebalance_calendar import get_rebalance_dates, forward_fill_weights
+from utils.universe_helpers import UniverseMembership
+
+
+# ---------------------------------
+# equal risk contribution solver. The weights with risk contributions w_i (cov w)_i / (w' cov w) equal to the
+# budgets b_i are y / sum(y) for the minimum y of the convex log-barrier problem 0.5 y' cov y - sum(b_i log(y_i)),
+# whose first order condition is y_i (cov y)_i = b_i
+# ---------------------------------
+
+
+def calculate_risk_contributions(weights, cov_mat):
+    """ :return: np.array of the relative risk contributions w_i (cov w)_i / (w' cov w), they sum to one """
+    weights = np.asarray(weights, dtype=np.float64)
+    risk_contributions = weights * np.asarray(cov_mat, dtype=np.float64).dot(weights)
+    return risk_contributions / risk_contributions.sum()
+
+
+def _solve_log_barrier_newton(cov_mat, budgets, y, tol, max_iter):
+    """ damped newton steps on the log-barrier problem, :return: y or None if the hessian is not positive definite """
+    def objective(y_):
+        return 0.5 * y_.dot(cov_mat).dot(y_) - budgets.dot(np.log(y_))
+
+    value = objective(y)
+    for _ in range(max_iter):
+        gradient = cov_mat.dot(y) - budgets / y
+        hessian = cov_mat + np.diag(budgets / y ** 2)
+        try:
+            step = np.linalg.solve(hessian, gradient)
+        except np.linalg.LinAlgError:
+            return None
+        if np.max(np.abs(y * gradient)) < tol:
+            return y
+        decrement = gradient.dot(step)
+        if not decrement > 0:
+            # not a descent direction, cov_mat is not positive semi-definite
+            return None
+        # stay inside y > 0, then backtrack until the decrease is sufficient
+        is_decreasing = step > 0
+        t = min(1., 0.99 * np.min(y[is_decreasing] / step[is_decreasing])) if is_decreasing.any() else 1.
+        while objective(y - t * step) > value - 0.25 * t * decrement:
+            t /= 2
+            if t < 1e-8:
+                # no further decrease at machine precision
+                return y
+        y = y - t * step
+        value = objective(y)
+    return y
+
+
+def _solve_cyclical_coordinate_descent(cov_mat, budgets, y, tol, max_iter):
+    """ cyclical coordinate descent on the log-barrier problem, each coordinate is the root of a quadratic """
+    variances = np.diag(cov_mat)
+    for _ in range(max_iter):
+        for i in range(len(y)):
+            cov_y_i = cov_mat[i].dot(y) - variances[i] * y[i]
+            y[i] = (-cov_y_i + np.sqrt(cov_y_i ** 2 + 4 * variances[i] * budgets[i])) / (2 * variances[i])
+        if np.max(np.abs(y * cov_mat.dot(y) - budgets)) < tol:
+            break
+    return y
+
+
+def _solve_bounded_risk_budgeting(cov_mat, budgets, x0, lower_bound, upper_bound):
+    """ risk contributions closest to the budgets within bounds, SLSQP with analytic gradients """
+    n_assets = len(budgets)
+
+    def rb_function(wgts):
+        cov_wgts = cov_mat.dot(wgts)
+        total_risk = wgts.dot(cov_wgts)
+        deviations = wgts * cov_wgts / total_risk - budgets
+        return np.sum(deviations ** 2)
+
+    def rb_gradient(wgts):
+        cov_wgts = cov_mat.dot(wgts)
+        total_risk = wgts.dot(cov_wgts)
+        risk_contributions = wgts * cov_wgts
+        deviations = risk_contributions / total_risk - budgets
+        return 2 * (deviations * cov_wgts / total_risk + cov_mat.dot(deviations * wgts) / total_risk
+                    - 2 * cov_wgts * deviations.dot(risk_contributions) / total_risk ** 2)
+
+    cons = ({'type': 'eq', 'fun': lambda wgts: np.sum(wgts) - 1, 'jac': lambda wgts: np.ones(n_assets)})
+    res = optimize.minimize(rb_function, x0, jac=rb_gradient, method='SLSQP',
+                            bounds=optimize.Bounds(lower_bound, upper_bound),
+                            constraints=cons, options={'disp': False, 'maxiter': 1000, 'ftol': 1e-12})
+    return np.clip(res.x, lower_bound, upper_bound)
+
+
+def solve_erc(cov_mat, risk_budgets=None, x0=None, lower_bound=None, upper_bound=None, tol=1e-10, max_iter=100):
+    """
+    equal risk contribution (or risk budgeting) weights, fully invested and long only
+    :param cov_mat: covariance matrix (N, N), assets without a positive variance get a weight of 0
+    :param risk_budgets: np.array (N,) of target risk contributions, normalized to sum to one, defaults to 1 / N,
+    assets with a budget of 0 get a weight of 0
+    :param x0: weights to warm start from, e.g. the solution of the previous date
+    :param lower_bound: lower bound on the weights, scalar or np.array (N,), None for no bound
+    :param upper_bound: upper bound on the weights, scalar or np.array (N,), None for no bound
+    :param tol: maximum deviation of y_i (cov y)_i from the budgets at which the log-barrier problem counts as solved
+    :param max_iter: maximum number of newton steps or coordinate descent sweeps
+    :return: np.array (N,) of weights summing to one
+    """
+    cov_mat = np.nan_to_num(np.asarray(cov_mat, dtype=np.float64))
+    n_assets = cov_mat.shape[0]
+    weights = np.zeros(n_assets)
+    budgets = np.ones(n_assets) if risk_budgets is None else np.asarray(risk_budgets, dtype=np.float64)
+    is_valid = (np.diag(cov_mat) > 0) & (budgets > 0)
+    if not is_valid.any():
+        return weights
+    cov_mat = cov_mat[np.ix_(is_valid, is_valid)]
+    budgets = budgets[is_valid] / budgets[is_valid].sum()
+
+    # warm start, y is the scaled x0 which minimizes the log-barrier objective along x0
+    y = budgets.copy() if x0 is None else np.asarray(x0, dtype=np.float64)[is_valid]
+    y = np.where(y > 0, y, 1. / len(y))
+    y = y * np.sqrt(budgets.sum() / y.dot(cov_mat).dot(y))
+
+    solution = _solve_log_barrier_newton(cov_mat, budgets, y, tol, max_iter)
+    if solution is None:
+        solution = _solve_cyclical_coordinate_descent(cov_mat, budgets, y, tol, max_iter)
+    weights[is_valid] = solution / solution.sum()
+
+    lower_bound = np.broadcast_to(-np.inf if lower_bound is None else lower_bound, (n_assets,))
+    upper_bound = np.broadcast_to(np.inf if upper_bound is None else upper_bound, (n_assets,))
+    if (weights < lower_bound).any() or (weights > upper_bound).any():
+        weights[is_valid] = _solve_bounded_risk_budgeting(cov_mat, budgets, weights[is_valid],
+                                                          lower_bound[is_valid], upper_bound[is_valid])
+    return weights
 
 
 class RiskParity:
@@ -18,6 +148,40 @@ class RiskParity:
             self.returns = kwargs['futures_returns']
         else:
             self.returns = self.calculate_returns(self.prices)
+        if 'risk_budgets' in kwargs:
+            # target risk contribution per market (pd.Series by market or array ordered as the columns)
+            risk_budgets = kwargs['risk_budgets']
+            if not isinstance(risk_budgets, pd.Series):
+                risk_budgets = pd.Series(np.asarray(risk_budgets, dtype=np.float64), index=self.returns.columns)
+            self.risk_budgets = risk_budgets
+        # dtype of the allocation buffer, np.float32 halves its memory
+        if 'dtype' in kwargs:
+            self.dtype = np.dtype(kwargs['dtype'])
+        else:
+            self.dtype = np.dtype(np.float64)
+        if 'cache' in kwargs:
+            self.cache = kwargs['cache']  # utils.result_cache.ResultCache, weights are loaded from it if cached
+        else:
+            self.cache = None
+        if 'rolling_moments' in kwargs:
+            # window correlations are updated date by date instead of recomputed (risk_metrics.rolling_moments)
+            self.rolling_moments = kwargs['rolling_moments']
+        else:
+            self.rolling_moments = False
+        if 'cleaning_chunk_size' in kwargs:
+            self.cleaning_chunk_size = kwargs['cleaning_chunk_size']  # windows whose correlations are cleaned at once
+        else:
+            self.cleaning_chunk_size = 64
+        if 'rebalance' in kwargs:
+            # 'daily', 'weekly', 'month_end' or a pd.DatetimeIndex, weights are held between rebalance dates
+            self.rebalance = kwargs['rebalance']
+        else:
+            self.rebalance = 'daily'
+        if 'universe' in kwargs:
+            # utils.universe_helpers.UniverseMembership, e.g. shared with other constructors and the backtester
+            self.universe = kwargs['universe']
+        else:
+            self.universe = UniverseMembership.from_prices(self.returns)
 
     @staticmethod
     def calculate_returns(prices, how='log'):
@@ -29,78 +193,127 @@ class RiskParity:
         return returns
 
     @staticmethod
-    def calculate_covariance(returns):
-        clean_cov = calculate_cleaned_cov_mat(returns)
+    def calculate_covariance(returns, clean_correlation=None):
+        clean_cov = calculate_cleaned_cov_mat(returns, clean_correlation=clean_correlation)
 
         return clean_cov
 
-    def _calculate_risk_allocation(self, date, active_markets):
-
-        # get window length and raw prices
-        window = self.window_length
+    def _copy_for_jobs(self):
+        """
+        shallow copy without the price, return and weight frames. Its bound methods are shipped to the workers, the
+        returns are passed as a job arg instead, so they are shared rather than pickled into every job
+        """
+        job_copy = copy.copy(self)
+        for name in ['prices', 'returns', 'allocation', 'universe', 'cache']:
+            setattr(job_copy, name, None)
+        return job_copy
 
-        # prepare price window, cut for active markets and dates in date window
-        current_date_loc = self.returns.index.get_loc(date)
-        first_date = self.returns.index[current_date_loc - window] # window + 1 observiations
+    def _get_returns_window(self, returns, date):
+        # window + 1 observations up to date
+        current_date_loc = returns.index.get_loc(date)
+        return returns.iloc[current_date_loc - self.window_length: current_date_loc + 1]
 
+    def _iterate_clean_correlations(self, returns, dates):
+        """
+        eigen-cleaned correlations of the windows ending on dates, cleaned in stacks of cleaning_chunk_size windows
+        :param returns:
+        :param dates: increasing return dates
+        :return: generator of np.array (N, N)
+        """
+        if self.rolling_moments:
+            # windows hold window + 1 returns, the moments are rolled over all dates between the first and last date.
+            # As calculate_normed_correlation markets with a nan in the window are left out (zeroed by the cleaning)
+            end_positions = returns.index.get_indexer(dates)
+            moments = iterate_rolling_moments(returns.values, self.window_length + 1, start=end_positions[0],
+                                              end=end_positions[-1], complete_only=True)
+        correlations = []
+        for row, date in enumerate(dates):
+            if self.rolling_moments:
+                t = -1
+                while t < end_positions[row]:
+                    t, _, correlation = next(moments)
+            else:
+                correlation = calculate_normed_correlation(self._get_returns_window(returns, date))
+            correlations.append(correlation)
+            if len(correlations) == self.cleaning_chunk_size or row == len(dates) - 1:
+                for clean_correlation in clean_correlation_matrices(np.stack(correlations), self.window_length + 1):
+                    yield clean_correlation
+                correlations = []
 
-        # calculate returns from window
-        returns = self.returns.loc[first_date:date]
-        n_assets = returns.shape[1]
+    def _calculate_risk_allocation(self, returns, date, active_markets, clean_correlation=None, x0=None):
+        """
+        :param returns:
+        :param date:
+        :param active_markets: markets in the universe at date
+        :param clean_correlation: cleaned correlation of the window of all markets, e.g. from
+        _iterate_clean_correlations
+        :param x0: weights of the active markets to warm start the solver from
+        :return: np.array of the erc weights of the active markets
+        """
+        # window + 1 observations
+        return_window = self._get_returns_window(returns, date)
 
         # calculate covariance
-        cov_mat = self.calculate_covariance(returns)  # pca_cleaning
+        cov_mat = self.calculate_covariance(return_window, clean_correlation)  # pca_cleaning
+        positions = cov_mat.columns.get_indexer(active_markets)
+        cov_mat = cov_mat.values[np.ix_(positions, positions)]
 
         # Ignore correlations < 0
         cov_mat[cov_mat < 0] = 0
-        budget = np.array(np.ones((n_assets, 1)) * 1 / n_assets)  # numpy matrix nAssets x 1
-
-        wgts = np.ones((n_assets, 1)) * 1 / n_assets
-        cons = ({'type': 'eq', 'fun': lambda wgts: sum(wgts) - 1})
-
-        def rb_function(wgts, cov_mat, budget, n_assets):
-            cov_mat = np.array(cov_mat)
-            wgts = wgts.reshape(n_assets, 1)
-            RC = cov_mat.dot(wgts)  # vector of risk contributions: np.array nAssets x 1
-            TR = wgts.T.dot(cov_mat).dot(wgts)  # 1x1 np.array
-
-            value_vector = np.power(np.multiply(wgts, RC) / TR - budget, 2)
-            function_value = np.sum(value_vector)
-
-            return function_value
-
-        #todo: different bounds input... check optimize bounds
-        res = optimize.minimize(rb_function, wgts, args=(cov_mat, budget, n_assets), method='SLSQP',
-                                    bounds=optimize.Bounds(self.lower_bound, self.upper_bound),
-                                    constraints=cons, options={'disp': False, 'maxiter': 1000, 'ftol': 1e-6})
+        if self.risk_budgets is None:
+            budgets = None
+        else:
+            budgets = self.risk_budgets.reindex(active_markets).fillna(0).values
 
-        result = res.x
+        return solve_erc(cov_mat, risk_budgets=budgets, x0=x0, lower_bound=self.lower_bound,
+                         upper_bound=self.upper_bound)
 
-        # Funky results with huge weights occur a couple of times throughout the history
-        result[result > 1.0] = 0.0
-        result[result < 0.0] = 0.0
+    def _calculate_erc_allocation_over_time(self, returns, molecule, universe):
+        """
+        :param returns:
+        :param molecule: rebalance dates
+        :param universe: UniverseMembership, markets live at date are allocated
+        :return: pd.DataFrame of erc weights indexed by the molecule dates
+        """
+        # erc weights buffer, markets not in the universe get a weight of 0
+        erc_weights = np.zeros((len(molecule), returns.shape[1]), dtype=self.dtype)
+        clean_correlations = self._iterate_clean_correlations(returns, molecule)
 
-        # Set weight for markets where all returns are nan to 0. cc all zero
+        for row, date in enumerate(molecule):
+            valid_markets = universe.live_columns(date)
+            positions = returns.columns.get_indexer(valid_markets)
+            # warm start from the weights of the previous rebalance date
+            x0 = erc_weights[row - 1, positions] if row > 0 else None
+            result = self._calculate_risk_allocation(returns, date, valid_markets, next(clean_correlations), x0=x0)
+            erc_weights[row, positions] = result
+            if date.is_year_end:
+                print("Optimisation ERC for date {} done ".format(date))
 
-        return result
+        return pd.DataFrame(erc_weights, index=molecule, columns=returns.columns)
 
     def calculate_rolling_erc_allocation(self):
 
         dates = self.returns.index[self.window_length + 1:] # first n returns from first n+1 prices
+        rebalance_dates = get_rebalance_dates(dates, self.rebalance)
 
+        if self.cache is not None:
+            cache_key = self.cache.make_key(self.returns, method='erc', window=self.window_length,
+                                            lower_bound=self.lower_bound, upper_bound=self.upper_bound,
+                                            risk_budgets=self.risk_budgets, cleaning=True, dtype=str(self.dtype),
+                                            rolling_moments=self.rolling_moments, rebalance_dates=rebalance_dates,
+                                            universe=self.universe.to_dict())
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.allocation = cached.erc_weights
+                return self.allocation
 
-        # erc weights dataframe
-        erc_weights = pd.DataFrame(index=dates, columns=self.returns.columns, data=np.nan)
-        is_in_universe = find_universe_tickers(self.returns)
-
-        for date in dates:
-            valid_markets =  is_in_universe.columns[is_in_universe.loc[date]]
-            result = self._calculate_risk_allocation(date, valid_markets)
-            erc_weights.loc[date][valid_markets] = result
-            if date.is_year_end:
-                print("Optimisation ERC for date {} done ".format(date))
-            erc_weights.fillna(0, inplace=True)
-
+        # solves of different rebalance dates are independent, each molecule warm starts date by date
+        erc_weights = mp_pandas_obj(func=self._copy_for_jobs()._calculate_erc_allocation_over_time,
+                                    pd_obj=('molecule', rebalance_dates), numThreads=8,
+                                    returns=self.returns, universe=self.universe)
+        erc_weights = forward_fill_weights(erc_weights, dates).astype(self.dtype)
         self.allocation = erc_weights
+        if self.cache is not None:
+            self.cache.put(cache_key, {'erc_weights': erc_weights})
 
-        return erc_weights
\ No newline at end of file
+        return erc_weights
@@ -1,13 +1,18 @@
+import copy
 import warnings
 
+import numpy as np
 import pandas as pd
 
-from risk_metrics.cleaning_routines import calculate_clean_correlation_matrix, calculate_cleaned_cov_mat
+from risk_metrics.cleaning_routines import calculate_cleaned_cov_mat, calculate_normed_correlation, \
+    clean_correlation_matrices
 from risk_metrics.measures import calculate_linkage_matrix, calculate_simple_covariance, calculate_returns, \
-    calculate_diagonalized_index, get_iv_cluster_variance, calculate_distance_matrix, calculate_simple_correlation
-from utils.parallel_computing import mp_pandas_obj
-from utils.universe_helpers import find_universe_tickers
-from utils.nan_handling import find_first_valid_date_where_n_larger_one
+    calculate_diagonalized_index, calculate_distance_matrix, calculate_simple_correlation, \
+    calculate_recursive_bisection
+from risk_metrics.rolling_moments import iterate_rolling_moments
+from utils.parallel_computing import concat_outputs, mp_pandas_obj
+from utils.rebalance_calendar import get_rebalance_dates, forward_fill_weights
+from utils.universe_helpers import UniverseMembership
 
 
 warnings.filterwarnings("ignore")
@@ -25,100 +30,276 @@ class HRP(object):
             self.returns = kwargs['future_returns']
         else:
             self.returns = calculate_returns(self.prices)
-        self.hrp_weights = pd.DataFrame(index=self.returns.index, columns=self.returns.columns)
+        # dtype of the allocation buffers, np.float32 halves their memory
+        if 'dtype' in kwargs:
+            self.dtype = np.dtype(kwargs['dtype'])
+        else:
+            self.dtype = np.dtype(np.float64)
+        self.hrp_weights = pd.DataFrame(index=self.returns.index, columns=self.returns.columns, dtype=self.dtype)
         if 'cleaning' in kwargs:
             self.cleaning = True
         else:
             self.cleaning = False
+        if 'cache' in kwargs:
+            self.cache = kwargs['cache']  # utils.result_cache.ResultCache, weights are loaded from it if cached
+        else:
+            self.cache = None
+        if 'rolling_moments' in kwargs:
+            # window moments are updated date by date instead of recomputed (risk_metrics.rolling_moments)
+            self.rolling_moments = kwargs['rolling_moments']
+        else:
+            self.rolling_moments = False
+        if 'cleaning_chunk_size' in kwargs:
+            self.cleaning_chunk_size = kwargs['cleaning_chunk_size']  # windows whose correlations are cleaned at once
+        else:
+            self.cleaning_chunk_size = 64
+        if 'rebalance' in kwargs:
+            # 'daily', 'weekly', 'month_end' or a pd.DatetimeIndex, weights are held between rebalance dates
+            self.rebalance = kwargs['rebalance']
+        else:
+            self.rebalance = 'daily'
+        if 'drift_threshold' in kwargs:
+            # on a rebalance date hrp is only recomputed if a correlation moved by more than drift_threshold since
+            # the last recomputation (or the universe changed), else the weights are held
+            self.drift_threshold = kwargs['drift_threshold']
+        else:
+            self.drift_threshold = None
+        if 'linkage_tolerance' in kwargs:
+            # the quasi-diagonal order of the last linkage is reused while no distance moved by more than
+            # linkage_tolerance since (on the same markets), only the recursive bisection is recomputed
+            self.linkage_tolerance = kwargs['linkage_tolerance']
+        else:
+            self.linkage_tolerance = None
+        if 'block_length' in kwargs:
+            # number of consecutive optimization dates over which weights are held (drift threshold) and the last
+            # linkage is reused, the first date of a block is always recomputed with the full linkage. Blocks are
+            # never split into molecules, so neither depends on the molecules
+            self.block_length = kwargs['block_length']
+        else:
+            self.block_length = 25
+        if 'universe' in kwargs:
+            # utils.universe_helpers.UniverseMembership, e.g. shared with other constructors and the backtester
+            self.universe = kwargs['universe']
+        else:
+            self.universe = UniverseMembership.from_prices(self.returns)
+        self.linkage_statistics = None  # per optimization date 'computed', 'reused' (linkage) or 'held' (weights)
 
     @staticmethod
     def _calculate_recursive_bisection(covariance, sorted_index):
-        weights = pd.Series(1, index=sorted_index)
-        cluster_items = [sorted_index]  # initialize all items in one cluster
-        while len(cluster_items) > 0:
-            # bi-sect list of cluster items in 2
-            cluster_items = [i[int(j): int(k)] for i in cluster_items for j, k in
-                             ((0, len(i) / 2), (len(i) / 2, len(i))) if
-                             len(i) > 1]
-            for i in range(0, len(cluster_items), 2):
-                # parse in pairs
-                cluster_items_0 = cluster_items[i]
-                cluster_items_1 = cluster_items[i + 1]
-                cluster_var_0 = get_iv_cluster_variance(covariance, cluster_items_0)
-                cluster_var_1 = get_iv_cluster_variance(covariance, cluster_items_1)
-                # weight for cluster 1
-                alpha = 1 - cluster_var_0 / (cluster_var_0 + cluster_var_1)
-                # weight of asset: weight in cluster * weight in next cluster
-                weights[cluster_items_0] *= alpha
-                weights[cluster_items_1] *= 1 - alpha
-        return weights
+        """ label based wrapper of the array kernel: covariance df, sorted_index list of asset names """
+        covariance = pd.DataFrame(covariance)
+        positions = covariance.columns.get_indexer(sorted_index)
+        weights = calculate_recursive_bisection(covariance.values.astype(np.float64), positions)
+        return pd.Series(weights[positions], index=sorted_index)
+
+    def _copy_for_jobs(self):
+        """
+        shallow copy without the price, return and weight frames. Its bound methods are shipped to the workers, the
+        frames are passed as job args instead, so large ones are shared rather than pickled into every job
+        """
+        job_copy = copy.copy(self)
+        for name in ['prices', 'returns', 'dates', 'weights', 'hrp_weights', 'linkage_statistics', 'universe',
+                     'cache']:
+            setattr(job_copy, name, None)
+        return job_copy
 
     def _find_first_valid_optimization_date(self):
         """ first valid opt date is the first opt date for which I have more than one instrument """
-        returns = self.returns
         # first date for which I have more than one asset price
-        start_date_optimization = find_first_valid_date_where_n_larger_one(returns)
+        start_date_optimization = self.universe.first_date_with_n_live(2)
         return start_date_optimization
 
-    def _calculate_hrp(self, covariance, correlation):
+    def _calculate_hrp(self, covariance, correlation, diagonalized_index=None):
         """
         takes a covmat, and a corrmat, calculates distance, linkage matrix, diagonalize by index
         create clusters, inverse-vol weight within cluster
         :param covariance:
         :param correlation:
+        :param diagonalized_index: quasi-diagonal order (positions) if already known, linkage is then skipped
         :return hrp:  returns hrp allocation for a given return mat
         """
         # takes a covmat, and a corrmat, calculates distance, linkage matrix, diagonalize by index
         # create clusters, inverse-vol weight within cluster
         corr, cov = pd.DataFrame(correlation), pd.DataFrame(covariance)
-        distance = calculate_distance_matrix(corr)
-        link = calculate_linkage_matrix(distance)
-        diagonalized_index = calculate_diagonalized_index(link)
-        sorted_correlation_mat_index = corr.index[diagonalized_index].tolist()  # sorted asset names
-        hrp = self._calculate_recursive_bisection(cov, sorted_correlation_mat_index)
-        return hrp.sort_index()
-
-    def _calculate_hrp_allocation_over_time(self, returns, molecule, events, is_in_universe):
+        # array kernel on integer positions, labels are only attached to the result
+        if diagonalized_index is None:
+            distance = calculate_distance_matrix(corr.values.astype(np.float64))
+            link = calculate_linkage_matrix(distance)
+            diagonalized_index = calculate_diagonalized_index(link)
+        hrp = calculate_recursive_bisection(cov.values.astype(np.float64), diagonalized_index)
+        return pd.Series(hrp, index=corr.index).sort_index()
+
+    def _calculate_hrp_allocation_over_time(self, returns, molecule, events, universe, block_length=1):
         """
         :param returns:
-        :param molecule:
+        :param molecule: first dates of the blocks of optimization dates of the molecule
         :param events: pd.Series where index_values are start dates and series values are end dates
-        :param is_in_universe: boolean df where for each date is True if date > first valid date
-        :return:
+        :param universe: UniverseMembership, markets live at the window start and end are allocated
+        :param block_length: number of consecutive events per block, within a block weights are held while no
+        correlation moved by more than drift_threshold and the quasi-diagonal order of the last linkage is reused
+        while no distance moved by more than linkage_tolerance
+        :return: (allocation df indexed by the end dates that are not held, pd.Series of 'computed', 'reused' or
+        'held' per end date)
         """
-        events_ = events.loc[molecule]
-        # cut returns matrix to molecule dates
-        returns_molecule = returns.loc[events_.index[0]:events_.iloc[-1]]
+        first = events.index.get_loc(molecule[0])
+        events_ = events.iloc[first:events.index.get_loc(molecule[-1]) + block_length]
         # prepare allocation slice
-        allocation = pd.DataFrame(columns=returns.columns, index=events_.values)
+        allocation = np.full((events_.shape[0], returns.shape[1]), np.nan, dtype=self.dtype)
+        linkage = np.full(events_.shape[0], 'computed', dtype=object)
 
         # loop through dates within slice, calculate HRP allocation
-        for date in events_:
-            start_date = events_[events_ == date].index[0]
-            return_window = returns_molecule.loc[start_date:date].copy()
-            # cut out markets for which current date is before the first valid date
-            valid_markets = is_in_universe.columns[is_in_universe.loc[start_date]]
-            return_window = return_window[valid_markets].copy()
-
-            if self.cleaning:
-                correlation = calculate_clean_correlation_matrix(return_window)
-                covariance = calculate_cleaned_cov_mat(return_window)
+        last_correlation = None  # correlation of the last recomputation
+        last_linkage = None  # (markets, distance, diagonalized index) of the last linkage
+        for row, covariance, correlation in self._iterate_window_moments(returns, events_, universe):
+            if (first + row) % block_length == 0:
+                last_correlation, last_linkage = None, None
+            if self._is_within_drift_threshold(correlation, last_correlation):
+                linkage[row] = 'held'
+                continue
+            last_correlation = correlation
+            valid_markets = correlation.columns
+            diagonalized_index = None
+            if self.linkage_tolerance is not None:
+                distance = calculate_distance_matrix(np.asarray(correlation, dtype=np.float64))
+                if self._is_within_linkage_tolerance(valid_markets, distance, last_linkage):
+                    linkage[row] = 'reused'
+                else:
+                    last_linkage = (valid_markets, distance, calculate_diagonalized_index(
+                        calculate_linkage_matrix(distance)))
+                diagonalized_index = last_linkage[2]
+            allocation_for_window = self._calculate_hrp(covariance, correlation, diagonalized_index)
+            allocation[row, returns.columns.get_indexer(valid_markets)] = allocation_for_window.reindex(valid_markets)
+        is_solved = linkage != 'held'
+        return pd.DataFrame(allocation[is_solved], index=events_.values[is_solved], columns=returns.columns), \
+            pd.Series(linkage, index=events_.values)
+
+    def _is_within_linkage_tolerance(self, valid_markets, distance, last_linkage):
+        """ True if no distance moved by more than linkage_tolerance since the last linkage on the same markets """
+        if last_linkage is None or not valid_markets.equals(last_linkage[0]):
+            return False
+        return np.max(np.abs(np.nan_to_num(distance - last_linkage[1]))) <= self.linkage_tolerance
+
+    def get_linkage_statistics(self):
+        """
+        how often the full linkage ran, available after hrp_calculation_through_time_in_parallel
+        :return: pd.Series of the number of 'computed', 'reused' (linkage reused) and 'held' (drift threshold)
+        optimization dates and the share of linkages reused
+        """
+        counts = self.linkage_statistics['linkage'].value_counts().reindex(['computed', 'reused', 'held'],
+                                                                           fill_value=0)
+        n_linkages = counts['computed'] + counts['reused']
+        counts['reuse_ratio'] = counts['reused'] / n_linkages if n_linkages > 0 else np.nan
+        return counts
+
+    def _is_within_drift_threshold(self, correlation, last_correlation):
+        """ True if no correlation moved by more than drift_threshold since last_correlation on the same markets """
+        if self.drift_threshold is None or last_correlation is None:
+            return False
+        if not correlation.columns.equals(last_correlation.columns):
+            return False
+        drift = np.nan_to_num(np.asarray(correlation, dtype=np.float64) - np.asarray(last_correlation, np.float64))
+        return np.max(np.abs(drift)) <= self.drift_threshold
+
+    def _iterate_window_moments(self, returns, events_, universe):
+        """
+        covariance and correlation of the return windows of a molecule, with cleaning the correlations of up to
+        cleaning_chunk_size windows are cleaned at once
+        :param returns:
+        :param events_: pd.Series where index_values are start dates and series values are end dates
+        :param universe: UniverseMembership, markets live at the window start and end are allocated
+        :return: generator of (row, covariance, correlation), dfs on the valid markets of the window
+        """
+        # cut returns matrix to molecule dates
+        returns_molecule = returns.loc[events_.index[0]:events_.iloc[-1]]
+        if self.rolling_moments:
+            # windows hold window_length + 1 returns, the moments are rolled over all dates between the window ends.
+            # Cleaned correlations leave out markets with a nan in the window, as calculate_normed_correlation
+            end_positions = returns.index.get_indexer(events_.values)
+            moments = iterate_rolling_moments(returns.values, self.window_length + 1, start=end_positions[0],
+                                              end=end_positions[-1], complete_only=self.cleaning)
+        windows_to_clean = []
+        for row, (start_date, date) in enumerate(events_.items()):
+            # markets live over the whole window: live at its start (full history) and at its end. By default
+            # markets stay live once listed, so these are the markets live at the start unless delisted in the window
+            valid_markets = universe.columns[np.intersect1d(universe.live_positions(start_date),
+                                                            universe.live_positions(date))]
+            return_window = returns_molecule.loc[start_date:date, valid_markets]
+
+            if self.rolling_moments:
+                t = -1
+                while t < end_positions[row]:
+                    t, covariance, correlation = next(moments)
+                positions = returns.columns.get_indexer(valid_markets)
+                covariance = covariance[np.ix_(positions, positions)]
+                correlation = correlation[np.ix_(positions, positions)]
+            elif self.cleaning:
+                covariance, correlation = None, calculate_normed_correlation(return_window)
             else:
-                correlation = calculate_simple_correlation(return_window)
                 covariance = calculate_simple_covariance(return_window)
-            allocation_for_window = self._calculate_hrp(covariance, correlation)
-            allocation.loc[date, valid_markets] = allocation_for_window
-        return allocation
+                correlation = calculate_simple_correlation(return_window)
+
+            if not self.cleaning:
+                yield row, pd.DataFrame(covariance, index=valid_markets, columns=valid_markets), \
+                    pd.DataFrame(correlation, index=valid_markets, columns=valid_markets)
+                continue
+            windows_to_clean.append((row, return_window, correlation))
+            if len(windows_to_clean) == self.cleaning_chunk_size or row == events_.shape[0] - 1:
+                for window_moments in self._clean_window_moments(windows_to_clean):
+                    yield window_moments
+                windows_to_clean = []
+
+    @staticmethod
+    def _clean_window_moments(windows):
+        """
+        RMT cleaning of a batch of windows, windows of equal shape are cleaned as one stack
+        :param windows: list of (row, return_window, correlation as np.array)
+        :return: generator of (row, covariance, correlation)
+        """
+        cleaned_correlations = {}
+        shapes = [return_window.shape for _, return_window, _ in windows]
+        for shape in set(shapes):
+            items = [i for i in range(len(windows)) if shapes[i] == shape]
+            correlations = clean_correlation_matrices(np.stack([windows[i][2] for i in items]), shape[0])
+            cleaned_correlations.update(zip(items, correlations))
+        for i, (row, return_window, _) in enumerate(windows):
+            correlation = pd.DataFrame(cleaned_correlations[i], index=return_window.columns,
+                                       columns=return_window.columns)
+            covariance = calculate_cleaned_cov_mat(return_window, clean_correlation=correlation)
+            yield row, covariance, correlation
 
     def hrp_calculation_through_time_in_parallel(self):
         # parallelize hrp allocation through time
         returns = self.returns.loc[self._find_first_valid_optimization_date():]
-        univ_boolean = find_universe_tickers(returns)
+        if self.cache is not None:
+            cache_key = self.cache.make_key(returns, method='hrp', window_length=self.window_length,
+                                            cleaning=self.cleaning, dtype=str(self.dtype),
+                                            rolling_moments=self.rolling_moments, rebalance=self.rebalance,
+                                            drift_threshold=self.drift_threshold,
+                                            linkage_tolerance=self.linkage_tolerance,
+                                            block_length=self.block_length,
+                                            universe=self.universe.to_dict())
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.hrp_weights = cached.hrp_weights
+                self.linkage_statistics = cached.linkage_statistics
+                return self.hrp_weights
         events = pd.Series(data=returns.index[self.window_length:], index=returns.index[:-self.window_length])
-        df0 = mp_pandas_obj(func=self._calculate_hrp_allocation_over_time, pd_obj=('molecule', events.index),
-                            numThreads=8,
-                            returns=returns, events=events, is_in_universe=univ_boolean)
+        # optimize on the rebalance dates only, weights are held in between
+        dates = returns.index[self.window_length:]
+        events = events[events.isin(get_rebalance_dates(dates, self.rebalance))]
+        # molecules are made of whole blocks, held dates keep the weights of the last recomputation of their block
+        if self.drift_threshold is None and self.linkage_tolerance is None:
+            block_length = 1
+        else:
+            block_length = self.block_length
+        out = mp_pandas_obj(func=self._copy_for_jobs()._calculate_hrp_allocation_over_time,
+                            pd_obj=('molecule', events.index[::block_length]), numThreads=8,
+                            returns=returns, events=events, universe=self.universe, block_length=block_length)
+        df0 = forward_fill_weights(concat_outputs([allocation for allocation, _ in out]), dates, fill_value=None)
+        self.linkage_statistics = pd.DataFrame({'linkage': concat_outputs([linkage for _, linkage in out])})
         self.hrp_weights = df0
+        if self.cache is not None:
+            self.cache.put(cache_key, {'hrp_weights': df0, 'linkage_statistics': self.linkage_statistics})
         return df0
 
 #
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the packages of the repo are imported from its root, e.g. from utils.parallel_computing import mp_pandas_obj
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -1,7 +1,7 @@
 import pandas as pd
 
-from backtesting.WalkForwardBacktest import WalkForwardBtNoCompounding
-from backtesting.portfolio_analysis import PortfolioResults, Comparis
+from backtesting.WalkForwardBacktest import WalkForwardBtBatch
+from backtesting.portfolio_analysis import Comparis
 from configs.strategy_configs.crypto_cta import crypto_cta_config
 from configs.universe_spec import universe_crypto
 from data_loading.load_from_disk.load_crypto_data import load_crypto_data_from_disk
@@ -24,22 +24,15 @@ for instrument in prices:
 
 splined_cma /= 2
 
-# backtests
-bt_raw = WalkForwardBtNoCompounding(cma, prices, aum=100, **crypto_cta_config)
-bt_spline_cta = WalkForwardBtNoCompounding(splined_cma, prices, aum=100,
-                                           **crypto_cta_config)
-bt_spline_grd = WalkForwardBtNoCompounding(splined_cma_grd, prices, aum=100,
-                                           **crypto_cta_config)
-bt_raw.calculate_backtest_performance()
-bt_spline_grd.calculate_backtest_performance()
-bt_spline_cta.calculate_backtest_performance()
+# backtests, all variants run together on the shared price panel
+bt = WalkForwardBtBatch({'ls_raw': cma, 'ls_spline': splined_cma, 'l_spline': splined_cma_grd}, prices, aum=100,
+                        **crypto_cta_config)
+bt.calculate_backtest_performance()
 
 # results
-res_l = PortfolioResults(bt_spline_grd, 'l_spline')
-res_ls = PortfolioResults(bt_spline_cta, 'ls_spline')
-res_ls_raw = PortfolioResults(bt_raw, 'ls_raw')
+results = bt.get_portfolio_results()
 
-comp = Comparis(LS=res_ls, L=res_l, RAW=res_ls_raw)
+comp = Comparis(LS=results.ls_spline, L=results.l_spline, RAW=results.ls_raw)
 
 comp.create_results_comparison()
 comp.plot_cumulative_returns()
@@ -0,0 +1,18 @@
+from backtesting.parameter_sweep import build_parameter_grid, run_parameter_sweep
+from configs.strategy_configs.crypto_cta import crypto_cta_config
+from configs.universe_spec import universe_crypto
+from data_loading.load_from_disk.load_crypto_data import load_crypto_data_from_disk
+
+# load crypto data
+crypto = load_crypto_data_from_disk(universe_crypto, frequency='1H')
+prices = crypto.get_cross_sectional_view('Close')
+
+# parameter grid of the ma crossover
+grid = build_parameter_grid(fast=[2, 4, 8], slow=[8, 16, 32], window=[20, 60], vol_floor=[0.1],
+                            spline=[None, 'cta_spline', 'grd_spline'])
+
+if __name__ == '__main__':
+    # results are streamed into the csv, rerunning the script resumes where it stopped
+    results = run_parameter_sweep(prices, grid, aum=100, num_threads=8, results_path='./ma_crossover_sweep.csv',
+                                  **crypto_cta_config)
+    print(results.sort_values(by='sharpe', ascending=False).head(10))
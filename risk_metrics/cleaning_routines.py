@@ -8,7 +8,7 @@ from scipy import linalg as la
 def normalize_data_mat(data):
     """ scales the matrix """
     t, n = data.shape
-    normed_data = data.apply(lambda x: (x - x.mean()) / x.std())
+    normed_data = (data - data.mean()) / data.std()
     return normed_data, t, n
 
 
@@ -34,11 +34,16 @@ def corr_pca(normed_data):
     return np.array(eig_vectors), eig_val_mat
 
 
+def calculate_rmt_cutoff(N, T):
+    """ Marchenko-Pastur upper edge, eigenvalues below it are treated as noise """
+    return 1 + N/T + 2 * math.sqrt(N/T)
+
+
 def eig_cleaning(eig_vecs, eig_val_mat, N, T):
     """ clean eigen values by applying RMT """
 
     # calculate cut-off lambda
-    lambda_max = 1 + N/T + 2 * math.sqrt(N/T)
+    lambda_max = calculate_rmt_cutoff(N, T)
 
     # how many EVs to include
     idx = np.sum(eig_val_mat >= lambda_max)
@@ -58,16 +63,60 @@ def calculate_clean_correlation_matrix(data):
     :return: df: returns a eigen-cleaned correlation matrix
     """
 
-    normed_data, T, N = normalize_data_mat(data)
-
-    eig_vec_mat, eig_val_mat = corr_pca(normed_data)
-    cleaned_correl_mat = eig_cleaning(eig_vec_mat, eig_val_mat, N, T)
+    cleaned_correl_mat = clean_correlation_matrix(calculate_normed_correlation(data), data.shape[0])
 
     df = pd.DataFrame(data=cleaned_correl_mat, columns=data.columns, index=data.columns)
 
     return df
 
 
+def calculate_normed_correlation(data):
+    """ covariance of the normed returns as decomposed by corr_pca, np.array (N, N) with nan entries as 0 """
+    values = np.asarray(data, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # normalize_data_mat on the array, columns with any nan are zeroed by nan_to_num as before
+        normed_data = (values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0, ddof=1)
+        return np.nan_to_num(np.cov(normed_data, rowvar=False, bias=False))
+
+
+def clean_correlation_matrices(correlations, T, chunk_size=64, check_reconstruction=False):
+    """
+    RMT cleaning of a stack of correlation matrices with the eig_cleaning cut-off, eigendecompositions are run
+    stacked in chunks, eigenvalues are never expanded to a dense diagonal matrix
+    :param correlations: np.array (K, N, N), e.g. one correlation matrix per window, nan entries are treated as 0
+    :param T: number of observations each correlation was estimated from
+    :param chunk_size: number of matrices decomposed at once
+    :param check_reconstruction: if True asserts that each decomposition reconstructs its matrix
+    :return: np.array (K, N, N) of eigen-cleaned correlation matrices
+    """
+    correlations = np.nan_to_num(np.asarray(correlations, dtype=np.float64))
+    n_matrices, N = correlations.shape[0], correlations.shape[1]
+    lambda_max = calculate_rmt_cutoff(N, T)
+    cleaned = np.empty_like(correlations)
+    for i in range(0, n_matrices, chunk_size):
+        chunk = correlations[i: i + chunk_size]
+        eig_values, eig_vectors = np.linalg.eigh(chunk)
+        if check_reconstruction:
+            reconstructed = np.matmul(eig_vectors * eig_values[:, None, :], np.swapaxes(eig_vectors, 1, 2))
+            assert np.allclose(chunk, reconstructed)
+        # keep the eigenvalues above the cut-off only
+        eig_values = np.where(eig_values >= lambda_max, eig_values, 0)
+        cleaned[i: i + chunk_size] = np.matmul(eig_vectors * eig_values[:, None, :], np.swapaxes(eig_vectors, 1, 2))
+    # force diagonal of corrmat to equal one
+    cleaned[:, np.arange(N), np.arange(N)] = 1
+    return cleaned
+
+
+def clean_correlation_matrix(correlation, T):
+    """
+    RMT cleaning of a given correlation matrix, e.g. from risk_metrics.rolling_moments
+    :param correlation: np.array (N, N), nan entries are treated as 0
+    :param T: number of observations the correlation was estimated from
+    :return: np.array (N, N) eigen-cleaned correlation matrix
+    """
+    return clean_correlation_matrices(np.asarray(correlation)[None], T)[0]
+
+
 def calculate_exp_vol(series, min_periods=0):
     # calculates exponential moving vol
 
@@ -77,19 +126,62 @@ def calculate_exp_vol(series, min_periods=0):
     assert len(series) > min_periods, "Not enough data to calculate exponential vol, " \
                                       "min period %d > series length" % min_periods
 
-    exp_vol = (series.ewm(span=span, adjust=False)).std(bias=False)[-1]
+    exp_vol = (series.ewm(span=span, adjust=False)).std(bias=False).iloc[-1]
 
     return exp_vol
 
 
-def calculate_cleaned_cov_mat(df):
-    corr = calculate_clean_correlation_matrix(df)
-    vars = df.apply(lambda x: calculate_exp_vol(x) ** 2)
-    cov_mat = pd.DataFrame(index=corr.index, columns=corr.columns)
-    cov_mat.values[[np.arange(cov_mat.shape[0])] * 2] = vars
-    for j in range(corr.shape[1]):
-        for i in range(corr.shape[0]):
-            if j != i:
-                cov_mat.iloc[i, j] = corr.iloc[i, j] * cov_mat.iloc[i, i] **(1/2) * cov_mat.iloc[j, j] ** (1/2)
-    return cov_mat
-
+def calculate_exp_vols(df, min_periods=0):
+    """
+    calculate_exp_vol of all columns at once on arrays. With adjust=False an observation after a gap of g rows gets
+    the weight alpha / ((1 - alpha)^g + alpha) and shrinks the weights of the earlier observations by
+    (1 - alpha)^g / ((1 - alpha)^g + alpha), the first valid row of a column starts with a weight of 1. Without gaps
+    these are the usual alpha (1 - alpha)^(T - 1 - k) weights
+    :param df: df of returns
+    :param min_periods:
+    :return: np.array (N,) of exponential vols at the last date
+    """
+    span = 2 * df.shape[0] - 1
+
+    assert len(df) > min_periods, "Not enough data to calculate exponential vol, " \
+                                  "min period %d > series length" % min_periods
+
+    values = np.asarray(df, dtype=np.float64)
+    alpha = 2. / (span + 1)
+    is_valid = ~np.isnan(values)
+    positions = np.arange(values.shape[0])[:, None]
+    last_valid = np.maximum.accumulate(np.where(is_valid, positions, -1), axis=0)
+    previous_valid = np.vstack([np.full((1, values.shape[1]), -1), last_valid[:-1]])
+    is_update = is_valid & (previous_valid >= 0)
+    decay = (1 - alpha) ** (positions - previous_valid)
+    own_weights = np.where(is_update, alpha / (decay + alpha), is_valid.astype(np.float64))
+    shrink = np.where(is_update, decay / (decay + alpha), 1.)
+    # product of the shrinks of all later observations
+    later_shrink = np.vstack([np.cumprod(shrink[::-1], axis=0)[::-1][1:], np.ones((1, values.shape[1]))])
+    weights = own_weights * later_shrink
+    sum_wt, sum_wt2 = weights.sum(axis=0), (weights ** 2).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(is_valid, values, 0)
+        mean = (weights * values).sum(axis=0) / sum_wt
+        var = (weights * (values - mean) ** 2).sum(axis=0) / sum_wt
+        # unbiased as ewm(...).std(bias=False)
+        denominator = sum_wt ** 2 - sum_wt2
+        exp_vols = np.sqrt(np.where(denominator > 0, sum_wt ** 2 / denominator * var, np.nan))
+    exp_vols[is_valid.sum(axis=0) < max(min_periods, 1)] = np.nan
+
+    return exp_vols
+
+
+def calculate_cleaned_cov_mat(df, clean_correlation=None):
+    """
+    covariance from the eigen-cleaned correlation and the exponential vols: vol_i * vol_j * corr_ij
+    :param df: df of returns
+    :param clean_correlation: cleaned correlation (df or np.array, ordered as the df columns) if it is already
+    computed, e.g. by calculate_clean_correlation_matrix, the eigendecomposition is then not repeated
+    :return: df: covariance matrix
+    """
+    if clean_correlation is None:
+        clean_correlation = calculate_clean_correlation_matrix(df)
+    vols = calculate_exp_vols(df)
+    cov_mat = np.asarray(clean_correlation, dtype=np.float64) * np.outer(vols, vols)
+    return pd.DataFrame(data=cov_mat, columns=df.columns, index=df.columns)
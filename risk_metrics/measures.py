@@ -1,5 +1,4 @@
 import numpy as np
-import pandas as pd
 import scipy.cluster.hierarchy as sch
 
 
@@ -33,21 +32,8 @@ def calculate_linkage_matrix(distance, link_type='single'):
 
 def calculate_diagonalized_index(link):
     # from link to diagonalization, outputs a list of indexes
-    link = link.astype(int)
-    sorted_instrument_index = pd.Series([link[-1, 0], link[-1, 1]])
-    num_items = link[-1, 3]
-
-    while sorted_instrument_index.max() >= num_items:
-        sorted_instrument_index.index = range(0, sorted_instrument_index.shape[0] * 2, 2)  # make space
-        df0 = sorted_instrument_index[sorted_instrument_index >= num_items]  # find clusters
-        i = df0.index
-        j = df0.values - num_items
-        sorted_instrument_index[i] = link[j, 0]  # item 1
-        df0 = pd.Series(link[j, 1], index=i + 1)
-        sorted_instrument_index = sorted_instrument_index.append(df0)  # item 2
-        sorted_instrument_index = sorted_instrument_index.sort_index()  # re-sort
-        sorted_instrument_index.index = range(sorted_instrument_index.shape[0])
-    return sorted_instrument_index.tolist()
+    # the quasi-diagonal order is the left to right order of the dendrogram leaves
+    return sch.leaves_list(link).tolist()
 
 
 # ---------------------------
@@ -72,3 +58,40 @@ def get_iv_cluster_variance(cov, c_items):
     w_ = get_inverse_volatility_weights(cov_).reshape(-1, 1)  # reshape to column vector
     c_var = np.dot(np.dot(w_.T, cov_), w_)[0, 0]  # compute variance, get value back
     return c_var
+
+
+def calculate_cluster_variance(cov, c_items):
+    """
+    array version of get_iv_cluster_variance
+    :param cov: covariance as np.array
+    :param c_items: np.array of integer positions of the cluster
+    :return:
+    """
+    cov_ = cov[np.ix_(c_items, c_items)]  # matrix slice
+    w_ = 1. / np.diag(cov_)
+    w_ /= w_.sum()
+    return w_.dot(cov_).dot(w_)
+
+
+def calculate_recursive_bisection(cov, sorted_index):
+    """
+    top down inverse variance allocation between the bisected clusters of the quasi-diagonal order
+    :param cov: covariance as np.array
+    :param sorted_index: integer positions in quasi-diagonal order (from calculate_diagonalized_index)
+    :return: weights: np.array, ordered as the covariance columns
+    """
+    weights = np.ones(cov.shape[0])
+    cluster_items = [np.asarray(sorted_index)]  # initialize all items in one cluster
+    while len(cluster_items) > 0:
+        # bi-sect list of cluster items in 2
+        cluster_items = [i[j: k] for i in cluster_items for j, k in ((0, len(i) // 2), (len(i) // 2, len(i))) if
+                         len(i) > 1]
+        for i in range(0, len(cluster_items), 2):
+            cluster_items_0 = cluster_items[i]
+            cluster_items_1 = cluster_items[i + 1]
+            cluster_var_0 = calculate_cluster_variance(cov, cluster_items_0)
+            cluster_var_1 = calculate_cluster_variance(cov, cluster_items_1)
+            alpha = 1 - cluster_var_0 / (cluster_var_0 + cluster_var_1)
+            weights[cluster_items_0] *= alpha
+            weights[cluster_items_1] *= 1 - alpha
+    return weights
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+# ---------------------------------------------------------------------------------
+# rolling first and second moments of a return panel. Sums and cross products are kept per pair of assets over the
+# dates where both returns are valid (pairwise complete, as pd.DataFrame.cov / corr), so a window move only adds
+# the entering and subtracts the leaving date: O(N^2) per date instead of O(W * N^2) for a full recomputation
+# ---------------------------------------------------------------------------------
+
+
+class RollingMoments(object):
+    """
+    pairwise nan aware sums of a return window. For assets i, j and the dates where both are valid it holds the
+    count n_ij, the sum of x_i (sum_x[i, j]), the sum of x_i^2 (sum_xx[i, j]) and the sum of x_i * x_j
+    """
+
+    def __init__(self, n_assets, dtype=np.float64):
+        self.n_assets = n_assets
+        self.dtype = np.dtype(dtype)
+        self.count = np.zeros((n_assets, n_assets), dtype=self.dtype)
+        self.sum_x = np.zeros((n_assets, n_assets), dtype=self.dtype)
+        self.sum_xx = np.zeros((n_assets, n_assets), dtype=self.dtype)
+        self.sum_xy = np.zeros((n_assets, n_assets), dtype=self.dtype)
+        # sum of x_i^2 added since the last reset, scale of the rounding residual left by remove
+        self.added_xx = np.zeros((n_assets, n_assets), dtype=self.dtype)
+
+    def _update(self, rows, sign):
+        rows = np.atleast_2d(rows)
+        is_valid = (~np.isnan(rows)).astype(self.dtype)
+        x = np.where(is_valid > 0, rows, 0).astype(self.dtype)
+        self.count += sign * is_valid.T.dot(is_valid)
+        self.sum_x += sign * x.T.dot(is_valid)
+        sum_xx = (x * x).T.dot(is_valid)
+        self.sum_xx += sign * sum_xx
+        if sign > 0:
+            self.added_xx += sum_xx
+        self.sum_xy += sign * x.T.dot(x)
+
+    def add(self, rows):
+        """ :param rows: np.array (N,) or (K, N) of returns entering the window, nan if not valid """
+        self._update(rows, 1)
+
+    def remove(self, rows):
+        """ :param rows: np.array (N,) or (K, N) of returns leaving the window """
+        self._update(rows, -1)
+
+    def reset(self, rows):
+        """ recomputes the sums from scratch for the window rows, removes the drift of many add / remove steps """
+        for moment in (self.count, self.sum_x, self.sum_xx, self.sum_xy, self.added_xx):
+            moment[:] = 0
+        self.add(rows)
+
+    def covariance(self, ddof=1):
+        """ :return: np.array (N, N) pairwise covariance, nan where fewer than ddof + 1 common observations """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = (self.sum_xy - self.sum_x * self.sum_x.T / self.count) / (self.count - ddof)
+        cov[self.count <= ddof] = np.nan
+        return cov
+
+    def correlation(self, min_count=None):
+        """
+        :param min_count: rows and columns of assets with fewer valid returns are nan, e.g. the window length to keep
+        only assets without a nan in the window (as calculate_normed_correlation, which zeroes the others)
+        :return: np.array (N, N) pairwise correlation, both variances on the common observations of the pair
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            co_moment = self.sum_xy - self.sum_x * self.sum_x.T / self.count
+            var = self.sum_xx - self.sum_x ** 2 / self.count
+            # constant returns leave a rounding residual after add / remove steps
+            var[var <= 1e-12 * self.added_xx] = 0
+            corr = co_moment / np.sqrt(var * var.T)
+        corr[(self.count < 2) | (var * var.T == 0)] = np.nan
+        corr = np.clip(corr, -1, 1)
+        is_diagonal_valid = np.diag(var) > 0
+        corr[np.diag_indices(self.n_assets)] = np.where(is_diagonal_valid, 1, np.nan)
+        if min_count is not None:
+            is_short = np.diag(self.count) < min_count
+            corr[is_short, :] = np.nan
+            corr[:, is_short] = np.nan
+        return corr
+
+
+def iterate_rolling_moments(returns, window_length, start=None, end=None, refresh_every=None, dtype=np.float64,
+                            complete_only=False):
+    """
+    stream of covariance and correlation matrices of the windows returns[t - window_length + 1: t + 1]
+    :param returns: pd.DataFrame or np.array (T, N) of returns, nan if not valid
+    :param window_length: number of rows per window
+    :param start: first window end position, defaults to window_length - 1
+    :param end: last window end position (inclusive), defaults to the last row
+    :param refresh_every: number of window moves after which the sums are recomputed, defaults to window_length
+    :param dtype: dtype of the sums
+    :param complete_only: if True correlations of assets with a nan in the window are nan instead of pairwise, as
+    the correlations of calculate_normed_correlation (where they are 0)
+    :return: generator of (t, covariance, correlation) with np.arrays (N, N)
+    """
+    values = np.asarray(returns, dtype=np.float64)
+    if start is None:
+        start = window_length - 1
+    if end is None:
+        end = values.shape[0] - 1
+    if refresh_every is None:
+        refresh_every = window_length
+    assert start >= window_length - 1, 'first window needs %d rows before position %d' % (window_length, start)
+
+    moments = RollingMoments(values.shape[1], dtype=dtype)
+    moments.add(values[start - window_length + 1: start + 1])
+    for t in range(start, end + 1):
+        if t > start:
+            if (t - start) % refresh_every == 0:
+                moments.reset(values[t - window_length + 1: t + 1])
+            else:
+                moments.add(values[t])
+                moments.remove(values[t - window_length])
+        yield t, moments.covariance(), moments.correlation(min_count=window_length if complete_only else None)
@@ -63,7 +63,7 @@ def run_tripple_barrier_date_search(prices, barrier_info, pt_sl, molecule):
     else:
         sl = pd.Series(index=barrier_info.index)
 
-    for loc, vb in events_['barrier_date'].fillna(prices.index[-1]).iteritems():
+    for loc, vb in events_['barrier_date'].fillna(prices.index[-1]).items():
         df = prices[loc:vb]
         df = (df / prices[loc] - 1) * events_.at[loc, 'side']  # changes signs if necessary, path return
         out.loc[loc, 'sl'] = df[df < sl[loc]].index.min()  # earliest stop loss
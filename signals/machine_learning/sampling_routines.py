@@ -21,7 +21,7 @@ def calculate_concurrent_events_per_date(price_index, touch_dates, molecule):
     # count concurrent events in a bar/date
     iloc = price_index.searchsorted(np.array([touch_dates.index[0], touch_dates.max()]))
     count = pd.Series(0, index=price_index[iloc[0]:iloc[1] + 1])
-    for start, end in touch_dates.iteritems():
+    for start, end in touch_dates.items():
         count.loc[start:end] += 1
     return count.loc[molecule[0]:touch_dates[molecule].max()]
 
@@ -39,7 +39,7 @@ def calculate_average_uniqueness_per_date(touch_dates, concurrent_events, molecu
     if type(touch_dates) == pd.DataFrame:
         touch_dates = touch_dates['barrier_date'].copy()  # convert to series
     wghts = pd.Series(index=molecule)
-    for start, end in touch_dates.loc[wghts.index].iteritems():
+    for start, end in touch_dates.loc[wghts.index].items():
         wghts.loc[start] = (1 / concurrent_events.loc[start:end]).mean()  # average uniqueness of label
     return wghts
 
@@ -71,7 +71,7 @@ def calculate_indicator_matrix(prices_dates, barrier_dates):
     if type(barrier_dates) == pd.DataFrame:
         barrier_dates = barrier_dates['barrier_date'].copy()
     indicator_matrix = pd.DataFrame(0, index=prices_dates, columns=range(barrier_dates.shape[0]))
-    for label, (start, end) in enumerate(barrier_dates.iteritems()):
+    for label, (start, end) in enumerate(barrier_dates.items()):
         indicator_matrix.loc[start:end, label] = 1
         # print('calculated indicator entries for date {}'.format(start))
     return indicator_matrix
@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.parallel_computing import mp_pandas_obj, job_telemetry, parallel_backend
+
+
+def _sum_rows(molecule, df):
+    return df.loc[molecule].sum(axis=1)
+
+
+def _make_panel(num_rows):
+    return pd.DataFrame(np.random.RandomState(0).rand(num_rows, 20))
+
+
+def test_telemetry_input_bytes_count_shared_args_as_handles():
+    input_bytes = []
+    for num_rows in [10000, 40000]:
+        df = _make_panel(num_rows)
+        with parallel_backend('process'), job_telemetry() as telemetry:
+            out = mp_pandas_obj(_sum_rows, ('molecule', df.index), numThreads=2, df=df)
+        pd.testing.assert_series_equal(out.sort_index(), df.sum(axis=1))
+        input_bytes.append(telemetry.to_frame()['input_bytes'].max())
+    # df is shared, jobs only ship their molecule
+    assert input_bytes[1] - input_bytes[0] < 0.01 * 30000 * 20 * 8
+
+
+def test_telemetry_replaces_progress_on_stderr(capsys):
+    df = _make_panel(1000)
+    with parallel_backend('thread'), job_telemetry() as telemetry:
+        mp_pandas_obj(_sum_rows, ('molecule', df.index), numThreads=2, df=df)
+    records = telemetry.to_frame()
+    assert len(records) == 2
+    assert records['rss_delta_mb'].isnull().all()
+    assert capsys.readouterr().err == ''
+
+
+def test_process_pool_sees_functions_defined_in_main_after_the_first_call(tmp_path):
+    script = tmp_path.joinpath('script.py')
+    script.write_text('\n'.join([
+        'import pandas as pd',
+        'from utils.parallel_computing import mp_pandas_obj, parallel_backend',
+        'def first(molecule):',
+        '    return pd.Series(1, index=molecule)',
+        'with parallel_backend("process"):',
+        '    print(mp_pandas_obj(first, ("molecule", range(4)), numThreads=2).sum())',
+        'def second(molecule):',
+        '    return pd.Series(2, index=molecule)',
+        'def first(molecule):',
+        '    return pd.Series(3, index=molecule)',
+        'with parallel_backend("process"):',
+        '    print(mp_pandas_obj(second, ("molecule", range(4)), numThreads=2).sum())',
+        '    print(mp_pandas_obj(first, ("molecule", range(4)), numThreads=2).sum())']))
+    root = Path(__file__).parent.parent
+    output = subprocess.run([sys.executable, str(script)], cwd=str(root), capture_output=True, text=True, timeout=60,
+                            env=dict(os.environ, PYTHONPATH=str(root)))
+    assert output.stdout.split() == ['4', '8', '12'], output.stderr[-2000:]
+
+
+def _demean_in_place(molecule, df, values):
+    assert 'mean' not in df
+    df['mean'] = df.mean(axis=1)
+    df.iloc[:, 0] -= df.iloc[:, 0].mean()
+    values -= values.mean()
+    return df.loc[molecule].drop('mean', axis=1).sum(axis=1) + values[molecule].sum(axis=1)
+
+
+def test_jobs_that_write_to_a_shared_arg_get_a_private_copy():
+    df = _make_panel(40000)
+    values = df.values.copy()
+    expected = _demean_in_place(df.index, df.copy(), values.copy())
+    with parallel_backend('process'):
+        out = mp_pandas_obj(_demean_in_place, ('molecule', df.index), numThreads=2, mpBatches=4, df=df,
+                            values=values)
+    pd.testing.assert_series_equal(out.sort_index(), expected)
+    # the parent's objects are unchanged
+    pd.testing.assert_frame_equal(df, _make_panel(40000))
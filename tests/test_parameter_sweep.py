@@ -0,0 +1,47 @@
+import pandas as pd
+
+from backtesting.parameter_sweep import append_result_row, build_parameter_grid, get_parameter_key, \
+    load_completed_results
+
+
+def _make_rows():
+    return [dict(parameter_key=get_parameter_key(params), sharpe=0.1 * i, **params)
+            for i, params in enumerate(build_parameter_grid([2, 4, 8], [16], [20]))]
+
+
+def test_resume_drops_a_partial_last_row(tmp_path):
+    results_path = tmp_path.joinpath('results.csv')
+    rows = _make_rows()
+    for row in rows[:2]:
+        append_result_row(results_path, row)
+    # a crash in the middle of writing the third row
+    line = pd.DataFrame([rows[2]]).to_csv(header=False, index=False)
+    with open(results_path, 'a') as f:
+        f.write(line[:len(line) // 2])
+    completed = load_completed_results(results_path)
+    assert list(completed['parameter_key']) == [row['parameter_key'] for row in rows[:2]]
+    # the rerun of the third parameter set starts on a fresh line
+    append_result_row(results_path, rows[2])
+    completed = load_completed_results(results_path)
+    columns = ['parameter_key', 'sharpe']
+    pd.testing.assert_frame_equal(completed[columns], pd.DataFrame(rows)[columns])
+
+
+def test_resume_drops_rows_that_fail_to_parse(tmp_path):
+    results_path = tmp_path.joinpath('results.csv')
+    rows = _make_rows()
+    append_result_row(results_path, rows[0])
+    with open(results_path, 'a') as f:
+        f.write('{"fast": 4, "slo,1,2,3,4,5,6,7,8,9\n')
+    append_result_row(results_path, rows[1])
+    completed = load_completed_results(results_path)
+    assert list(completed['parameter_key']) == [rows[0]['parameter_key'], rows[1]['parameter_key']]
+
+
+def test_a_header_cut_short_is_rewritten(tmp_path):
+    results_path = tmp_path.joinpath('results.csv')
+    results_path.write_text('parameter_key,sha')
+    assert load_completed_results(results_path).empty
+    rows = _make_rows()
+    append_result_row(results_path, rows[0])
+    assert list(load_completed_results(results_path)['parameter_key']) == [rows[0]['parameter_key']]
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+from classes.portfolio_construction.ERC import RiskParity
+from classes.portfolio_construction.HRP import HRP
+from utils.parallel_computing import job_telemetry, parallel_backend, get_scheduler, set_scheduler
+
+
+def _make_prices(num_dates, num_markets, seed=0):
+    returns = np.random.RandomState(seed).normal(0., 0.01, (num_dates, num_markets))
+    index = pd.bdate_range('2005-01-03', periods=num_dates)
+    return pd.DataFrame(100 * np.exp(np.cumsum(returns, axis=0)), index=index,
+                        columns=['m%d' % i for i in range(num_markets)])
+
+
+def _get_max_input_bytes(run):
+    with parallel_backend('process'), job_telemetry() as telemetry:
+        run()
+    return telemetry.to_frame()['input_bytes'].max()
+
+
+def test_hrp_jobs_do_not_ship_the_panel():
+    input_bytes = []
+    for num_markets in [50, 100]:
+        prices = _make_prices(3000, num_markets)
+        hrp = HRP(prices, 60, future_returns=np.log(prices).diff().iloc[1:], rebalance='month_end')
+        input_bytes.append(_get_max_input_bytes(hrp.hrp_calculation_through_time_in_parallel))
+    # the returns are shared, so the jobs grow by far less than the 1.2mb the returns grow by
+    assert input_bytes[1] - input_bytes[0] < 0.05 * 3000 * 50 * 8
+
+
+def test_erc_jobs_do_not_ship_the_panel():
+    input_bytes = []
+    for num_markets in [50, 100]:
+        erc = RiskParity(_make_prices(3000, num_markets), window=60, rebalance='month_end')
+        input_bytes.append(_get_max_input_bytes(erc.calculate_rolling_erc_allocation))
+    assert input_bytes[1] - input_bytes[0] < 0.05 * 3000 * 50 * 8
+
+
+def _run_hrp(backend, scheduler, **kwargs):
+    prices = _make_prices(1500, 12, seed=1)
+    hrp = HRP(prices, 60, future_returns=np.log(prices).diff().iloc[1:], rebalance='weekly', **kwargs)
+    previous_scheduler = get_scheduler()
+    set_scheduler(scheduler)
+    try:
+        with parallel_backend(backend):
+            weights = hrp.hrp_calculation_through_time_in_parallel()
+    finally:
+        set_scheduler(previous_scheduler)
+    return weights, hrp.linkage_statistics
+
+
+def test_hrp_drift_does_not_depend_on_the_molecules():
+    serial_weights, serial_statistics = _run_hrp('serial', 'static', drift_threshold=0.15)
+    assert (serial_statistics['linkage'] == 'held').any()
+    # the first date of a block is always recomputed
+    assert (serial_statistics['linkage'].iloc[::25] == 'computed').all()
+    for backend, scheduler in [('process', 'static'), ('process', 'dynamic'), ('thread', 'dynamic')]:
+        weights, statistics = _run_hrp(backend, scheduler, drift_threshold=0.15)
+        pd.testing.assert_frame_equal(weights, serial_weights)
+        pd.testing.assert_frame_equal(statistics, serial_statistics)
+
+
+def test_hrp_linkage_reuse_does_not_depend_on_the_molecules():
+    serial_weights, serial_statistics = _run_hrp('serial', 'static', drift_threshold=0.15, linkage_tolerance=0.3)
+    assert set(serial_statistics['linkage']) == {'computed', 'reused', 'held'}
+    for backend, scheduler in [('process', 'static'), ('process', 'dynamic'), ('thread', 'dynamic')]:
+        weights, statistics = _run_hrp(backend, scheduler, drift_threshold=0.15, linkage_tolerance=0.3)
+        pd.testing.assert_frame_equal(weights, serial_weights)
+        pd.testing.assert_frame_equal(statistics, serial_statistics)
+
+
+def test_hrp_linkage_tolerance_of_zero_matches_the_full_linkage():
+    weights, statistics = _run_hrp('serial', 'static', linkage_tolerance=0.)
+    full_weights, _ = _run_hrp('serial', 'static')
+    pd.testing.assert_frame_equal(weights, full_weights)
+
+
+def _make_staggered_returns():
+    random_state = np.random.RandomState(2)
+    # two factors, so the correlations survive the eigenvalue cleaning
+    factors = random_state.normal(0., 0.01, (400, 2))
+    loadings = np.repeat(np.eye(2), 4, axis=0)
+    returns = pd.DataFrame(factors.dot(loadings.T) + random_state.normal(0., 0.01, (400, 8)),
+                           index=pd.bdate_range('2005-01-03', periods=400), columns=['m%d' % i for i in range(8)])
+    # markets list at different dates, one has a gap of missing returns
+    for i, first_position in enumerate([0, 0, 0, 30, 90, 150, 150, 200]):
+        returns.iloc[:first_position, i] = np.nan
+    returns.iloc[250:260, 1] = np.nan
+    return returns
+
+
+def test_erc_rolling_moments_match_on_a_staggered_listing():
+    returns = _make_staggered_returns()
+    weights = []
+    for rolling_moments in [False, True]:
+        erc = RiskParity(None, window=60, futures_returns=returns, rolling_moments=rolling_moments)
+        with parallel_backend('serial'):
+            weights.append(erc.calculate_rolling_erc_allocation())
+    pd.testing.assert_frame_equal(weights[1], weights[0], atol=1e-8)
+
+
+def test_hrp_cleaned_rolling_moments_match_on_a_staggered_listing():
+    returns = _make_staggered_returns()
+    weights = []
+    for rolling_moments in [False, True]:
+        hrp = HRP(returns, 60, future_returns=returns, cleaning=True, rolling_moments=rolling_moments)
+        with parallel_backend('serial'):
+            weights.append(hrp.hrp_calculation_through_time_in_parallel())
+    pd.testing.assert_frame_equal(weights[1], weights[0], atol=1e-8)
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from utils.universe_helpers import UniverseMembership, find_universe_tickers
+
+
+def _make_prices():
+    index = pd.bdate_range('2010-01-01', periods=50)
+    prices = pd.DataFrame(np.random.RandomState(0).rand(50, 4) + 1, index=index, columns=['a', 'b', 'c', 'd'])
+    prices.iloc[:10, 1] = np.nan  # listed late
+    prices.iloc[30:, 2] = np.nan  # prices stop
+    prices.iloc[20:25, 3] = np.nan  # gap
+    return prices
+
+
+def test_markets_stay_live_from_their_first_valid_price():
+    prices = _make_prices()
+    universe = UniverseMembership.from_prices(prices)
+    pd.testing.assert_frame_equal(universe.to_frame(), find_universe_tickers(prices))
+
+
+def test_until_last_valid_drops_markets_after_their_last_price():
+    prices = _make_prices()
+    is_live = UniverseMembership.from_prices(prices, until_last_valid=True).to_frame()
+    assert is_live['c'].iloc[:30].all() and not is_live['c'].iloc[30:].any()
+    assert is_live['d'].all()
+
+
+def test_mask_weights_matches_the_dense_membership():
+    prices = _make_prices()
+    inclusion_rule = pd.DataFrame(True, index=prices.index, columns=prices.columns)
+    inclusion_rule.iloc[35:40, 0] = False
+    delisting_dates = pd.Series([pd.NaT, pd.NaT, pd.NaT, prices.index[45]], index=prices.columns)
+    for kwargs in [{}, {'until_last_valid': True}, {'inclusion_rule': inclusion_rule},
+                   {'delisting_dates': delisting_dates}]:
+        universe = UniverseMembership.from_prices(prices, **kwargs)
+        # dates before and after the index, a column the universe does not know
+        index = pd.bdate_range('2009-12-28', periods=60)
+        weights = pd.DataFrame(1., index=index, columns=['a', 'b', 'c', 'd', 'e'])
+        is_live = universe.to_frame().reindex(index=index, method='ffill').reindex(columns=weights.columns)
+        expected = weights.where(is_live.fillna(False).astype(bool), 0.)
+        pd.testing.assert_frame_equal(universe.mask_weights(weights), expected)
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtesting.WalkForwardBacktest import WalkForwardBtCompounding, WalkForwardBtNoCompounding, WalkForwardBtStream
+from utils.result_cache import ResultCache
+
+
+def _make_inputs(num_dates=120, num_markets=4):
+    random_state = np.random.RandomState(3)
+    index = pd.bdate_range('2015-01-01', periods=num_dates, freq='B')
+    columns = ['m%d' % i for i in range(num_markets)]
+    prices = pd.DataFrame(100 * np.exp(np.cumsum(random_state.normal(0., 0.01, (num_dates, num_markets)), axis=0)),
+                          index=index, columns=columns)
+    weights = pd.DataFrame(random_state.normal(0., 0.3, (num_dates, num_markets)), index=index, columns=columns)
+    return weights.iloc[5::5], prices
+
+
+def test_cache_key_covers_costs_and_engine(tmp_path):
+    weights, prices = _make_inputs()
+    cache = ResultCache(tmp_path)
+    nav = {}
+    for name, kwargs in [('no_costs', {}), ('slippage', {'slippage': 0.1}),
+                         ('slippage_span', {'slippage': 0.1, 'slippage_vol_span': 5}),
+                         ('fee', {'fee_per_contract': 0.5}),
+                         ('trading_costs', {'trading_costs': pd.DataFrame(0.001, index=prices.index,
+                                                                          columns=prices.columns)})]:
+        bt = WalkForwardBtCompounding(weights, prices, 1e6, engine='array', cache=cache, **kwargs)
+        nav[name] = bt.calculate_backtest_performance().net_asset_value
+    for name in ['slippage', 'slippage_span', 'fee', 'trading_costs']:
+        assert not np.allclose(nav[name].values, nav['no_costs'].values)
+    assert not np.allclose(nav['slippage_span'].values, nav['slippage'].values)
+    loop_key = WalkForwardBtCompounding(weights, prices, 1e6, engine='loop', cache=cache)._get_cache_key()
+    array_key = WalkForwardBtCompounding(weights, prices, 1e6, engine='array', cache=cache)._get_cache_key()
+    assert loop_key != array_key
+
+
+def test_cache_restores_pnl_per_instrument(tmp_path):
+    weights, prices = _make_inputs()
+    cache = ResultCache(tmp_path)
+    bt = WalkForwardBtCompounding(weights, prices, 1e6, engine='array', cache=cache, slippage=0.1)
+    backtest = bt.calculate_backtest_performance()
+    cached_bt = WalkForwardBtCompounding(weights, prices, 1e6, engine='array', cache=cache, slippage=0.1)
+    assert cached_bt._load_backtest_from_cache() is not None
+    pd.testing.assert_frame_equal(cached_bt.pnl_per_instrument, bt.pnl_per_instrument, check_freq=False)
+    pd.testing.assert_series_equal(cached_bt.transaction_costs, bt.transaction_costs, check_freq=False)
+    assert sorted(cached_bt.backtest.keys()) == sorted(backtest.keys())
+
+
+def _run_stream(weights, prices, chunk_bounds, **kwargs):
+    nav, holdings = [], []
+    stream = WalkForwardBtStream(1e6, callback=lambda nav_, holdings_: (nav.append(nav_), holdings.append(holdings_)),
+                                 **kwargs)
+    chunks = [(weights.loc[prices.index[start]:prices.index[end - 1]], prices.iloc[start:end])
+              for start, end in zip(chunk_bounds[:-1], chunk_bounds[1:])]
+    stream.run(chunks)
+    return pd.concat(nav), pd.concat(holdings)
+
+
+def test_stream_emits_t0_nav_after_a_single_bar_first_chunk():
+    weights, prices = _make_inputs()
+    nav, holdings = _run_stream(weights, prices, [0, 60, 120])
+    single_bar_nav, single_bar_holdings = _run_stream(weights, prices, [0, 1, 60, 120])
+    assert nav.index[0] == prices.index[0] and nav.iloc[0] == 1e6
+    pd.testing.assert_series_equal(single_bar_nav, nav)
+    pd.testing.assert_frame_equal(single_bar_holdings, holdings)
+
+
+def test_stream_constant_exposure_matches_the_backtest():
+    weights, prices = _make_inputs()
+    settings = {'constant_exposure': True, 'constant_long': 1.5, 'constant_short': -0.5}
+    nav, _ = _run_stream(weights, prices, [0, 60, 120], **settings)
+    bt = WalkForwardBtCompounding(weights, prices.loc[weights.index[0] - pd.offsets.BDay(1):], 1e6, engine='array',
+                                  **settings)
+    expected = bt.calculate_backtest_performance().net_asset_value
+    np.testing.assert_allclose(nav.loc[expected.index].values, expected.values, rtol=1e-10)
+
+
+@pytest.mark.parametrize('chunk_bounds', [[0, 50, 115], [0, 1, 50, 115]])
+def test_stream_starting_on_a_trading_date_matches_the_backtest(chunk_bounds):
+    weights, prices = _make_inputs()
+    prices = prices.loc[weights.index[0]:]
+    nav, holdings = _run_stream(weights, prices, chunk_bounds)
+    bt = WalkForwardBtCompounding(weights, prices, 1e6, engine='array')
+    bt.calculate_backtest_performance()
+    # t0 is prepended before the first bar with an empty book, the first trade is on the first bar
+    pd.testing.assert_series_equal(nav, bt.net_asset_value, check_freq=False)
+    pd.testing.assert_frame_equal(holdings, bt.holdings, check_freq=False, check_dtype=False)
+
+
+@pytest.mark.parametrize('bt_class', [WalkForwardBtCompounding, WalkForwardBtNoCompounding])
+def test_extend_matches_the_full_backtest(bt_class):
+    weights, prices = _make_inputs(num_dates=600)
+    settings = {'engine': 'array', 'slippage': 0.1, 'slippage_vol_span': 10, 'fee_per_contract': 0.2,
+                'trading_costs': pd.DataFrame(0.001, index=prices.index, columns=prices.columns)}
+    full = bt_class(weights, prices, 1e6, **settings)
+    full_backtest = full.calculate_backtest_performance()
+
+    extended = bt_class(weights.loc[:prices.index[299]], prices.iloc[:300], 1e6, **settings)
+    extended.calculate_backtest_performance()
+    for start, end in [(300, 301), (301, 450), (450, 600)]:
+        backtest = extended.extend(weights.loc[prices.index[start]:prices.index[end - 1]], prices.iloc[start:end])
+
+    assert sorted(backtest.keys()) == sorted(full_backtest.keys())
+    for name in full_backtest.keys():
+        pd.testing.assert_frame_equal(pd.DataFrame(backtest[name]), pd.DataFrame(full_backtest[name]), rtol=1e-10,
+                                      check_freq=False)
+    pd.testing.assert_frame_equal(extended.pnl_per_instrument, full.pnl_per_instrument, check_freq=False)
+    pd.testing.assert_series_equal(extended.transaction_costs, full.transaction_costs, rtol=1e-10, check_freq=False)
+    pd.testing.assert_frame_equal(extended.dt_df, full.dt_df, check_freq=False)
+
+
+@pytest.mark.parametrize('bt_class', [WalkForwardBtCompounding, WalkForwardBtNoCompounding])
+def test_loop_engine_runs_in_float32(bt_class):
+    weights, prices = _make_inputs()
+    backtest = bt_class(weights, prices, 1e6, engine='loop', dtype=np.float32).calculate_backtest_performance()
+    backtest_float64 = bt_class(weights, prices, 1e6, engine='loop').calculate_backtest_performance()
+    assert (backtest.holdings.dtypes == np.float32).all()
+    np.testing.assert_allclose(backtest.net_asset_value.values, backtest_float64.net_asset_value.values, rtol=1e-6)
+
+
+@pytest.mark.parametrize('kwargs', [{'slippage': 0.1}, {'fee_per_contract': 0.5}, {'trading_costs': 0.001}])
+def test_loop_engine_rejects_trading_costs(kwargs):
+    weights, prices = _make_inputs()
+    if 'trading_costs' in kwargs:
+        kwargs = {'trading_costs': pd.DataFrame(kwargs['trading_costs'], index=prices.index, columns=prices.columns)}
+    with pytest.raises(ValueError):
+        WalkForwardBtCompounding(weights, prices, 1e6, **kwargs)
+    WalkForwardBtCompounding(weights, prices, 1e6, engine='array', **kwargs)
+
+
+@pytest.mark.parametrize('bt_class', [WalkForwardBtCompounding, WalkForwardBtNoCompounding])
+def test_array_engine_matches_the_loop_engine_on_zero_weight_dates(bt_class):
+    weights, prices = _make_inputs(num_dates=60, num_markets=3)
+    weights.iloc[2:4] = 0.  # the book is flat, both engines hold nan until the next trade
+    weights.iloc[5, 1] = np.nan
+    loop = bt_class(weights, prices, 1e6, engine='loop')
+    array = bt_class(weights, prices, 1e6, engine='array')
+    loop_backtest, array_backtest = loop.calculate_backtest_performance(), array.calculate_backtest_performance()
+    assert loop.holdings.loc[weights.index[2]:weights.index[4]].iloc[:-1].isnull().all().all()
+    for name in loop_backtest.keys():
+        pd.testing.assert_frame_equal(pd.DataFrame(array_backtest[name]), pd.DataFrame(loop_backtest[name]),
+                                      rtol=1e-10, check_freq=False, check_dtype=False)
+    pd.testing.assert_frame_equal(array.holdings, loop.holdings, check_freq=False, check_dtype=False)
+    pd.testing.assert_frame_equal(array.pnl_per_instrument, loop.pnl_per_instrument, check_freq=False,
+                                  check_dtype=False)
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtesting.WalkForwardBacktest import WalkForwardBtCompounding
+from backtesting.engine import scale_weights
+
+
+def _make_weights():
+    random_state = np.random.RandomState(0)
+    weights = random_state.normal(0., 0.6, (300, 6))
+    # long and short biased rows to breach the net leverage on both sides, large entries for the position limit
+    weights[::3] = np.abs(weights[::3])
+    weights[1::3] = -np.abs(weights[1::3])
+    weights[::7, 0] = 3.
+    # nan entries, a nan row, a row without shorts and one without longs
+    weights[random_state.rand(300, 6) < 0.1] = np.nan
+    weights[5] = np.nan
+    weights[10] = np.abs(weights[10])
+    weights[11] = -np.abs(weights[11])
+    return pd.DataFrame(weights, columns=['m%d' % i for i in range(6)])
+
+
+def _scale_row_wise(weights, **settings):
+    bt = SimpleNamespace(**settings)
+    rows = [WalkForwardBtCompounding._weight_scaling_alternative(bt, row.copy()) for _, row in weights.iterrows()]
+    return pd.DataFrame(rows, index=weights.index, columns=weights.columns).values
+
+
+@pytest.mark.parametrize('max_pos_leverage, max_gross_leverage, max_net_leverage', [
+    (1, 1, 1), (0.5, 2, 0.5), (0.3, 1.5, 0.2), (10, 10, 10)])
+def test_scale_weights_matches_row_wise_scaling(max_pos_leverage, max_gross_leverage, max_net_leverage):
+    weights = _make_weights()
+    expected = _scale_row_wise(weights, constant_exposure=False, max_pos_leverage=max_pos_leverage,
+                               max_gross_leverage=max_gross_leverage, max_net_leverage=max_net_leverage)
+    scaled = scale_weights(weights.values, max_pos_leverage, max_gross_leverage, max_net_leverage)
+    np.testing.assert_allclose(scaled, expected, rtol=1e-12, atol=1e-14)
+
+
+@pytest.mark.parametrize('constant_long, constant_short', [(1, -1), (1.5, -0.5)])
+def test_scale_weights_matches_row_wise_constant_exposure(constant_long, constant_short):
+    weights = _make_weights()
+    expected = _scale_row_wise(weights, constant_exposure=True, constant_long=constant_long,
+                               constant_short=constant_short)
+    scaled = scale_weights(weights.values, constant_exposure=True, constant_long=constant_long,
+                           constant_short=constant_short)
+    np.testing.assert_allclose(scaled, expected, rtol=1e-12, atol=1e-14)
@@ -13,6 +13,7 @@ def find_first_valid_date(df):
 
 
 def find_first_valid_date_where_n_larger_one(df):
-    first_valid_dates = df.apply(lambda x: x.first_valid_index(), axis=0)
-    valid_date = first_valid_dates.sort_values()[1]
+    # first date on which more than one column had a valid value
+    n_started = df.notna().cummax().sum(axis=1)
+    valid_date = n_started.index[(n_started.values > 1).argmax()]
     return valid_date
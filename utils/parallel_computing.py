@@ -1,22 +1,34 @@
 import numpy as np
 import pandas as pd
+import atexit
+import contextlib
 import copyreg, types
+import json
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from multiprocessing import shared_memory
+import os
+import queue
 import sys
+import tempfile
+import threading
+import traceback
 import time
 import datetime as dt
 from tqdm import tqdm
 import pickle
 import swifter
 
+from utils.result_cache import hash_inputs
+
 
 # -------------------------------------
 # registry stuff for  serialization pickling/unpickling
 
 def _pickle_method(method):
-    func_name = method.im_func.__name__
-    obj = method.im_self # class instance object
-    cls = method.im_class # class that asked for the method
+    func_name = method.__func__.__name__
+    obj = method.__self__ # class instance object
+    cls = type(obj) # class that asked for the method
     return _unpickle_method, (func_name, obj, cls)
 
 
@@ -39,6 +51,32 @@ copyreg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 def expand_call(kargs):
     func = kargs['func']  # value: the function to be used (you unwrap fct from dictionary)
     del kargs['func'] # kill key-value pair (delete function from dictionary)
+    measure = kargs.pop(TELEMETRY_KEY, False) # set by enabled job_telemetry, True or the name of the molecule arg
+    input_bytes = _get_job_nbytes(func, kargs) if measure else None # before the shared args are attached
+    shared_names = dict([(key, value.spec['name']) for key, value in kargs.items() if isinstance(value, SharedArg)])
+    kargs = attach_shared_kargs(kargs) # read-only zero-copy views of args placed in shared memory by share_large_kargs
+    try:
+        return _call(func, kargs, measure, input_bytes)
+    except (ValueError, TypeError) as e:
+        if len(shared_names) == 0 or not _is_read_only_error(e):
+            raise
+    # func writes to a shared arg, it is rerun on private copies of the shared args as they were before the call
+    kargs.update([(key, _attached_shared_objs[name][1].copy()) for key, name in shared_names.items()])
+    return _call(func, kargs, measure, input_bytes)
+
+
+def _is_read_only_error(e):
+    """ True if e was raised by a write to a read-only array, pandas raises a TypeError from the numpy ValueError """
+    while e is not None:
+        if isinstance(e, ValueError) and 'read-only' in str(e):
+            return True
+        e = e.__cause__ if e.__cause__ is not None else e.__context__
+    return False
+
+
+def _call(func, kargs, measure, input_bytes):
+    if measure:
+        return run_measured_call(func, kargs, measure, input_bytes=input_bytes)
     out = func(**kargs) # execute function, this is where function execution happens, kargs includes fct + all params
     return out
 
@@ -50,11 +88,40 @@ def mp_pandas_obj(func, pd_obj, numThreads=8, mpBatches=1, lin_mols=True, **karg
     :param pd_obj: tuple where [0] is argument used to pass molecules to callback fct, list of indivisible atoms
     which will be grouped into molecules, e.g. all dates, or all features (features for aux feat importance)
     :param numThreads:
-    :param mpBatches:
-    :param lin_mols:
+    :param mpBatches: molecules per thread, with the opt-in dynamic scheduler a hint for the size of the first molecules
+    :param lin_mols: True splits by lin_parts, False by nested_parts (always split upfront)
     :param kargs:
     :return:
     """
+    out = {}
+    for part, out_ in iterate_molecule_outputs(func, pd_obj, numThreads, mpBatches, lin_mols, kargs):
+        out[part] = out_
+    out = [out[part] for part in sorted(out)]  # part order is atom order
+
+    if len(out) == 0 or not isinstance(out[0], (pd.DataFrame, pd.Series)):
+        return out
+    return concat_outputs(out)
+
+
+def iterate_molecule_outputs(func, pd_obj, numThreads=8, mpBatches=1, lin_mols=True, kargs=None, backend=None):
+    """
+    splits the atoms into molecules and yields the molecule outputs as they complete. Molecules are split upfront by
+    lin_parts / nested_parts, unless the 'dynamic' scheduler is opted in (set_scheduler) and lin_mols is True, then
+    they are handed out and sized on the fly, so molecule bounds depend on the run. Within a checkpointed_jobs block
+    molecules are split upfront, so their checkpoints match on a rerun
+    :param kargs: dict of args of func
+    :param backend: 'process', 'thread' or 'serial', defaults to get_parallel_backend()
+    :return: generator of (part, output), parts are numbered in atom order
+    """
+    if kargs is None:
+        kargs = {}
+    checkpoint = get_checkpoint()
+    if numThreads > 1 and lin_mols and get_scheduler() == 'dynamic' and checkpoint is None:
+        for part, out_ in iterate_dynamic_jobs(func, pd_obj, numThreads=numThreads, mpBatches=mpBatches,
+                                               backend=backend, **kargs):
+            yield part, out_
+        return
+
     if lin_mols:
         parts = lin_parts(len(pd_obj[1]), numThreads * mpBatches) # splits into molecules
     else:
@@ -63,48 +130,128 @@ def mp_pandas_obj(func, pd_obj, numThreads=8, mpBatches=1, lin_mols=True, **karg
     for i in range(1, len(parts)):
         job = {pd_obj[0]: pd_obj[1][parts[i - 1]: parts[i]], 'func':func}  # job contains fct, and molecule of feature
         job.update(kargs) # combine the 2 dictionaries
+        if get_telemetry() is not None:
+            job[TELEMETRY_KEY] = pd_obj[0]
         jobs.append(job)  # jobs list
         # all the jobs now set-up, callback function for each molecule and identical parametrization
-    if numThreads == 1:
-        out = process_jobs_(jobs)
+    if checkpoint is not None:
+        outputs = checkpoint.iterate_jobs(jobs, func, pd_obj, parts, kargs, numThreads=numThreads, backend=backend)
+    elif numThreads == 1:
+        outputs = iterate_serial_jobs(jobs)
     else:
-        out = process_jobs(jobs, numThreads=numThreads)
+        outputs = iterate_jobs(jobs, numThreads=numThreads, backend=backend)
+    for part, out_ in outputs:
+        yield part, out_
 
-    if isinstance(out[0], pd.DataFrame):
-        df0 = pd.DataFrame()
-    elif isinstance(out[0], pd.Series):
-        df0 = pd.Series()
-    else:
-        return out
 
-    for i in out:
-        df0 = df0.append(i) # concatenating outputs
+def concat_outputs(out):
+    """
+    single concatenation of molecule outputs in part order, sorted only if the molecules are not already
+    :param out: list of pd.DataFrame / pd.Series
+    :return: df0
+    """
+    df0 = pd.concat(out)
+    if not df0.index.is_monotonic_increasing:
+        df0 = df0.sort_index()
+    return df0
+
+
+def mp_pandas_obj_to_disk(func, pd_obj, path, numThreads=8, mpBatches=1, lin_mols=True, **kargs):
+    """
+    mp_pandas_obj for outputs too large to hold twice, each molecule output is written to path as soon as it
+    arrives and dropped from memory
+    :param func: function to be parallelized, returns a pd.DataFrame / pd.Series per molecule
+    :param pd_obj: tuple where [0] is argument used to pass molecules to callback fct, list of atoms
+    :param path: directory of the partial outputs, one pickle file per molecule
+    :param numThreads:
+    :param mpBatches:
+    :param lin_mols:
+    :param kargs:
+    :return: part_files: list of files in part order, read them back with read_outputs_from_disk
+    """
+    os.makedirs(path, exist_ok=True)
+    part_files = {}
+    for part, out_ in iterate_molecule_outputs(func, pd_obj, numThreads, mpBatches, lin_mols, kargs):
+        part_files[part] = os.path.join(path, 'part_%06d.pkl' % part)
+        pd.to_pickle(out_, part_files[part])
+        del out_
+    return [part_files[part] for part in sorted(part_files)]
 
-    return df0.sort_index()
+
+def read_outputs_from_disk(part_files):
+    """ :return: concatenation of the partial outputs of mp_pandas_obj_to_disk, as mp_pandas_obj returns it """
+    return concat_outputs([pd.read_pickle(part_file) for part_file in part_files])
 
 
 def process_jobs_(jobs):
     out = []
-    for job in jobs:
-        out_ = expand_call(job)
+    for _, out_ in iterate_serial_jobs(jobs):
         out.append(out_)
 
     return out
 
 
-def process_jobs(jobs, task=None, numThreads=8):
+def iterate_serial_jobs(jobs, task=None):
+    """ runs jobs one after the other in the calling process, :return: generator of (part, output) """
+    if task is None and len(jobs) > 0:
+        task = jobs[0]['func'].__name__
+    telemetry = get_telemetry()
+    for part, job in enumerate(jobs):
+        if telemetry is not None:
+            job.setdefault(TELEMETRY_KEY, True)
+        yield part, unwrap_measured_output(expand_call(job), part, task)
+
+
+def process_jobs(jobs, task=None, numThreads=8, backend=None):
+    """
+    :param jobs: list of job dicts, each with the func callback
+    :param task: name to print
+    :param numThreads:
+    :param backend: 'process', 'thread' or 'serial', defaults to get_parallel_backend()
+    :return: list of outputs in job order
+    """
     if task is None:
         task = jobs[0]['func'].__name__ # name to print
-    pool = mp.Pool(processes=numThreads)
-    outputs, out, time0 = pool.imap_unordered(expand_call, jobs), [], time.time()
-    for i, out_ in tqdm(enumerate(outputs, 1)):
-        out.append(out_)
-        report_progress(i, len(jobs), time0, task)
-    pool.close()
-    pool.join()
+    out = [None] * len(jobs)
+    for part, out_ in iterate_jobs(jobs, task=task, numThreads=numThreads, backend=backend):
+        out[part] = out_  # outputs are kept in part order
     return out
 
 
+def _expand_part_call(part_job):
+    part, job = part_job
+    return part, expand_call(job)
+
+
+def iterate_jobs(jobs, task=None, numThreads=8, backend=None):
+    """
+    runs jobs on an executor and yields their outputs as they complete
+    :param jobs: list of job dicts, each with the func callback
+    :param task: name to print
+    :param numThreads:
+    :param backend: 'process', 'thread' or 'serial', defaults to get_parallel_backend()
+    :return: generator of (part, output), part is the position of the job in jobs
+    """
+    if task is None:
+        task = jobs[0]['func'].__name__ # name to print
+    executor = get_executor(backend, numThreads, jobs[0]['func'] if len(jobs) > 0 else None)
+    if get_telemetry() is not None:
+        for job in jobs:
+            job.setdefault(TELEMETRY_KEY, True)
+    jobs, handles = executor.prepare_jobs(jobs)
+    try:
+        outputs, time0 = executor.imap_unordered(_expand_part_call, enumerate(jobs)), time.time()
+        # within a job_telemetry block the records replace the progress on stderr
+        is_reporting = get_telemetry() is None
+        for i, (part, out_) in tqdm(enumerate(outputs, 1), disable=not is_reporting):
+            if is_reporting:
+                report_progress(i, len(jobs), time0, task)
+            yield part, unwrap_measured_output(out_, part, task)
+    finally:
+        release_shared_kargs(handles)
+        release_executor(executor)
+
+
 def report_progress(job_num, num_jobs, time0, task):
     msg = [float(job_num)/num_jobs, (time.time() - time0)/60]
     msg.append(msg[1] * (1/msg[0]-1))
@@ -118,7 +265,7 @@ def report_progress(job_num, num_jobs, time0, task):
     return
 
 
-def process_jobs_redux(jobs, task=None, numThreads=8, redux=None, reduxArgs={}, reduxInPlace=False):
+def process_jobs_redux(jobs, task=None, numThreads=8, redux=None, reduxArgs={}, reduxInPlace=False, backend=None):
     """
     run in parallel, jobs must contain func callback, redux prevents wasting memory by reducing output on the fly
     :param jobs:
@@ -127,17 +274,23 @@ def process_jobs_redux(jobs, task=None, numThreads=8, redux=None, reduxArgs={},
     :param redux: callback to function that carries out the extension
     :param reduxArgs:
     :param reduxInPlace: whether redux should happen inplace or not (e.g. list.append is inplace as is dict update)
+    :param backend: 'process', 'thread' or 'serial', defaults to get_parallel_backend()
     :return:
     """
     if task is None:
         task = jobs[0]['func'].__name__
-    pool = mp.Pool(processes=numThreads)
-    imap, out, time0 = pool.imap_unordered(expand_call, jobs), None, time.time()
+    outputs = iterate_jobs(jobs, task=task, numThreads=numThreads, backend=backend)
+    return reduce_outputs(outputs, redux=redux, reduxArgs=reduxArgs, reduxInPlace=reduxInPlace)
+
+
+def reduce_outputs(outputs, redux=None, reduxArgs={}, reduxInPlace=False):
+    """ reduces (part, output) pairs on the fly, see process_jobs_redux """
+    out = None
     # processes asynchronous output
-    for i, out_ in enumerate(imap, 1):
+    for _, out_ in outputs:
         if out is None:
             if redux is None:
-                out, redux, reduxArgs = [out_], list.append, True
+                out, redux, reduxInPlace = [out_], list.append, True
             else:
                 import copy
                 out = copy.deepcopy(out_)
@@ -146,9 +299,6 @@ def process_jobs_redux(jobs, task=None, numThreads=8, redux=None, reduxArgs={},
                 redux(out, out_, **reduxArgs)
             else:
                 out = redux(out, out_, **reduxArgs)
-        report_progress(i, len(jobs), time0, task)
-    pool.close()
-    pool.join()
     if isinstance(out, (pd.Series, pd.DataFrame)):
         out = out.sort_index()
     return out
@@ -156,22 +306,651 @@ def process_jobs_redux(jobs, task=None, numThreads=8, redux=None, reduxArgs={},
 # enhanced mp_Pandas_obj...
 
 
-def mp_job_list(func, argList, numThreads=8, mpBatches=1., linMols=True, redux=None, reduxArgs={}, reduxInPlace=False,
-                **kargs):
-    if linMols:
-        parts = lin_parts(len(argList[1]), numThreads*mpBatches)
-    else:
-        parts = nested_parts(len(argList[1]), numThreads*mpBatches)
-    jobs = []
-    for i in range(1, len(parts)):
-        job = {argList[0]: argList[1][parts[i-1]:parts[i]], 'func': func}
-        job.update(kargs)
-        jobs.append(job)
-    out = process_jobs_redux(jobs, redux=redux, reduxArgs=reduxArgs, reduxInPlace=reduxInPlace, numThreads=numThreads)
+def mp_job_list(func, argList, numThreads=8, mpBatches=1, linMols=True, redux=None, reduxArgs={}, reduxInPlace=False,
+                backend=None, **kargs):
+    outputs = iterate_molecule_outputs(func, argList, numThreads, mpBatches, linMols, kargs, backend=backend)
+    out = reduce_outputs(outputs, redux=redux, reduxArgs=reduxArgs, reduxInPlace=reduxInPlace)
 
     return out
 
 
+# ---------------------------------
+# dynamic scheduling
+# ---------------------------------
+
+# 'static' splits the atoms upfront, 'dynamic' hands out molecules from a queue sized by the learned per atom cost.
+# Callers whose molecule functions depend on the molecule bounds must keep 'static'
+SCHEDULER = os.environ.get('PARALLEL_SCHEDULER', 'static')
+
+
+def get_scheduler():
+    return SCHEDULER
+
+
+def set_scheduler(scheduler):
+    """ :param scheduler: 'dynamic' or 'static' """
+    global SCHEDULER
+    assert scheduler in ('dynamic', 'static'), 'unknown scheduler %s' % scheduler
+    SCHEDULER = scheduler
+
+
+class DynamicMolecules(object):
+    """
+    hands out consecutive molecules of atoms (guided self-scheduling). Each molecule gets about 1 / (2 * threads) of
+    the predicted remaining work and at most 1 / (2 * threads) of the remaining atoms, so molecules shrink towards
+    the end and no straggler holds back the job. The cost
+    per atom is fitted linearly in the atom position on the completed molecules, so later atoms that are more
+    expensive (more live markets, longer barriers) get smaller molecules
+    """
+
+    def __init__(self, num_atoms, num_threads, mp_batches=1, min_seconds=0.05):
+        """
+        :param num_atoms:
+        :param num_threads:
+        :param mp_batches: hint, the first molecules (before any cost is known) hold num_atoms / (8 * threads *
+        mp_batches) atoms
+        :param min_seconds: lower bound of the predicted molecule run time, amortizes the per job overhead
+        """
+        self.num_atoms = num_atoms
+        self.num_threads = num_threads
+        self.initial_size = int(max(1, np.ceil(num_atoms / (8. * num_threads * mp_batches))))
+        self.min_seconds = min_seconds
+        self.next_start = 0
+        self.completed = []  # (start, end, seconds) per completed molecule
+
+    def record(self, start, end, seconds):
+        self.completed.append((start, end, seconds))
+
+    def _predict_atom_costs(self, start):
+        """ :return: np.array of predicted seconds per atom for the atoms from start """
+        starts, ends, seconds = np.array(self.completed, dtype=np.float64).T
+        centers = (starts + ends - 1) / 2.
+        costs = seconds / (ends - starts)
+        if len(costs) > 2 and np.ptp(centers) > 0:
+            slope, intercept = np.polyfit(centers, costs, 1)
+        else:
+            slope, intercept = 0., costs.mean()
+        predicted_costs = intercept + slope * np.arange(start, self.num_atoms)
+        return np.maximum(predicted_costs, max(costs.min(), 1e-9))
+
+    def next_molecule(self):
+        """ :return: (start, end) positions of the next molecule, None if all atoms are handed out """
+        start = self.next_start
+        if start >= self.num_atoms:
+            return None
+        if len(self.completed) == 0:
+            size = self.initial_size
+        else:
+            cumulative_costs = np.cumsum(self._predict_atom_costs(start))
+            target_seconds = max(cumulative_costs[-1] / (2. * self.num_threads), self.min_seconds)
+            size = int(np.searchsorted(cumulative_costs, target_seconds)) + 1
+            # never more than the guided share of the remaining atoms, in case the cost model is off
+            size = min(size, int(np.ceil((self.num_atoms - start) / (2. * self.num_threads))))
+        self.next_start = min(start + size, self.num_atoms)
+        return start, self.next_start
+
+
+def _expand_timed_call(part_job):
+    part, job = part_job
+    time0 = time.time()
+    out = expand_call(job)
+    return part, time.time() - time0, out
+
+
+def iterate_dynamic_jobs(func, pd_obj, numThreads=8, mpBatches=1, task=None, backend=None, **kargs):
+    """
+    runs func on molecules handed out by DynamicMolecules, at most 2 * numThreads molecules are in flight
+    :param func: function to be parallelized
+    :param pd_obj: tuple where [0] is argument used to pass molecules to callback fct, list of atoms
+    :param numThreads:
+    :param mpBatches: hint for the size of the first molecules
+    :param task: name to print
+    :param backend: 'process', 'thread' or 'serial', defaults to get_parallel_backend()
+    :param kargs: args of func
+    :return: generator of (part, output), parts are numbered in atom order
+    """
+    if task is None:
+        task = func.__name__
+    executor = get_executor(backend, numThreads, func)
+    shared_kargs, handles = executor.prepare_jobs([kargs])
+    molecules = DynamicMolecules(len(pd_obj[1]), numThreads, mpBatches)
+    results, pending, part, num_done, time0 = queue.Queue(), {}, 0, 0, time.time()
+    try:
+        while True:
+            while len(pending) < 2 * numThreads:
+                bounds = molecules.next_molecule()
+                if bounds is None:
+                    break
+                job = {pd_obj[0]: pd_obj[1][bounds[0]: bounds[1]], 'func': func}
+                job.update(shared_kargs[0])
+                if get_telemetry() is not None:
+                    job[TELEMETRY_KEY] = pd_obj[0]
+                pending[part] = bounds
+                executor.apply_async(_expand_timed_call, (part, job), results.put)
+                part += 1
+            if len(pending) == 0:
+                break
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            part_, seconds, out_ = result
+            start, end = pending.pop(part_)
+            molecules.record(start, end, seconds)
+            num_done += end - start
+            if get_telemetry() is None:
+                report_progress(num_done, molecules.num_atoms, time0, task)
+            yield part_, unwrap_measured_output(out_, part_, task)
+    finally:
+        release_shared_kargs(handles)
+        release_executor(executor)
+
+
+# ---------------------------------
+# checkpointing
+# ---------------------------------
+
+# JobCheckpoint of the enclosing checkpointed_jobs block
+_checkpoint = None
+
+
+class CaughtError(object):
+    """ output of a job that raised, holds the formatted traceback """
+
+    def __init__(self, error, trace):
+        self.error = error
+        self.trace = trace
+
+
+class CatchErrors(object):
+    """ wraps a job func so an exception is returned as CaughtError instead of killing the pool """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = getattr(func, '__name__', 'job')
+
+    def __call__(self, **kargs):
+        try:
+            return self.func(**kargs)
+        except Exception as e:
+            return CaughtError(repr(e), traceback.format_exc())
+
+
+class JobCheckpoint(object):
+    """
+    persists the output of each completed molecule in job_dir, keyed by the function, the molecule bounds and a hash
+    of the args (frames and arrays by content, other args by repr). On a rerun completed molecules are loaded
+    instead of computed, failed molecules are retried and molecules that still fail are collected in a report
+    """
+
+    def __init__(self, job_dir, retries=2):
+        """
+        :param job_dir: directory of the molecule outputs
+        :param retries: number of times a failed molecule is rerun
+        """
+        self.job_dir = job_dir
+        self.retries = retries
+        self.failures = []
+        os.makedirs(job_dir, exist_ok=True)
+
+    @staticmethod
+    def _get_func_state(func):
+        """ name of func and, for a bound method, the simple attributes of its instance (e.g. window length) """
+        state = {'func': getattr(func, '__module__', '') + '.' + getattr(func, '__qualname__', repr(func))}
+        instance = getattr(func, '__self__', None)
+        if instance is not None and hasattr(instance, '__dict__'):
+            for key, value in vars(instance).items():
+                if value is None or isinstance(value, (bool, int, float, str, tuple, np.dtype)):
+                    state[key] = value
+        return state
+
+    def get_keys(self, func, atoms, parts, kargs):
+        """ :return: list of keys, one per molecule atoms[parts[i - 1]: parts[i]] """
+        args_hash = hash_inputs(**kargs)
+        func_state = self._get_func_state(func)
+        keys = []
+        for i in range(1, len(parts)):
+            first_atom, last_atom = self._get_first_and_last_atom(atoms[parts[i - 1]: parts[i]])
+            bounds = (parts[i - 1], parts[i], repr(first_atom), repr(last_atom))
+            keys.append(hash_inputs(func_state, bounds=bounds, args=args_hash))
+        return keys
+
+    @staticmethod
+    def _get_first_and_last_atom(molecule):
+        molecule = np.asarray(molecule)
+        if len(molecule) == 0:
+            return None, None
+        return molecule[0], molecule[-1]
+
+    def _get_path(self, key):
+        return os.path.join(self.job_dir, key + '.pkl')
+
+    def iterate_jobs(self, jobs, func, pd_obj, parts, kargs, numThreads=8, backend=None):
+        """
+        :param jobs: list of job dicts of the molecules pd_obj[1][parts[i - 1]: parts[i]]
+        :param func: function of the jobs
+        :param pd_obj: tuple of the molecule argument name and the atoms
+        :param parts: molecule bounds from lin_parts / nested_parts
+        :param kargs: args of func
+        :return: generator of (part, output) of the completed molecules
+        """
+        keys = self.get_keys(func, pd_obj[1], parts, kargs)
+        pending = []
+        for part, key in enumerate(keys):
+            if os.path.exists(self._get_path(key)):
+                yield part, pd.read_pickle(self._get_path(key))
+            else:
+                pending.append(part)
+
+        attempts = dict([(part, 0) for part in pending])
+        errors = {}
+        while len(pending) > 0:
+            round_jobs = []
+            for part in pending:
+                job = dict(jobs[part])
+                job['func'] = CatchErrors(func)
+                round_jobs.append(job)
+                attempts[part] += 1
+            if numThreads == 1:
+                outputs = iterate_serial_jobs(round_jobs)
+            else:
+                outputs = iterate_jobs(round_jobs, numThreads=numThreads, backend=backend)
+            failed = []
+            for i, out_ in outputs:
+                part = pending[i]
+                if isinstance(out_, CaughtError):
+                    errors[part] = out_
+                    if attempts[part] <= self.retries:
+                        failed.append(part)
+                    continue
+                errors.pop(part, None)
+                # write then rename, a crash never leaves a partial checkpoint
+                tmp_path = self._get_path(keys[part]) + '.tmp'
+                pd.to_pickle(out_, tmp_path)
+                os.replace(tmp_path, self._get_path(keys[part]))
+                yield part, out_
+            pending = sorted(failed)
+
+        for part in sorted(errors):
+            first_atom, last_atom = self._get_first_and_last_atom(jobs[part][pd_obj[0]])
+            self.failures.append({'part': part, 'first_atom': first_atom, 'last_atom': last_atom,
+                                  'attempts': attempts[part], 'error': errors[part].error,
+                                  'traceback': errors[part].trace})
+        report_path = os.path.join(self.job_dir, 'failures.csv')
+        if len(errors) > 0:
+            self.report().to_csv(report_path, index=False)
+        elif os.path.exists(report_path):
+            os.remove(report_path)
+
+    def report(self):
+        """ :return: pd.DataFrame, one row per molecule that failed after all retries """
+        return pd.DataFrame(self.failures, columns=['part', 'first_atom', 'last_atom', 'attempts', 'error',
+                                                    'traceback'])
+
+
+def get_checkpoint():
+    return _checkpoint
+
+
+@contextlib.contextmanager
+def checkpointed_jobs(job_dir, retries=2):
+    """
+    mp_pandas_obj / mp_job_list calls within the block persist molecule outputs in job_dir, skip molecules completed
+    by an earlier run and retry failed ones. Molecules that still fail are left out of the result and reported:
+
+        with checkpointed_jobs('./jobs/hrp') as checkpoint:
+            weights = mp_pandas_obj(...)
+        checkpoint.report()
+
+    :param job_dir: directory of the molecule outputs
+    :param retries: number of times a failed molecule is rerun
+    :return: JobCheckpoint
+    """
+    global _checkpoint
+    previous_checkpoint = _checkpoint
+    _checkpoint = JobCheckpoint(job_dir, retries=retries)
+    try:
+        yield _checkpoint
+    finally:
+        _checkpoint = previous_checkpoint
+
+
+# ---------------------------------
+# telemetry
+# ---------------------------------
+
+# job key of the flag that makes expand_call measure the job
+TELEMETRY_KEY = '__telemetry__'
+
+# JobTelemetry of the enclosing job_telemetry block
+_telemetry = None
+
+
+class MeasuredOutput(object):
+    """ output of a measured job together with its record """
+
+    def __init__(self, out, record):
+        self.out = out
+        self.record = record
+
+
+def _get_nbytes(obj):
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    return sys.getsizeof(obj)
+
+
+def _get_job_nbytes(func, kargs):
+    """
+    bytes a job ships to a worker process, its pickled size with args placed in shared memory counting as their
+    handle. Falls back to the in memory size of the args where func or an arg can not be pickled
+    """
+    try:
+        return len(pickle.dumps((func, kargs), protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sum([_get_nbytes(value) for value in kargs.values()])
+
+
+def _read_rss_mb():
+    """ current and peak resident memory of the process in mb from /proc, (None, None) where it is not available """
+    rss = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    rss[line[:5]] = int(line.split()[1]) / 1024.
+    except (OSError, ValueError):
+        return None, None
+    return rss.get('VmRSS'), rss.get('VmHWM')
+
+
+def _reset_peak_rss():
+    """ resets the peak rss of the process to its current rss (linux), :return: True if it was reset """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _get_max_rss_mb():
+    """ lifetime peak resident memory of the process, None where the resource module is not available """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return max_rss / 1024. ** 2 if sys.platform == 'darwin' else max_rss / 1024.
+
+
+def run_measured_call(func, kargs, molecule_name=True, input_bytes=None):
+    """
+    runs func(**kargs) and records wall time, cpu time, input and output sizes and the memory of the job. Jobs
+    running in a thread of a pool record the cpu time of their thread, else of their process. rss_delta_mb is the
+    change of the resident memory over the job, peak_rss_delta_mb the peak above the memory at the start of the job.
+    The peak is reset per job where the os allows it, else it is only known if the job raises the lifetime peak of
+    the worker. Threads share the memory of their process, so thread jobs record no memory
+    :param molecule_name: name of the molecule arg, its size and first / last atoms are recorded
+    :param input_bytes: bytes shipped with the job, defaults to the in memory size of kargs
+    :return: MeasuredOutput
+    """
+    is_thread_job = threading.current_thread() is not threading.main_thread()
+    cpu_clock = time.thread_time if is_thread_job else time.process_time
+    is_peak_reset = not is_thread_job and _reset_peak_rss()
+    max_rss0 = _get_max_rss_mb()
+    rss0 = None if is_thread_job else _read_rss_mb()[0]
+    time0, cpu_time0 = time.time(), cpu_clock()
+    out = func(**kargs)
+    wall_time, cpu_time = time.time() - time0, cpu_clock() - cpu_time0
+    rss1, peak_rss1 = _read_rss_mb()
+    max_rss1 = _get_max_rss_mb()
+    if rss0 is None:
+        peak_rss = None
+    elif is_peak_reset:
+        peak_rss = peak_rss1
+    else:
+        peak_rss = max_rss1 if max_rss0 is not None and max_rss1 > max_rss0 else None
+    if input_bytes is None:
+        input_bytes = sum([_get_nbytes(value) for value in kargs.values()])
+    record = {'pid': os.getpid(), 'start_time': time0, 'wall_time': wall_time, 'cpu_time': cpu_time,
+              'input_bytes': input_bytes, 'output_bytes': _get_nbytes(out),
+              'rss_delta_mb': rss1 - rss0 if rss0 is not None else None,
+              'peak_rss_delta_mb': peak_rss - rss0 if peak_rss is not None else None}
+    if molecule_name is not True and molecule_name in kargs:
+        molecule = np.asarray(kargs[molecule_name])
+        record['num_atoms'] = len(molecule)
+        record['first_atom'] = str(molecule[0]) if len(molecule) > 0 else None
+        record['last_atom'] = str(molecule[-1]) if len(molecule) > 0 else None
+    return MeasuredOutput(out, record)
+
+
+def unwrap_measured_output(out, part, task):
+    """ records a MeasuredOutput in the enclosing job_telemetry block, :return: the output of the job """
+    if not isinstance(out, MeasuredOutput):
+        return out
+    if _telemetry is not None:
+        record = {'task': task, 'part': part}
+        record.update(out.record)
+        _telemetry.add(record)
+    return out.out
+
+
+class JobTelemetry(object):
+    """ per job records of the parallel calls within a job_telemetry block """
+
+    def __init__(self, jsonl_path=None):
+        """ :param jsonl_path: file each record is appended to as a json line, None keeps records in memory only """
+        self.jsonl_path = jsonl_path
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def to_frame(self):
+        """ :return: pd.DataFrame, one row per job """
+        return pd.DataFrame(self.records)
+
+
+def get_telemetry():
+    return _telemetry
+
+
+@contextlib.contextmanager
+def job_telemetry(jsonl_path=None):
+    """
+    records wall time, cpu time, input / output bytes and memory of every job run within the block, in place of the
+    progress written to stderr:
+
+        with job_telemetry('hrp_jobs.jsonl') as telemetry:
+            weights = mp_pandas_obj(...)
+        telemetry.to_frame()
+
+    :param jsonl_path: file each record is appended to as a json line
+    :return: JobTelemetry
+    """
+    global _telemetry
+    previous_telemetry = _telemetry
+    _telemetry = JobTelemetry(jsonl_path=jsonl_path)
+    try:
+        yield _telemetry
+    finally:
+        _telemetry = previous_telemetry
+
+
+# ---------------------------------
+# executors
+# ---------------------------------
+
+# default backend of process_jobs / process_jobs_redux / mp_pandas_obj, overridden by the PARALLEL_BACKEND env
+# variable, set_parallel_backend or per call with the parallel_backend context manager
+PARALLEL_BACKEND = os.environ.get('PARALLEL_BACKEND', 'process')
+
+# persistent executors by (backend, number of workers). Forked workers keep the modules as they were when the pool
+# started, set PARALLEL_PERSISTENT=0 or set_persistent_executors(False) to start a new pool for every call
+_executors = {}
+PERSISTENT_EXECUTORS = os.environ.get('PARALLEL_PERSISTENT', '1') != '0'
+
+
+class SerialExecutor(object):
+    """ runs jobs one after the other in the calling process """
+
+    def __init__(self, num_threads=1):
+        self.num_threads = 1
+
+    def prepare_jobs(self, jobs):
+        return jobs, []
+
+    def imap_unordered(self, func, jobs):
+        return map(func, jobs)
+
+    def apply_async(self, func, args, callback):
+        """ calls callback with the result of func(args), or with the exception raised """
+        try:
+            result = func(args)
+        except Exception as e:
+            result = e
+        callback(result)
+
+    def shutdown(self):
+        return
+
+
+class ThreadExecutor(SerialExecutor):
+    """ persistent thread pool, for numpy / scipy kernels that release the GIL. Args are shared, never copied """
+
+    def __init__(self, num_threads=8):
+        self.num_threads = num_threads
+        self.pool = None
+
+    def _get_pool(self):
+        return ThreadPool(processes=self.num_threads)
+
+    def imap_unordered(self, func, jobs):
+        if self.pool is None:
+            self.pool = self._get_pool()
+        return self.pool.imap_unordered(func, jobs)
+
+    def apply_async(self, func, args, callback):
+        if self.pool is None:
+            self.pool = self._get_pool()
+        self.pool.apply_async(func, (args,), callback=callback, error_callback=callback)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class ProcessExecutor(ThreadExecutor):
+    """
+    persistent process pool, started on first use and reused across calls. Large args go through shared memory.
+    Workers only know the modules as they were when the pool started: the pool is restarted for a function defined in
+    __main__ once __main__ changed, e.g. a function defined or redefined in a script or notebook after the first
+    parallel call. Later changes to the globals of other modules need shutdown_executors() or non persistent
+    executors (set_persistent_executors)
+    """
+
+    def __init__(self, num_threads=8):
+        super(ProcessExecutor, self).__init__(num_threads)
+        self.main_namespace = None  # ids of the __main__ globals when the pool started
+
+    def _get_pool(self):
+        self.main_namespace = _get_main_namespace()
+        return mp.Pool(processes=self.num_threads)
+
+    def refresh(self, func):
+        """ restarts the pool if func is defined in __main__ and __main__ changed since the pool started """
+        if self.pool is not None and getattr(func, '__module__', None) == '__main__' and \
+                _get_main_namespace() != self.main_namespace:
+            self.shutdown()
+
+    def prepare_jobs(self, jobs):
+        # large args are placed once in shared memory instead of being pickled into every job
+        return share_large_job_args(jobs)
+
+
+def _get_main_namespace():
+    main = sys.modules.get('__main__')
+    return {} if main is None else {name: id(value) for name, value in vars(main).items()}
+
+
+executor_classes = {'process': ProcessExecutor, 'thread': ThreadExecutor, 'serial': SerialExecutor}
+
+
+def get_parallel_backend():
+    return PARALLEL_BACKEND
+
+
+def set_parallel_backend(backend):
+    """ :param backend: 'process', 'thread' or 'serial' """
+    global PARALLEL_BACKEND
+    assert backend in executor_classes, 'unknown parallel backend %s' % backend
+    PARALLEL_BACKEND = backend
+
+
+@contextlib.contextmanager
+def parallel_backend(backend):
+    """ sets the backend within a with block, e.g. for one mp_pandas_obj call """
+    previous_backend = get_parallel_backend()
+    set_parallel_backend(backend)
+    try:
+        yield
+    finally:
+        set_parallel_backend(previous_backend)
+
+
+def get_executor(backend=None, num_threads=8, func=None):
+    """
+    persistent executor of a backend, created on first use
+    :param backend: 'process', 'thread' or 'serial', defaults to get_parallel_backend()
+    :param num_threads: number of workers
+    :param func: job function, a process pool that does not know it is restarted
+    :return: executor
+    """
+    if backend is None:
+        backend = get_parallel_backend()
+    assert backend in executor_classes, 'unknown parallel backend %s' % backend
+    key = (backend, num_threads)
+    if key not in _executors:
+        _executors[key] = executor_classes[backend](num_threads)
+    if func is not None and isinstance(_executors[key], ProcessExecutor):
+        _executors[key].refresh(func)
+    return _executors[key]
+
+
+def release_executor(executor):
+    """ shuts the pool of executor down after a call, unless executors are persistent """
+    if not PERSISTENT_EXECUTORS:
+        executor.shutdown()
+
+
+def set_persistent_executors(persistent):
+    """ :param persistent: False starts a new pool for every call, so workers always see the current modules """
+    global PERSISTENT_EXECUTORS
+    PERSISTENT_EXECUTORS = persistent
+    if not persistent:
+        shutdown_executors()
+
+
+def shutdown_executors():
+    """ closes all persistent pools """
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+atexit.register(shutdown_executors)
+
+
 def lin_parts(num_atoms, num_threads):
     parts = np.linspace(0, num_atoms, min(num_threads, num_atoms) + 1)
     parts = np.ceil(parts).astype(int)
@@ -188,4 +967,179 @@ def nested_parts(num_atoms, num_threads, upper_triang=False):
     if upper_triang:
         parts = np.cumsum(np.diff(parts)[::-1])
         parts = np.append(np.array([0]), parts)
-    return parts
\ No newline at end of file
+    return parts
+
+
+# ---------------------------------
+# shared memory
+# ---------------------------------
+
+# numpy / pandas args of at least SHARE_MIN_BYTES are passed to workers through shared memory
+SHARE_MIN_BYTES = 1024 ** 2
+# 'shm' for multiprocessing.shared_memory blocks, 'mmap' for memory-mapped .npy files in SHARE_MMAP_DIR
+SHARE_BACKEND = 'shm'
+SHARE_MMAP_DIR = None
+
+# blocks a worker process has attached to, by name, so every block is attached once per process
+_attached_shared_objs = {}
+
+
+class SharedArg(object):
+    """ placeholder of a job argument whose values live in a shared memory block or a memory-mapped file """
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+def share_array(values, backend=None):
+    """
+    copies an array once into a shared memory block or a memory-mapped file
+    :param values: np.array
+    :param backend: 'shm' or 'mmap', defaults to SHARE_BACKEND
+    :return: handle: the block or file path (the owner releases it with release_shared_array), spec: picklable dict
+    """
+    if backend is None:
+        backend = SHARE_BACKEND
+    values = np.ascontiguousarray(values)
+    if backend == 'shm':
+        handle = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        buffer = np.ndarray(values.shape, dtype=values.dtype, buffer=handle.buf)
+        buffer[:] = values
+        spec = {'backend': backend, 'name': handle.name, 'shape': values.shape, 'dtype': values.dtype.str}
+    else:
+        assert backend == 'mmap', 'unknown shared memory backend %s' % backend
+        fd, handle = tempfile.mkstemp(suffix='.npy', dir=SHARE_MMAP_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, values)
+        spec = {'backend': backend, 'name': handle}
+    return handle, spec
+
+
+def attach_array(spec):
+    """
+    :param spec: dict from share_array
+    :return: handle: the attached block (kept alive while the array is used), values: read-only zero-copy np.array
+    """
+    if spec['backend'] == 'shm':
+        handle = shared_memory.SharedMemory(name=spec['name'])
+        values = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=handle.buf)
+    else:
+        handle = None
+        values = np.load(spec['name'], mmap_mode='r')
+    values.flags.writeable = False
+    return handle, values
+
+
+def release_shared_array(handle):
+    if isinstance(handle, shared_memory.SharedMemory):
+        handle.close()
+        handle.unlink()
+    elif handle is not None and os.path.exists(handle):
+        os.remove(handle)
+
+
+def share_pandas_obj(pd_obj, backend=None):
+    """
+    copies the values of a numeric dataframe/series once into a shared memory block
+    :param pd_obj: pd.DataFrame or pd.Series
+    :param backend: 'shm' or 'mmap', defaults to SHARE_BACKEND
+    :return: handle: the SharedMemory block or file (the owner releases it), spec: picklable dict to attach to it
+    """
+    handle, spec = share_array(pd_obj.values, backend=backend)
+    spec['index'] = pd_obj.index
+    if isinstance(pd_obj, pd.DataFrame):
+        spec['columns'] = pd_obj.columns
+    else:
+        spec['series_name'] = pd_obj.name
+    return handle, spec
+
+
+def attach_shared_pandas_obj(spec):
+    """
+    rebuilds a zero-copy dataframe/series on a shared memory block created by share_pandas_obj
+    :param spec: dict from share_pandas_obj
+    :return: handle: the attached block (the caller keeps it alive while the object is used), pd_obj
+    """
+    handle, values = attach_array(spec)
+    if 'columns' in spec:
+        pd_obj = pd.DataFrame(values, index=spec['index'], columns=spec['columns'], copy=False)
+    elif 'index' in spec:
+        pd_obj = pd.Series(values, index=spec['index'], name=spec['series_name'], copy=False)
+    else:
+        pd_obj = values
+    return handle, pd_obj
+
+
+def _is_shareable(obj, min_bytes):
+    """ numeric arrays and single dtype numeric frames / series of at least min_bytes """
+    if isinstance(obj, pd.DataFrame):
+        if obj.shape[1] == 0 or len(set(obj.dtypes)) != 1:
+            return False
+        dtype = obj.dtypes.iloc[0]
+    elif isinstance(obj, (pd.Series, np.ndarray)):
+        dtype = obj.dtype
+    else:
+        return False
+    if not isinstance(dtype, np.dtype) or dtype.kind not in 'biuf':
+        return False
+    return obj.size * dtype.itemsize >= min_bytes
+
+
+def share_large_job_args(jobs, min_bytes=None):
+    """
+    replaces large numpy / pandas args by SharedArg placeholders, resolved in the workers by attach_shared_kargs.
+    An object passed to several jobs is shared once. The workers get read-only views, a job that writes to one is
+    rerun on private copies by expand_call
+    :param jobs: list of job dicts
+    :param min_bytes: size from which args are shared, defaults to SHARE_MIN_BYTES
+    :return: shared_jobs: list of job dicts, handles: list of blocks / files to release with release_shared_kargs
+    """
+    if min_bytes is None:
+        min_bytes = SHARE_MIN_BYTES
+    shared_args, shared_jobs, handles = {}, [], []
+    for job in jobs:
+        shared_job = {}
+        for key, value in job.items():
+            if id(value) not in shared_args and _is_shareable(value, min_bytes):
+                if isinstance(value, np.ndarray):
+                    handle, spec = share_array(value)
+                else:
+                    handle, spec = share_pandas_obj(value)
+                shared_args[id(value)] = SharedArg(spec)
+                handles.append(handle)
+            shared_job[key] = shared_args[id(value)] if id(value) in shared_args else value
+        shared_jobs.append(shared_job)
+    return shared_jobs, handles
+
+
+def share_large_kargs(kargs, min_bytes=None):
+    """ share_large_job_args of a single dict of args """
+    shared_kargs, handles = share_large_job_args([kargs], min_bytes=min_bytes)
+    return shared_kargs[0], handles
+
+
+def attach_shared_kargs(kargs):
+    """ resolves SharedArg placeholders to zero-copy objects, each block is attached once per process """
+    names = set([value.spec['name'] for value in kargs.values() if isinstance(value, SharedArg)])
+    # blocks of earlier calls are no longer needed by this process
+    for name in set(_attached_shared_objs) - names:
+        handle, _ = _attached_shared_objs.pop(name)
+        if handle is not None:
+            try:
+                handle.close()
+            except BufferError:
+                pass  # still referenced by a live object, the block is freed once that is collected
+    for key, value in kargs.items():
+        if isinstance(value, SharedArg):
+            name = value.spec['name']
+            if name not in _attached_shared_objs:
+                _attached_shared_objs[name] = attach_shared_pandas_obj(value.spec)
+            # every job gets its own object on the block, so columns a job adds do not leak into the next job
+            shared_obj = _attached_shared_objs[name][1]
+            kargs[key] = shared_obj.view() if isinstance(shared_obj, np.ndarray) else shared_obj.copy(deep=False)
+    return kargs
+
+
+def release_shared_kargs(handles):
+    for handle in handles:
+        release_shared_array(handle)
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+
+def get_rebalance_dates(index, schedule='daily'):
+    """
+    dates of index on which a portfolio is rebalanced
+    :param index: pd.DatetimeIndex of trading dates, e.g. the optimization dates of a portfolio constructor
+    :param schedule: 'daily', 'weekly' (last trading date of each week), 'month_end' (last trading date of each month)
+    or a pd.DatetimeIndex of custom dates, each snapped to the last trading date on or before it
+    :return: pd.DatetimeIndex, subset of index
+    """
+    index = pd.DatetimeIndex(index)
+    if isinstance(schedule, str):
+        if schedule == 'daily':
+            return index
+        assert schedule in ('weekly', 'month_end'), "schedule %s not supported" % schedule
+        periods = index.to_period('W' if schedule == 'weekly' else 'M')
+        is_last_of_period = np.append(periods[1:] != periods[:-1], True)
+        return index[is_last_of_period]
+    positions = index.searchsorted(pd.DatetimeIndex(schedule), side='right') - 1
+    return index[np.unique(positions[positions >= 0])]
+
+
+def forward_fill_weights(weights, index, fill_value=0.):
+    """
+    weights of the rebalance dates held until the next rebalance date
+    :param weights: pd.DataFrame of weights indexed by rebalance dates
+    :param index: pd.DatetimeIndex the weights are aligned to, e.g. the return index
+    :param fill_value: weight before the first rebalance date and of nan weights, None keeps them nan
+    :return: pd.DataFrame of weights indexed by index
+    """
+    weights = weights.reindex(index, method='ffill')
+    if fill_value is not None:
+        weights = weights.fillna(fill_value)
+    return weights
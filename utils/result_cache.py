@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.dataset import DataSet
+
+
+# ---------------------------------
+# content hashing
+# ---------------------------------
+
+
+def _update_hash(hasher, obj):
+    """ feeds an input (frame, series, index, array or scalar/param) into the hasher """
+    if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        hasher.update(type(obj).__name__.encode())
+        hasher.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        if isinstance(obj, pd.DataFrame):
+            hasher.update(repr(list(obj.columns)).encode())
+            hasher.update(repr(list(obj.dtypes.astype(str))).encode())
+    elif isinstance(obj, np.ndarray):
+        hasher.update(repr((obj.shape, str(obj.dtype))).encode())
+        hasher.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            hasher.update(str(key).encode())
+            _update_hash(hasher, obj[key])
+    else:
+        hasher.update(repr(obj).encode())
+
+
+def hash_inputs(*args, **params):
+    """
+    content hash of input frames and parameters, equal inputs give equal keys across sessions
+    :param args: pd.DataFrame, pd.Series, np.array or scalars
+    :param params: named parameters, e.g. window, leverage limits, cleaning flag, compounding mode
+    :return: key: hex string
+    """
+    hasher = hashlib.sha256()
+    for arg in args:
+        _update_hash(hasher, arg)
+    _update_hash(hasher, params)
+    return hasher.hexdigest()
+
+
+# ---------------------------------
+# persistent cache
+# ---------------------------------
+
+
+class ResultCache(object):
+    """
+    on-disk cache of result frames, one directory per key with one parquet file per frame. The cache is bounded in
+    size, the least recently used entries are evicted first (usage is tracked with the directory modification time)
+    """
+
+    def __init__(self, cache_dir='./cache', max_size_bytes=2 * 1024 ** 3):
+        """
+        :param cache_dir: root directory of the cache
+        :param max_size_bytes: scalar, total size of the cache after which entries are evicted
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(*args, **params):
+        return hash_inputs(*args, **params)
+
+    def _entry_path(self, key):
+        return self.cache_dir.joinpath(key)
+
+    def __contains__(self, key):
+        return self._entry_path(key).joinpath('meta.json').exists()
+
+    def get(self, key):
+        """
+        :param key: from make_key
+        :return: DataSet of name: pd.DataFrame / pd.Series, None if the key is not cached
+        """
+        if key not in self:
+            return None
+        path = self._entry_path(key)
+        with open(path.joinpath('meta.json')) as f:
+            meta = json.load(f)
+        results = DataSet()
+        for name, info in meta.items():
+            df = pd.read_parquet(path.joinpath(name + '.parquet'))
+            if info['columns'] is not None:
+                df.columns = pd.Index(info['columns'])
+            if info['type'] == 'series':
+                df = df.iloc[:, 0]
+                df.name = info['name']
+            results[name] = df
+        # mark as recently used
+        now = time.time()
+        os.utime(path, (now, now))
+        return results
+
+    def put(self, key, results):
+        """
+        :param key: from make_key
+        :param results: dict of name: pd.DataFrame / pd.Series
+        :return:
+        """
+        path = self._entry_path(key)
+        tmp_path = self.cache_dir.joinpath(key + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        meta = {}
+        for name, df in results.items():
+            if isinstance(df, pd.Series):
+                meta[name] = {'type': 'series', 'name': df.name, 'columns': None}
+                df = df.to_frame(name='value')
+            else:
+                # parquet needs string column names, the original ones are restored from meta
+                columns = list(df.columns)
+                meta[name] = {'type': 'frame', 'name': None,
+                              'columns': columns if all([isinstance(c, (str, int)) for c in columns]) else None}
+                df = df.copy()
+                df.columns = df.columns.astype(str)
+            df.to_parquet(tmp_path.joinpath(name + '.parquet'))
+        with open(tmp_path.joinpath('meta.json'), 'w') as f:
+            json.dump(meta, f)
+        # the entry only becomes visible once complete
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _entry_sizes(self):
+        sizes = {}
+        for path in self.cache_dir.iterdir():
+            if path.is_dir() and not path.name.endswith('.tmp'):
+                sizes[path] = sum([f.stat().st_size for f in path.iterdir()])
+        return sizes
+
+    def _evict(self):
+        """ removes least recently used entries until the cache is within max_size_bytes """
+        sizes = self._entry_sizes()
+        total_size = sum(sizes.values())
+        for path in sorted(sizes, key=lambda x: x.stat().st_mtime):
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= sizes[path]
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
@@ -1,10 +1,141 @@
+import numpy as np
 import pandas as pd
 
 
 def find_universe_tickers(df_prices):
     """ function to get markets in universe as they expand """
-    first_valid_indices = df_prices.apply(lambda x: x.first_valid_index())
-    is_live_market = pd.DataFrame(index=df_prices.index, columns=df_prices.columns)
-    is_live_market = is_live_market.apply(lambda x: x.name >= first_valid_indices, axis=1)
+    # a market is live from its first valid price onwards
+    is_live_market = df_prices.notna().cummax()
 
     return is_live_market
+
+
+class UniverseMembership(object):
+    """
+    point in time universe of a price panel, built once and shared by the portfolio constructors and the backtester.
+    Per asset it holds the first and last live positions, optionally an inclusion mask. The distinct sets of live
+    columns are stored once as integer arrays and each date points to its set, so the live columns at a date are a
+    lookup. As find_universe_tickers an asset is by default live from its first valid price onwards
+    """
+
+    def __init__(self, index, columns, first_live, last_live, is_included=None):
+        """
+        :param index: pd.DatetimeIndex of the dates
+        :param columns: pd.Index of the assets
+        :param first_live: np.array (N,) of the first live position per asset, len(index) if never live
+        :param last_live: np.array (N,) of the last live position per asset
+        :param is_included: optional boolean np.array (T, N), assets are live only where it is True
+        """
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+        self.first_live = np.asarray(first_live, dtype=np.int64)
+        self.last_live = np.asarray(last_live, dtype=np.int64)
+        positions = np.arange(len(self.index))[:, None]
+        is_live = (positions >= self.first_live) & (positions <= self.last_live)
+        self.has_inclusion_rule = is_included is not None
+        if is_included is not None:
+            is_live &= np.asarray(is_included, dtype=bool)
+        # a new set starts at every date where the membership changes
+        is_new_set = np.ones(len(self.index), dtype=bool)
+        is_new_set[1:] = (is_live[1:] != is_live[:-1]).any(axis=1)
+        self.set_ids = np.cumsum(is_new_set) - 1
+        self.live_sets = [np.flatnonzero(is_live[t]) for t in np.flatnonzero(is_new_set)]
+
+    @classmethod
+    def from_prices(cls, prices, delisting_dates=None, inclusion_rule=None, until_last_valid=False):
+        """
+        :param prices: pd.DataFrame of prices (or returns), an asset is live from its first valid value on
+        :param delisting_dates: pd.Series of delisting dates by asset (NaT if not delisted), an asset is not live
+        from its delisting date on
+        :param inclusion_rule: boolean pd.DataFrame or function of prices returning one, e.g. a minimum history or
+        liquidity filter, assets are live only where it is True
+        :param until_last_valid: if True an asset is not live after its last valid value, e.g. for a panel whose
+        delisted assets stop with nan, else it stays live until the last date
+        :return: UniverseMembership
+        """
+        is_valid = prices.notna().values
+        n_dates = is_valid.shape[0]
+        has_valid = is_valid.any(axis=0)
+        first_live = np.where(has_valid, is_valid.argmax(axis=0), n_dates)
+        if until_last_valid:
+            last_live = np.where(has_valid, n_dates - 1 - is_valid[::-1].argmax(axis=0), -1)
+        else:
+            last_live = np.full(len(first_live), n_dates - 1)
+        if delisting_dates is not None:
+            delisting_dates = pd.Series(delisting_dates).reindex(prices.columns)
+            is_delisted = delisting_dates.notna().values
+            delisting_positions = prices.index.searchsorted(pd.DatetimeIndex(delisting_dates[is_delisted]))
+            last_live[is_delisted] = np.minimum(last_live[is_delisted], delisting_positions - 1)
+        is_included = None
+        if inclusion_rule is not None:
+            if callable(inclusion_rule):
+                inclusion_rule = inclusion_rule(prices)
+            is_included = inclusion_rule.reindex(index=prices.index, columns=prices.columns).fillna(False)
+            is_included = is_included.values.astype(bool)
+        return cls(prices.index, prices.columns, first_live, last_live, is_included=is_included)
+
+    def get_position(self, date):
+        """ :param date: date of the index or an integer position """
+        if isinstance(date, (int, np.integer)):
+            return date
+        return self.index.get_loc(date)
+
+    def live_positions(self, date):
+        """ :return: np.array of the integer positions of the columns live at date """
+        return self.live_sets[self.set_ids[self.get_position(date)]]
+
+    def live_columns(self, date):
+        """ :return: pd.Index of the columns live at date """
+        return self.columns[self.live_positions(date)]
+
+    def count_live(self):
+        """ :return: pd.Series of the number of live columns per date """
+        set_sizes = np.array([len(live_set) for live_set in self.live_sets])
+        return pd.Series(set_sizes[self.set_ids], index=self.index)
+
+    def first_date_with_n_live(self, n=2):
+        """ first date on which at least n columns are live, None if there is none """
+        is_enough = self.count_live().values >= n
+        return self.index[is_enough.argmax()] if is_enough.any() else None
+
+    def to_frame(self):
+        """ :return: boolean pd.DataFrame of the membership, True where a column is live """
+        is_live = np.zeros((len(self.index), len(self.columns)), dtype=bool)
+        for set_id, live_set in enumerate(self.live_sets):
+            rows = np.flatnonzero(self.set_ids == set_id)
+            is_live[np.ix_(rows, live_set)] = True
+        return pd.DataFrame(is_live, index=self.index, columns=self.columns)
+
+    def to_dict(self):
+        """ compact representation for cache keys: the index, columns, set per date and the live sets """
+        return {'index': self.index, 'columns': self.columns, 'set_ids': self.set_ids,
+                'live_set_sizes': np.array([len(live_set) for live_set in self.live_sets]),
+                'live_sets': np.concatenate(self.live_sets) if len(self.live_sets) > 0 else np.array([])}
+
+    def is_live_at(self, positions, columns):
+        """
+        :param positions: np.array of integer positions in the index, -1 before the first date
+        :param columns: pd.Index of columns, columns not in the membership are never live
+        :return: boolean np.array (len(positions), len(columns)), True where a column is live
+        """
+        column_positions = self.columns.get_indexer(columns)
+        is_known = column_positions >= 0
+        positions = np.asarray(positions)[:, None]
+        is_live = (positions >= self.first_live[column_positions]) & (positions <= self.last_live[column_positions])
+        is_live &= is_known & (positions >= 0)
+        if self.has_inclusion_rule:
+            # the inclusion mask is only kept in the live sets, rows are looked up by their set
+            set_ids = self.set_ids[np.maximum(positions[:, 0], 0)]
+            for set_id in np.unique(set_ids):
+                rows = set_ids == set_id
+                is_live[rows] &= np.isin(column_positions, self.live_sets[set_id])
+        return is_live
+
+    def mask_weights(self, weights, fill_value=0.):
+        """
+        :param weights: pd.DataFrame of weights, dates after the last date of the index keep its membership
+        :param fill_value: weight of the columns that are not live
+        :return: pd.DataFrame of weights with fill_value where a column is not live
+        """
+        positions = self.index.searchsorted(weights.index, side='right') - 1
+        return weights.where(self.is_live_at(positions, weights.columns), fill_value)